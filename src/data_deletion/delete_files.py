@@ -2,6 +2,8 @@ import os
 from datetime import datetime, timedelta
 
 from notulen.settings import DATALAKE_BASE_FOLDER
+from notulen.utils.result_cache import delete_expired_results
+from notulen.utils.transcript_cache import delete_expired_transcripts
 from shared.msteams import log_result_to_MS_teams
 from shared.my_logging import logger
 from shared.utils import AzureHelper, init_openai_client
@@ -31,16 +33,20 @@ def delete_data_from_datalake(az: AzureHelper):
 def delete_old_notulen_files() -> None:
     """Removes all uploaded and created files in the process of generating notulen.
 
-    That is: agenda, opname, transcript, notulen, and any intermediate files.
+    That is: agenda, opname, transcript, notulen, and any intermediate files, and the cached transcripts and results.
     Files are considered 'old' if they are older than 7 days and then removed from datalake.
     """
     logger.info("Deleting notulen from datalake prd")
     az = AzureHelper(account_name=os.environ["DATALAKE_NAME_PRD"])
     delete_data_from_datalake(az)
+    delete_expired_transcripts(az)
+    delete_expired_results(az)
 
     logger.info("Deleting notulen from datalake dev")
     az2 = AzureHelper(account_name=os.environ["DATALAKE_NAME_DEV"])
     delete_data_from_datalake(az2)
+    delete_expired_transcripts(az2)
+    delete_expired_results(az2)
 
     return None
 
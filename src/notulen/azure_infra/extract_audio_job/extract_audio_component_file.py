@@ -0,0 +1,33 @@
+"""Zie transcribe_component_file.py voor meer uitleg over dit bestand, want het is bijna hetzelfde.
+
+Deze (optionele) component draait op een CPU node voor de transcribe node, en haalt alleen de audio uit de opname.
+"""
+import os
+import sys
+from pathlib import Path
+
+from mldesigner import Input, Output, command_component
+
+# dir_path should lead to src so that you can do imports from your other files
+dir_path = Path(os.path.abspath(__file__)).parent.parent.parent.parent
+sys.path.append(str(dir_path))
+
+from notulen.transcribe import extract_audio  # noqa: E402
+
+
+@command_component(
+    name="extract_audio_job",
+    version="1",
+    display_name="Extract the audio of the recording",
+    description="Decode the recording into compact 16 kHz mono PCM for the transcribe job",
+    environment=dict(
+        conda_file=Path(__file__).parent / "conda-extract-audio.yaml",
+        image="mcr.microsoft.com/azureml/openmpi4.1.0-ubuntu22.04:latest",
+    ),
+    code="../../..",  # this should lead to the src folder
+)
+def extract_audio_component(
+    input_folder: Input(type="uri_folder"), output_folder: Output(type="uri_folder")  # noqa:F821
+):
+    """Prepare the component."""
+    extract_audio(folder_path=input_folder, output_folder=output_folder)
@@ -16,13 +16,32 @@ from azure.identity import DefaultAzureCredential
 dir_path = Path(os.path.abspath(__file__)).parent.parent.parent
 sys.path.append(str(dir_path))
 
+from notulen.azure_infra.extract_audio_job.extract_audio_component_file import (  # noqa: E402
+    extract_audio_component,
+)
 from notulen.azure_infra.post_transcribe_job.post_transcribe_component_file import (  # noqa: E402
     post_transcribe_component,
 )
 from notulen.azure_infra.transcribe_job.transcribe_component_file import (  # noqa: E402
     transcribe_component,
 )
-from notulen.settings import DATALAKE_BASE_FOLDER  # noqa: E402
+from notulen.settings import (  # noqa: E402
+    CPU_TRANSCRIBE_INSTANCE_TYPE,
+    DATALAKE_BASE_FOLDER,
+    DEFAULT_TRANSCRIBE_PROFILE,
+    LLM_EXECUTION_MODE,
+    LLM_EXECUTION_MODES,
+    TRANSCRIBE_ENGINES,
+    WHISPER_MODEL_FOLDER,
+    WHISPER_MODEL_VERSION,
+    get_transcribe_settings,
+)
+from notulen.utils.transcript_cache import (  # noqa: E402
+    compute_transcript_cache_key,
+    fetch_cached_transcript,
+)
+from shared.my_logging import logger  # noqa: E402
+from shared.utils import AzureHelper  # noqa: E402
 
 # from webapp.check_credential import check_credential
 
@@ -41,35 +60,130 @@ def my_pipeline(
     email: str,
     vve_number="",
     for_vve=False,
+    transcribe_engine="gpu",
+    transcribe_profile=DEFAULT_TRANSCRIBE_PROFILE,
+    transcript_cache_key="",
+    model_folder: Input = None,
+    llm_execution_mode=LLM_EXECUTION_MODE,
 ) -> Any:
     """Generate meeting notes."""
 
     output_folder = Output(path=output_folder_path, type="uri_folder", mode="rw_mount")
 
-    gpu_node = transcribe_component(input_folder=input_folder)
+    gpu_node = transcribe_component(input_folder=input_folder, model_folder=model_folder)
     # use either gpu_node.compute or gpu_node.resources to set the compute, depending on if you
     # want to use the compute cluster or serverless compute. Note that for serverless compute,
     # the NCv3 series will deprecate!
     gpu_node.compute = "ml-ci-gpu-cluster-prd"
     # gpu_node.resources = ResourceConfiguration(instance_type="Standard_NC6s_v3", instance_count=1)
     gpu_node.outputs.output_folder = output_folder
-    gpu_node.environment_variables = {
+    gpu_node.environment_variables = transcribe_node_environment_variables(
+        vve_number, for_vve, timestamp, OTAP, email, transcribe_engine, transcribe_profile
+    )
+
+    cpu_node = post_transcribe_component(input_folder=gpu_node.outputs.output_folder)
+    # use this instead if you want to comment out the gpu node:
+    # cpu_node = post_transcribe_component(input_folder=input_folder)
+    cpu_node.resources = ResourceConfiguration(instance_type="Standard_DS1_v2", instance_count=1)
+    cpu_node.outputs.output_folder = output_folder
+    cpu_node.environment_variables = cpu_node_environment_variables(
+        vve_number, for_vve, timestamp, type_notulen, OTAP, email, transcript_cache_key, llm_execution_mode
+    )
+
+
+@pipeline(default_compute="serverless")
+def my_pipeline_with_audio_extraction(
+    input_folder: Input,
+    output_folder_path: str,
+    timestamp: str,
+    type_notulen: str,
+    OTAP: str,
+    email: str,
+    vve_number="",
+    for_vve=False,
+    transcribe_engine="gpu",
+    transcribe_profile=DEFAULT_TRANSCRIBE_PROFILE,
+    transcript_cache_key="",
+    model_folder: Input = None,
+    llm_execution_mode=LLM_EXECUTION_MODE,
+) -> Any:
+    """Generate meeting notes, but first extract the audio of the recording on a CPU node.
+
+    Useful for (large) video recordings: the GPU node then only reads the compact audio instead of the whole video.
+    """
+
+    output_folder = Output(path=output_folder_path, type="uri_folder", mode="rw_mount")
+
+    audio_node = extract_audio_component(input_folder=input_folder)
+    audio_node.resources = ResourceConfiguration(instance_type="Standard_DS3_v2", instance_count=1)
+    audio_node.outputs.output_folder = output_folder
+    audio_node.environment_variables = transcribe_node_environment_variables(
+        vve_number, for_vve, timestamp, OTAP, email, transcribe_engine, transcribe_profile, in_which_node="cpu_audio"
+    )
+
+    gpu_node = transcribe_component(input_folder=audio_node.outputs.output_folder, model_folder=model_folder)
+    gpu_node.compute = "ml-ci-gpu-cluster-prd"
+    gpu_node.outputs.output_folder = output_folder
+    gpu_node.environment_variables = transcribe_node_environment_variables(
+        vve_number, for_vve, timestamp, OTAP, email, transcribe_engine, transcribe_profile
+    )
+
+    cpu_node = post_transcribe_component(input_folder=gpu_node.outputs.output_folder)
+    cpu_node.resources = ResourceConfiguration(instance_type="Standard_DS1_v2", instance_count=1)
+    cpu_node.outputs.output_folder = output_folder
+    cpu_node.environment_variables = cpu_node_environment_variables(
+        vve_number, for_vve, timestamp, type_notulen, OTAP, email, transcript_cache_key, llm_execution_mode
+    )
+
+
+@pipeline(default_compute="serverless")
+def my_pipeline_from_transcript(
+    input_folder: Input,
+    output_folder_path: str,
+    timestamp: str,
+    type_notulen: str,
+    OTAP: str,
+    email: str,
+    vve_number="",
+    for_vve=False,
+    llm_execution_mode=LLM_EXECUTION_MODE,
+) -> Any:
+    """Generate meeting notes when the transcript is already in the folder (transcript cache hit), so without the GPU
+    node."""
+
+    output_folder = Output(path=output_folder_path, type="uri_folder", mode="rw_mount")
+
+    cpu_node = post_transcribe_component(input_folder=input_folder)
+    cpu_node.resources = ResourceConfiguration(instance_type="Standard_DS1_v2", instance_count=1)
+    cpu_node.outputs.output_folder = output_folder
+    cpu_node.environment_variables = cpu_node_environment_variables(
+        vve_number, for_vve, timestamp, type_notulen, OTAP, email, "", llm_execution_mode
+    )
+
+
+def transcribe_node_environment_variables(
+    vve_number, for_vve, timestamp, OTAP, email, transcribe_engine, transcribe_profile, in_which_node="gpu"
+) -> dict:
+    """Environment variables of the transcribe (GPU) node, and of the audio extraction node."""
+    return {
         "vve_number": vve_number,
         "for_vve": for_vve,
         "OTAP": OTAP,
         "email": email,
         "timestamp": timestamp,
-        "in_which_node": "gpu",
+        "in_which_node": in_which_node,
+        "transcribe_engine": transcribe_engine,
+        "transcribe_profile": transcribe_profile,
         "APPLICATION_INSIGHTS_CONNECTION_STRING": os.environ["APPLICATION_INSIGHTS_CONNECTION_STRING"],
         "APPLICATION_INSIGHTS_NAMESPACE": os.environ["APPLICATION_INSIGHTS_NAMESPACE"],
     }
 
-    cpu_node = post_transcribe_component(input_folder=gpu_node.outputs.output_folder)
-    # use this instead if you want to comment out the gpu node:
-    # cpu_node = post_transcribe_component(input_folder=input_folder)
-    cpu_node.resources = ResourceConfiguration(instance_type="Standard_DS1_v2", instance_count=1)
-    cpu_node.outputs.output_folder = output_folder
-    cpu_node.environment_variables = {
+
+def cpu_node_environment_variables(
+    vve_number, for_vve, timestamp, type_notulen, OTAP, email, transcript_cache_key, llm_execution_mode
+) -> dict:
+    """Environment variables of the post transcribe (CPU) node."""
+    return {
         "vve_number": vve_number,
         "for_vve": for_vve,
         "timestamp": timestamp,
@@ -77,7 +191,13 @@ def my_pipeline(
         "OTAP": OTAP,
         "email": email,
         "in_which_node": "cpu",
+        # when not empty, the post transcribe node stores the new transcript in the transcript cache under this key
+        "transcript_cache_key": transcript_cache_key,
         "DATALAKE_NAME": os.environ["DATALAKE_NAME"],
+        # share the results of the splitting and the notulen per agendapunt with other jobs via the datalake
+        "result_cache_datalake": "True",
+        # "batch": the splitting and the notulen through the Batch API, for jobs that are not urgent
+        "llm_execution_mode": llm_execution_mode,
         "APPLICATION_INSIGHTS_CONNECTION_STRING": os.environ["APPLICATION_INSIGHTS_CONNECTION_STRING"],
         "APPLICATION_INSIGHTS_NAMESPACE": os.environ["APPLICATION_INSIGHTS_NAMESPACE"],
         "OPENAI_SWEDEN": os.environ["OPENAI_SWEDEN"],
@@ -87,10 +207,60 @@ def my_pipeline(
     }
 
 
+def get_model_folder(OTAP: str, model_size: str) -> Input | None:
+    """The published Whisper model snapshot (see whisper_model_utils.py) as input of the transcribe node, which
+    downloads it to its local disk before it starts.
+
+    None when no snapshot of this model size and WHISPER_MODEL_VERSION is published: the transcribe node then downloads
+    the model from the hub, like before the snapshots.
+    """
+    snapshot_path = f"{WHISPER_MODEL_FOLDER}/{model_size}/{WHISPER_MODEL_VERSION}"
+    az = AzureHelper(account_name=os.environ["DATALAKE_NAME"])
+    if not az.container_client.get_blob_client(f"{snapshot_path}/manifest.json").exists():
+        logger.warning(f"No published model snapshot {snapshot_path}, the transcribe node downloads it from the hub")
+        return None
+    model_datastore_name = f"{DATALAKE_BASE_FOLDER}_prd" if OTAP in ["prd", "acc"] else f"{DATALAKE_BASE_FOLDER}_dev"
+    return Input(
+        path=f"azureml://datastores/{model_datastore_name}/paths/{snapshot_path}",
+        type="uri_folder",
+        mode="download",
+    )
+
+
 def run_pipeline(
-    timestamp: str, type_notulen: str, OTAP: str, email: str, vve_number="", for_vve=False
+    timestamp: str,
+    type_notulen: str,
+    OTAP: str,
+    email: str,
+    vve_number="",
+    for_vve=False,
+    transcribe_engine="gpu",
+    transcribe_profile=DEFAULT_TRANSCRIBE_PROFILE,
+    use_transcript_cache=True,
+    extract_audio_first=False,
+    llm_execution_mode=LLM_EXECUTION_MODE,
 ) -> tuple[MLClient, Job]:
-    """Runs the pipeline."""
+    """Runs the pipeline.
+
+    With transcribe_engine="cpu_batched" the transcribe step runs with int8 batched inference on a CPU node instead of
+    the GPU cluster, e.g. to absorb overflow when recordings queue up behind the GPU node.
+
+    transcribe_profile ("fast", "balanced" or "accurate", see TRANSCRIBE_PROFILES) trades transcription accuracy for
+    turnaround time.
+
+    With use_transcript_cache, the recording is first looked up in the transcript cache. On a cache hit the transcript
+    is copied into the folder and the pipeline runs without the transcribe node.
+
+    With extract_audio_first, a CPU node first extracts the audio of the recordings, so that the transcribe node does
+    not have to read whole video files. Recommended for mp4/webm uploads.
+
+    llm_execution_mode "batch" sends the prompts of the splitting and the notulen through the Batch API: cheaper, but
+    the notulen can take hours instead of minutes. For jobs that are not urgent, see LLM_EXECUTION_MODE.
+    """
+    if transcribe_engine not in TRANSCRIBE_ENGINES:
+        raise ValueError(f"Unknown transcribe_engine '{transcribe_engine}', choose from {TRANSCRIBE_ENGINES}")
+    if llm_execution_mode not in LLM_EXECUTION_MODES:
+        raise ValueError(f"Unknown llm_execution_mode '{llm_execution_mode}', choose from {LLM_EXECUTION_MODES}")
     if for_vve:
         folder = f"{vve_number}/{timestamp}"
     else:
@@ -114,17 +284,53 @@ def run_pipeline(
     )
     output_folder_path = os.path.join(f"azureml://datastores/{datastore_name}/paths/{DATALAKE_BASE_FOLDER}/", folder)
 
+    settings = get_transcribe_settings(engine=transcribe_engine, profile=transcribe_profile)
+    model_folder = get_model_folder(OTAP, settings["model_size"])
+
+    # the transcript cache lives on DATALAKE_NAME, the VvE datastores are not part of it
+    transcript_cache_key = ""
+    transcript_cached = False
+    if use_transcript_cache and not for_vve:
+        az = AzureHelper(account_name=os.environ["DATALAKE_NAME"])
+        transcript_cache_key = compute_transcript_cache_key(az, folder, settings)
+        transcript_cached = bool(transcript_cache_key) and fetch_cached_transcript(az, transcript_cache_key, folder)
+
     # create a pipeline
-    pipeline_job = my_pipeline(
-        input_folder=input_folder,
-        output_folder_path=output_folder_path,
-        timestamp=timestamp,
-        type_notulen=type_notulen,
-        OTAP=OTAP,
-        email=email,
-        vve_number=vve_number,
-        for_vve=for_vve,
-    )
+    if transcript_cached:
+        pipeline_job = my_pipeline_from_transcript(
+            input_folder=input_folder,
+            output_folder_path=output_folder_path,
+            timestamp=timestamp,
+            type_notulen=type_notulen,
+            OTAP=OTAP,
+            email=email,
+            vve_number=vve_number,
+            for_vve=for_vve,
+            llm_execution_mode=llm_execution_mode,
+        )
+    else:
+        pipeline_function = my_pipeline_with_audio_extraction if extract_audio_first else my_pipeline
+        pipeline_job = pipeline_function(
+            input_folder=input_folder,
+            output_folder_path=output_folder_path,
+            timestamp=timestamp,
+            type_notulen=type_notulen,
+            OTAP=OTAP,
+            email=email,
+            vve_number=vve_number,
+            for_vve=for_vve,
+            transcribe_engine=transcribe_engine,
+            transcribe_profile=transcribe_profile,
+            transcript_cache_key=transcript_cache_key,
+            model_folder=model_folder,
+            llm_execution_mode=llm_execution_mode,
+        )
+    if transcribe_engine == "cpu_batched" and not transcript_cached:
+        # the node is still called gpu_node, but now runs on a CPU instance
+        pipeline_job.jobs["gpu_node"].compute = None
+        pipeline_job.jobs["gpu_node"].resources = ResourceConfiguration(
+            instance_type=CPU_TRANSCRIBE_INSTANCE_TYPE, instance_count=1
+        )
     if for_vve:
         pipeline_job.display_name = f"VvE-{vve_number}"
     else:
@@ -29,5 +29,9 @@ from notulen.transcribe import transcribe  # noqa: E402
     ),
     code="../../..",  # this should lead to the src folder
 )
-def transcribe_component(input_folder: Input(type="uri_folder"), output_folder: Output(type="uri_folder")):  # noqa:F821
-    transcribe(folder_path=input_folder, output_folder=output_folder)
+def transcribe_component(
+    input_folder: Input(type="uri_folder"),  # noqa:F821
+    output_folder: Output(type="uri_folder"),  # noqa:F821
+    model_folder: Input(type="uri_folder", optional=True) = None,  # noqa:F821
+):
+    transcribe(folder_path=input_folder, output_folder=output_folder, model_folder=model_folder)
@@ -0,0 +1,180 @@
+"""Benchmark of the transcription: real-time factor, peak memory and model load time per configuration.
+
+Runs on CPU and without network: the models are loaded from published snapshots (see whisper_model_utils.py) and the
+audio comes from a folder with (Dutch) speech clips, or is synthesized. Synthetic clips are speech-like (voiced
+syllables with pauses) but are not real speech, so use --clips-dir with real recordings to judge the transcripts too.
+Every configuration runs in a fresh process, so that the peak memory of one configuration does not hide the next.
+
+Example:
+    python src/notulen/benchmark_transcribe.py --model-folders data/whisper_models/large-v2/v1 \
+        --engines gpu cpu_batched --beam-sizes 1 5
+On a machine without GPU the "gpu" engine runs the sequential (non batched) decoder on CPU.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+
+from notulen.settings import SUPPORTED_MEDIA_FILES, get_transcribe_settings
+from notulen.transcribe import load_whisper_model, transcribe_folder
+from notulen.utils.audio_utils import SAMPLING_RATE
+from notulen.utils.whisper_model_utils import verify_model_artifact
+from shared.my_logging import logger
+
+SYNTHETIC_CLIP_SECONDS = [30, 120, 600]
+
+
+def synthesize_clip(path: Path, seconds: int, seed: int = 0) -> None:
+    """Write a speech-like test signal as 16 kHz wav: sentences of voiced syllables (harmonics of a varying pitch,
+    about 4 syllables per second) separated by pauses, with some background noise."""
+    rng = np.random.default_rng(seed)
+    audio = np.zeros(seconds * SAMPLING_RATE, dtype=np.float32)
+    position = 0
+    while position < len(audio):
+        length = min(int(rng.uniform(2, 8) * SAMPLING_RATE), len(audio) - position)
+        t = np.arange(length) / SAMPLING_RATE
+        pitch = rng.uniform(100, 220) * (1 + 0.1 * np.sin(2 * np.pi * 0.5 * t))
+        phase = 2 * np.pi * np.cumsum(pitch) / SAMPLING_RATE
+        voiced = sum(np.sin(k * phase) / k for k in range(1, 6))
+        syllables = np.clip(np.sin(2 * np.pi * rng.uniform(3, 5) * t), 0, None)
+        audio[position : position + length] = 0.3 * voiced * syllables  # noqa:E203
+        position += length + int(rng.uniform(0.3, 3) * SAMPLING_RATE)
+    audio += rng.normal(0, 0.005, len(audio)).astype(np.float32)
+
+    with wave.open(path.as_posix(), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLING_RATE)
+        f.writeframes((np.clip(audio, -1, 1) * 32767).astype(np.int16).tobytes())
+
+
+def get_clips(clips_dir: Path | None, work_dir: Path) -> list[Path]:
+    """The clips in clips_dir, or synthetic clips of SYNTHETIC_CLIP_SECONDS when no clips_dir is given."""
+    if clips_dir is not None:
+        clips = sorted(p for p in clips_dir.iterdir() if p.suffix.lstrip(".") in SUPPORTED_MEDIA_FILES)
+        if not clips:
+            raise FileNotFoundError(f"No audio/video clips in {clips_dir}")
+        return clips
+    clips = []
+    for seconds in SYNTHETIC_CLIP_SECONDS:
+        path = work_dir / f"synthetic_{seconds}s.wav"
+        synthesize_clip(path, seconds)
+        clips.append(path)
+    return clips
+
+
+def get_snapshot_model_size(model_folder: Path) -> str:
+    """The model size of a published snapshot (model_size/version), from its manifest."""
+    manifest = verify_model_artifact(model_folder)
+    if model_folder.parent.name != manifest["model_size"]:
+        raise ValueError(
+            f"Model folder {model_folder} contains {manifest['model_size']}, not {model_folder.parent.name}"
+        )
+    return manifest["model_size"]
+
+
+def benchmark_config(config: dict, clips: list[Path]) -> list[dict]:
+    """Load the model once and transcribe every clip with it. Runs in its own process (see main)."""
+    settings = get_transcribe_settings(engine=config["engine"])
+    # model_size comes from the manifest of the snapshot (see main), so it overrides the model of the profile too
+    settings.update({k: v for k, v in config.items() if k in settings})
+    settings["device"] = config["device"]
+
+    start = time.time()
+    model = load_whisper_model(settings, config["model_folder"])
+    model_load_seconds = time.time() - start
+
+    results = []
+    for clip in clips:
+        with tempfile.TemporaryDirectory() as tmp:
+            folder = Path(tmp)
+            (folder / "input/opname").mkdir(parents=True)
+            shutil.copy(clip, folder / "input/opname" / f"1{clip.suffix}")
+            start = time.time()
+            transcribe_folder(folder, settings, model)
+            elapsed = time.time() - start
+            duration = (folder / "pcm/1.pcm").stat().st_size / 2 / SAMPLING_RATE
+            results.append(
+                {
+                    **config,
+                    "clip": clip.name,
+                    "clip_seconds": round(duration, 1),
+                    "elapsed_seconds": round(elapsed, 2),
+                    "real_time_factor": round(elapsed / duration, 4),
+                    "model_load_seconds": round(model_load_seconds, 2),
+                    "transcript_lines": len((folder / "transcript.txt").read_text().splitlines()),
+                }
+            )
+    # ru_maxrss is in kilobytes on Linux, and this process only ran this configuration
+    peak_rss_mb = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    for result in results:
+        result["peak_rss_mb"] = peak_rss_mb
+    return results
+
+
+def main() -> None:
+    """Run every combination of the given settings on every clip and write the results as JSON."""
+    parser = argparse.ArgumentParser(description="Benchmark the transcription of notulen.transcribe.")
+    parser.add_argument("--model-folders", nargs="+", required=True, help="published model snapshots")
+    parser.add_argument("--clips-dir", type=Path, default=None, help="folder with speech clips (default: synthetic)")
+    parser.add_argument("--engines", nargs="+", default=["cpu_batched"])
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--compute-types", nargs="+", default=["int8"])
+    parser.add_argument("--beam-sizes", nargs="+", type=int, default=[1, 5])
+    parser.add_argument("--vad", nargs="+", choices=["on", "off"], default=["on"])
+    parser.add_argument("--compact-silences", nargs="+", choices=["on", "off"], default=["on"])
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--output", type=Path, default=None)
+    args = parser.parse_args()
+
+    output = args.output or Path(f"data/benchmarks/transcribe_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory() as work_dir:
+        clips = get_clips(args.clips_dir, Path(work_dir))
+        results = []
+        for model_folder, engine, compute_type, beam_size, vad, compact in itertools.product(
+            args.model_folders, args.engines, args.compute_types, args.beam_sizes, args.vad, args.compact_silences
+        ):
+            config = {
+                "model_folder": model_folder,
+                "model_size": get_snapshot_model_size(Path(model_folder)),
+                "engine": engine,
+                "device": args.device,
+                "compute_type": compute_type,
+                "beam_size": beam_size,
+                "vad_filter": vad == "on",
+                "compact_silences": compact == "on",
+                "batch_size": args.batch_size,
+            }
+            logger.info(f"Benchmarking {config}")
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                results.extend(executor.submit(benchmark_config, config, clips).result())
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "machine": {"platform": platform.platform(), "cpu_count": os.cpu_count()},
+        "results": results,
+    }
+    output.write_text(json.dumps(report, indent=4))
+    for result in results:
+        logger.info(
+            f"{result['model_size']} {result['engine']} {result['compute_type']} beam {result['beam_size']}, "
+            f"{result['clip']}: real-time factor {result['real_time_factor']}, peak {result['peak_rss_mb']} MB"
+        )
+    logger.info(f"Benchmark results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,82 @@
 import base64
+import hashlib
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 from pathlib import Path
 from time import time
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional
 
+import httpx
 import requests
 
 # from msal import ConfidentialClientApplication
 from azure.identity import DefaultAzureCredential
 from mldesigner import Input, Output
+from openai import APIError, LengthFinishReasonError, OpenAI
 
+from notulen.settings import (
+    DEPLOYMENT_NAME,
+    LLM_SAMPLING_PARAMETERS,
+    NOTULEN_CONCURRENCY,
+    NOTULEN_STREAMING,
+    PRESEGMENT,
+    PRESEGMENT_CONFIDENCE,
+    PRESEGMENT_MIN_SAVING,
+    PRESEGMENT_MODES,
+    SPLIT_CONCURRENCY,
+    SPLIT_OUTPUT_TOKENS_PER_AGENDAPUNT,
+    SPLIT_STRATEGIES,
+    SPLIT_STRATEGY,
+    SPLIT_WINDOW_OVERLAP_LINES,
+    SPLIT_WINDOW_TOKENS,
+    get_llm_execution_mode,
+    get_split_settings,
+    get_split_token_budgets,
+)
+from notulen.utils.batch_utils import (
+    batch_result_content,
+    build_batch_request,
+    get_batch_client,
+    get_llm_deployment_name,
+    run_batch,
+)
+from notulen.utils.llm_ledger import get_llm_ledger
+from notulen.utils.progress_utils import NotulenProgress
+from notulen.utils.rate_limit_utils import make_rate_limited_llm_call
+from notulen.utils.result_cache import (
+    compute_result_cache_key,
+    fetch_cached_result,
+    store_result_in_cache,
+)
+from notulen.utils.retrieval_utils import candidate_line_ranges, presegment
 from notulen.utils.splits_utils import (
     apply_gpt_split,
-    create_agenda_groups,
     extract_agendapunten,
+    merge_window_splits,
+    plan_agenda_groups,
+    plan_transcript_windows,
 )
+from notulen.utils.stage_utils import Stage, file_hash, run_stages
+from notulen.utils.token_utils import count_tokens
+from notulen.utils.transcript import get_transcript
+from notulen.utils.transcript_cache import store_transcript_in_cache
 from notulen.utils.utilities import (
+    CONTENT_FILTER_MESSAGE,
+    AgendapuntenMetGevondenRegels,
+    StartregelsVanAgendapunten,
     convert_from_pdf_to_markdown,
     convert_stuff_to_docx_for_stakeholders,
     convert_to_docx,
     get_splitsing_prompt,
-    load_transcript,
-    make_llm_call,
     new_trial_nr,
     process_llm_output,
+    read_agenda,
 )
 from shared.my_logging import logger
-from shared.utils import init_openai_client
-
-# For local development, we can use "trials" of specific parts of the process
-# so that we don't need to do a full run every time. For example, if you tried the part of splitting the transcript
-# and it worked, you can set the trial to that number and it will use the existing splits.
-SPLITS_TRIAL = None
-NOTUL_TRIAL = None
+from shared.utils import AzureHelper, init_openai_client
 
 
 def full_pipeline(input_folder: Input(type="uri_folder"), output_folder: Output(type="uri_folder")):  # noqa:F821
@@ -43,65 +85,167 @@ def full_pipeline(input_folder: Input(type="uri_folder"), output_folder: Output(
     Dus let op: het agendabestand, de opname en het transcript moeten klaar staan.
     De opname staat dan in data/foldernaam/input en de agenda in data/foldernaam/input/opname.
     Als je een custom agenda gebruikt, zet het in data/foldernaam/input/agenda.txt
+
+    De stappen zijn stages (zie utils/stage_utils.py): bij een rerun in dezelfde folder worden de stages die al klaar
+    zijn overgeslagen. Als bijvoorbeeld alleen de e-mail mislukte, wordt bij een rerun alleen de e-mail verstuurd.
     """
     logger.info("\n\n\n\n Notulen pipeline entered \n\n\n\n")
     input_folder = Path(output_folder)  # for local development, don't do this
     logger.info(input_folder.stem)
     start = time()
-    if os.environ["for_vve"] == "True":
-        for_vve = True
-        convert_from_pdf_to_markdown(input_folder)
-        agenda_splitsing = extract_agendapunten(input_folder)
+    for_vve = os.environ["for_vve"] == "True"
+    transcript_cache_key = os.environ.get("transcript_cache_key", "")
+    stages = [
+        Stage(
+            "transcript_cache",
+            partial(stage_transcript_cache, input_folder, transcript_cache_key),
+            parameters={"transcript_cache_key": transcript_cache_key},
+        ),
+        Stage(
+            "agenda",
+            partial(stage_agenda, input_folder, for_vve),
+            parameters={"for_vve": for_vve, "input_files": hash_agenda_input_files(input_folder)},
+            outputs=lambda result: ["processed_input_docs/agenda.md"] if for_vve else [],
+        ),
+        Stage(
+            "transcript",
+            partial(stage_transcript, input_folder),
+            parameters={"transcript.txt": file_hash(input_folder / "transcript.txt")},
+            outputs=lambda result: ["transcript_numbered.txt"],
+        ),
+        Stage(
+            "splitsing",
+            partial(stage_splitsing, input_folder, for_vve),
+            depends_on=("agenda", "transcript"),
+            # dezelfde instellingen als in de key van de result cache van de splitsing
+            parameters=get_split_settings(),
+            outputs=lambda result: [
+                f"{result['splits_path']}/{name}"
+                for name in ("interval_split_llm_output.json", "transcript gesplitst.json", "resultaat splitsing.md")
+            ],
+        ),
+        Stage(
+            "notulen",
+            partial(stage_notulen, input_folder, for_vve),
+            depends_on=("agenda", "splitsing"),
+            parameters={"type_notulen": os.environ["type_notulen"], "vve_number": os.environ.get("vve_number", "")},
+            outputs=lambda result: [f"{result['notulen_path']}/notulen.md", f"{result['notulen_path']}/notulen.docx"],
+        ),
+        Stage(
+            "stakeholder_docs",
+            partial(stage_stakeholder_docs, input_folder),
+            depends_on=("splitsing", "notulen"),
+            outputs=lambda result: [
+                "result/splitsing output LLM.docx",
+                "result/resultaat splitsing.docx",
+                "result/notulen.docx",
+            ],
+        ),
+        Stage(
+            "email",
+            partial(stage_email, input_folder, os.environ["email"]),
+            depends_on=("notulen",),
+            parameters={"email": os.environ["email"], "timestamp": os.environ.get("timestamp")},
+        ),
+    ]
+    get_llm_ledger().start_job(input_folder)
+    try:
+        run_stages(input_folder, stages)
+    finally:
+        get_llm_ledger().write_summary()
+    logger.info(f"Total time full_pipeline: {round((time()-start)/60,1)} min")
+
+
+def hash_agenda_input_files(folder_path: Path) -> dict:
+    """De hashes van de agendabestanden in input (PDF, agendapunten.json, agenda.txt), voor de checkpoint."""
+    paths = sorted((folder_path / "input").glob("*.pdf")) + [
+        folder_path / "input/agendapunten.json",
+        folder_path / "input/agenda.txt",
+    ]
+    return {path.name: file_hash(path) for path in paths}
+
+
+def stage_transcript_cache(folder_path: Path, transcript_cache_key: str) -> dict:
+    """Sla een nieuw transcript op in de transcript cache, voor als dezelfde opname nog een keer wordt ingestuurd."""
+    if transcript_cache_key:
+        store_transcript_in_cache(AzureHelper(), transcript_cache_key, folder_path / "transcript.txt")
+    return {"stored": bool(transcript_cache_key)}
+
+
+def stage_agenda(folder_path: Path, for_vve: bool) -> dict:
+    """Zet de agenda om naar agendapunten: uit de PDF (VvE) of uit input/agendapunten.json."""
+    if for_vve:
+        # de stage draait alleen als de agendabestanden zijn veranderd (of de eerste keer), dus de PDF opnieuw omzetten
+        (folder_path / "processed_input_docs/agenda.md").unlink(missing_ok=True)
+        convert_from_pdf_to_markdown(folder_path)
+        agenda_splitsing = extract_agendapunten(folder_path)
     else:
-        for_vve = False
-        with open(input_folder / "input/agendapunten.json", "r") as f:
+        with open(folder_path / "input/agendapunten.json", "r") as f:
             agenda_splitsing = json.load(f)
+    return {"agenda_splitsing": agenda_splitsing}
 
-    if SPLITS_TRIAL is None:
-        gpt_dict, splits_path = get_gpt_split(input_folder, agenda_splitsing, for_vve)
-    else:
-        splits_path = input_folder / "splitsing" / str(SPLITS_TRIAL)
-        with open(splits_path / "interval_split_llm_output.json", "r") as json_file:
-            gpt_dict = json.load(json_file)
 
-    transcript_lines = load_transcript(input_folder, numbered=False)
-    transcript_lines_numbered = load_transcript(input_folder, numbered=True)
-    transcript_gesplitst_dict = apply_gpt_split(transcript_lines, gpt_dict, splits_path)
-    transcript_gesplitst_numbered_dict = apply_gpt_split(transcript_lines_numbered, gpt_dict, splits_path)
+def stage_transcript(folder_path: Path) -> dict:
+    """Laad het transcript (eenmalig, zie utils/transcript.py), tegelijk met het omzetten van de agenda."""
+    transcript = get_transcript(folder_path)
+    return {"sha256": hashlib.sha256(transcript.text.encode()).hexdigest(), "lines": len(transcript)}
+
 
+def stage_splitsing(folder_path: Path, for_vve: bool, agenda: dict, transcript: dict) -> dict:
+    """Splits het transcript in stukjes per agendapunt."""
+    agenda_splitsing = agenda["agenda_splitsing"]
+    gpt_dict, splits_path = get_gpt_split(folder_path, agenda_splitsing, for_vve)
+    transcript_gesplitst_dict, transcript_gesplitst_numbered_dict = apply_gpt_split(
+        get_transcript(folder_path), gpt_dict, splits_path
+    )
+    with open(splits_path / "transcript gesplitst.json", "w") as f:
+        json.dump(transcript_gesplitst_dict, f, ensure_ascii=False)
     with open(splits_path / "resultaat splitsing.md", "w") as f:
         for key, value in transcript_gesplitst_numbered_dict.items():
             agendapunt_titel = agenda_splitsing[key]["titel"]
             f.write(f"# {agendapunt_titel}\n\n\n\n{value}\n\n\n\n")
+    return {"splits_path": splits_path.relative_to(folder_path).as_posix()}
 
-    type_notulen = os.environ["type_notulen"]
 
+def stage_notulen(folder_path: Path, for_vve: bool, agenda: dict, splitsing: dict) -> dict:
+    """Genereer de notulen per agendapunt."""
+    with open(folder_path / splitsing["splits_path"] / "transcript gesplitst.json", "r") as f:
+        transcript_gesplitst_dict = json.load(f)
     notulen_output_path = genereer_notulen(
-        input_folder, transcript_gesplitst_dict, agenda_splitsing, type_notulen, for_vve
+        folder_path, transcript_gesplitst_dict, agenda["agenda_splitsing"], os.environ["type_notulen"], for_vve
     )
-    logger.info(f"Total time full_pipeline: {round((time()-start)/60,1)} min")
-    convert_stuff_to_docx_for_stakeholders(input_folder, splits_path, notulen_output_path)
+    return {"notulen_path": notulen_output_path.relative_to(folder_path).as_posix()}
+
+
+def stage_stakeholder_docs(folder_path: Path, splitsing: dict, notulen: dict) -> dict:
+    """Maak de .docx bestanden voor de stakeholders, tegelijk met het versturen van de e-mail."""
+    convert_stuff_to_docx_for_stakeholders(
+        folder_path, folder_path / splitsing["splits_path"], folder_path / notulen["notulen_path"]
+    )
+    return {}
 
-    email = os.environ["email"]
 
-    send_notulen_to_email(output_folder=input_folder, email=email)
+def stage_email(folder_path: Path, email: str, notulen: dict) -> dict:
+    """Verstuur de notulen. Een mislukte e-mail is een fout, zodat de stage bij een rerun opnieuw wordt gedaan."""
+    response = send_notulen_to_email(folder_path / notulen["notulen_path"] / "notulen.docx", email)
+    if not response["success"]:
+        raise RuntimeError(f"Sending the notulen by email failed: {response.get('error')}")
+    return {"status_code": response["status_code"]}
 
 
-def send_notulen_to_email(output_folder: Path, email: str):
+def send_notulen_to_email(notulen_docx: Path, email: str) -> Dict:
     """Sends the notulen.docx to the specified email address."""
 
     token = get_token()
     timestamp = os.environ.get("timestamp")
     timestamp_formatted = datetime.strptime(timestamp, "%Y-%m-%d_%H%M%S").strftime("%d-%m-%Y %H:%M:%S")
 
-    filepath = output_folder / "result" / "notulen.docx"
-
-    send_mail(
+    return send_mail(
         to_email=email,
         email_subject=f"Alliantie AI - Gegenereerde notulen - {timestamp_formatted}",
         email_body=f"Hierbij ontvang je de conceptnotulen van de vergadering die je op {timestamp_formatted} instuurde via Alliantie AI. Vragen of opmerkingen? Stuur ons een berichtje via dcc@de-alliantie.nl.",  # noqa: E501
         token=token,
-        attachments=[{"Name": f"notulen_{timestamp}.docx", "file_path": str(filepath)}],
+        attachments=[{"Name": f"notulen_{timestamp}.docx", "file_path": str(notulen_docx)}],
     )
 
 
@@ -214,34 +358,457 @@ def send_mail(
 
 
 def get_gpt_split(folder_path: Path, agenda_splitsing: dict, for_vve: bool) -> tuple[dict, Path]:
-    """Splits het transcript en verbind stukjes van het transcript met agendapuntnummers."""
-    # splits agendapuntnummers in groepjes, want in 1x prompten gaat niet goed
-    agendapuntnummers = list(agenda_splitsing.keys())
+    """Splits het transcript en verbind stukjes van het transcript met agendapuntnummers.
+
+    Als dezelfde splitsing al eerder is gemaakt (zelfde transcript, agenda, prompts, deployment en instellingen), dan
+    komt die uit de result cache, zie utils/result_cache.py. De splitsing komt in de cache onder de deployment die hem
+    echt heeft gemaakt: ook met llm_execution_mode "batch" kan (een deel van) de splitsing real-time gaan.
+    """
     trial = new_trial_nr(folder_path / "splitsing")
     logger.info(f"Trial {trial} voor splitsing.")
     splits_path = folder_path / "splitsing" / trial
     splits_path.mkdir(exist_ok=True, parents=True)
+
+    split_prompt_templates = {
+        path.name: path.read_text() for path in sorted((Path(__file__).parent / "prompts").glob("prompt_splitsen*.md"))
+    }
+
+    def _cache_key(deployment: str) -> str:
+        return compute_result_cache_key(
+            "splitsing",
+            get_transcript(folder_path).text,
+            read_agenda(folder_path),
+            agenda_splitsing,
+            for_vve,
+            split_prompt_templates,
+            get_split_settings(),
+            deployment,
+            LLM_SAMPLING_PARAMETERS["splitsing"],
+        )
+
+    cached = fetch_cached_result(folder_path, "splitsing", _cache_key(get_llm_deployment_name()))
+    if cached is not None:
+        gpt_dict = cached["gpt_dict"]
+        (splits_path / "splitsing output LLM.txt").write_text(cached["llm_output"])
+        with open(splits_path / "interval_split_llm_output.json", "w") as json_file:
+            json.dump(gpt_dict, json_file, indent=4)
+        return gpt_dict, splits_path
+
+    gpt_dict, deployment = split_transcript(folder_path, agenda_splitsing, for_vve, splits_path)
+    missing = [nr for nr in agenda_splitsing if nr not in gpt_dict]
+    if missing:
+        # een mislukte of onvolledige splitsing niet cachen, dan wordt die bij een rerun opnieuw geprobeerd
+        logger.warning(f"Splitsing niet in de result cache: geen intervallen voor agendapunten {missing}")
+        return gpt_dict, splits_path
+    if deployment is None:
+        logger.warning("Splitsing niet in de result cache: deels met de Batch API en deels real-time gemaakt")
+        return gpt_dict, splits_path
+    llm_output_path = splits_path / "splitsing output LLM.txt"
+    llm_output = llm_output_path.read_text() if llm_output_path.exists() else ""
+    store_result_in_cache(
+        folder_path, "splitsing", _cache_key(deployment), {"gpt_dict": gpt_dict, "llm_output": llm_output}
+    )
+    return gpt_dict, splits_path
+
+
+def split_transcript(
+    folder_path: Path, agenda_splitsing: dict, for_vve: bool, splits_path: Path
+) -> tuple[dict, str | None]:
+    """Splits het transcript met de LLM (en eventueel de voorsegmentatie).
+
+    Zie SPLIT_STRATEGY in settings.py voor de manieren van splitsen. Geeft de splitsing en de deployment die hem heeft
+    gemaakt (None als dat deels de Batch API en deels real-time was).
+    """
+    agendapuntnummers = list(agenda_splitsing.keys())
     openai_client = init_openai_client()
-    agendapuntnummers_groups = create_agenda_groups(agendapuntnummers, groupsize=4)
-    gpt_dict = {}  # dit wordt de dict van de splitsing
-    subsplits = []
-    for agendapuntnummers_group in agendapuntnummers_groups:
-        prompt, _ = get_splitsing_prompt(folder_path, agendapuntnummers_group, for_vve)
-        split_by_llm = make_llm_call(
-            openai_client, prompt, reason="splitsen " + str(agendapuntnummers_group), notulen=False
+
+    split_strategy = os.environ.get("split_strategy", SPLIT_STRATEGY)
+    if split_strategy not in SPLIT_STRATEGIES:
+        raise ValueError(f"Unknown split_strategy '{split_strategy}', choose from {SPLIT_STRATEGIES}")
+    input_budget, output_budget = get_split_token_budgets()
+    prompt, _ = get_splitsing_prompt(folder_path, agendapuntnummers, for_vve, start_lines=True)
+    prompt_tokens = count_tokens(prompt)
+    logger.info(f"Splitsingsprompt: {prompt_tokens} tokens (budget {input_budget})")
+    if split_strategy == "windowed" or prompt_tokens > input_budget:
+        if prompt_tokens > input_budget:
+            logger.info("Transcript en agenda passen niet in 1 prompt, dus splitsen in vensters.")
+        if get_llm_execution_mode() == "batch":
+            logger.info("Splitsen in vensters gaat altijd real-time, ook met llm_execution_mode batch.")
+        gpt_dict = get_gpt_split_windowed(
+            openai_client, folder_path, agendapuntnummers, for_vve, splits_path, input_budget, output_budget
         )
-        subsplits.append(split_by_llm)
-        (splits_path / "splitsing output LLM.txt").write_text(
-            "\n\n".join("\n".join(f"{k}: {v}" for k, v in split_by_llm.items()) for split_by_llm in subsplits)
+        return gpt_dict, DEPLOYMENT_NAME
+
+    if get_llm_execution_mode() == "batch":
+        return get_gpt_split_batch(
+            openai_client, folder_path, agenda_splitsing, for_vve, splits_path, split_strategy, output_budget
+        )
+
+    if split_strategy == "start_lines":
+        if len(agendapuntnummers) * SPLIT_OUTPUT_TOKENS_PER_AGENDAPUNT["start_lines"] > output_budget:
+            logger.info("Startregels: te veel agendapunten voor het output budget, dus splitsen in groepjes.")
+        else:
+            gpt_dict, line_ranges = presegment_transcript(folder_path, agenda_splitsing, splits_path)
+            if gpt_dict:
+                return gpt_dict, DEPLOYMENT_NAME
+            if line_ranges:
+                prompt, _ = get_splitsing_prompt(
+                    folder_path, agendapuntnummers, for_vve, start_lines=True, line_ranges=line_ranges
+                )
+                logger.info(f"Splitsingsprompt na voorsegmentatie: {count_tokens(prompt)} tokens")
+            try:
+                gpt_dict = get_gpt_split_start_lines(
+                    openai_client, prompt, agendapuntnummers, splits_path, output_budget
+                )
+                if gpt_dict:
+                    return gpt_dict, DEPLOYMENT_NAME
+                logger.warning("Geen startregels gevonden, dus toch splitsen in groepjes.")
+            # httpx.TransportError: de verbinding bleef haperen, ook na de retries
+            except (LengthFinishReasonError, APIError, httpx.TransportError) as e:
+                logger.warning(f"Startregels mislukt ({type(e).__name__}: {e}), dus toch splitsen in groepjes.")
+    gpt_dict = get_gpt_split_grouped(openai_client, folder_path, agendapuntnummers, for_vve, splits_path, output_budget)
+    return gpt_dict, DEPLOYMENT_NAME
+
+
+def get_gpt_split_batch(
+    openai_client: OpenAI,
+    folder_path: Path,
+    agenda_splitsing: dict,
+    for_vve: bool,
+    splits_path: Path,
+    split_strategy: str,
+    max_tokens: int,
+) -> tuple[dict, str | None]:
+    """De splitsing van start_lines of grouped met de Batch API (llm_execution_mode "batch"), zie utils/batch_utils.py.
+
+    Dezelfde prompts als real-time, maar als 1 batch. Wat de batch niet oplevert wordt alsnog real-time gedaan: een
+    groepje waarvan de output is afgekapt in 2 helften, een mislukt request met een gewone call, mislukte of afgekapte
+    startregels in groepjes, en alles als de batch niet is voltooid (zie run_batch). Geeft de splitsing en de deployment
+    die hem heeft gemaakt, zoals split_transcript.
+    """
+    agendapuntnummers = list(agenda_splitsing)
+    batch_deployment = get_llm_deployment_name()
+    batch_client = get_batch_client(folder_path)
+    batch_folder = folder_path / "batch" / "splitsing"
+
+    if split_strategy == "start_lines":
+        if len(agendapuntnummers) * SPLIT_OUTPUT_TOKENS_PER_AGENDAPUNT["start_lines"] > max_tokens:
+            logger.info("Startregels: te veel agendapunten voor het output budget, dus splitsen in groepjes.")
+        else:
+            gpt_dict, line_ranges = presegment_transcript(folder_path, agenda_splitsing, splits_path)
+            if gpt_dict:
+                return gpt_dict, batch_deployment
+            prompt, _ = get_splitsing_prompt(
+                folder_path, agendapuntnummers, for_vve, start_lines=True, line_ranges=line_ranges
+            )
+            request = build_batch_request(
+                "startregels",
+                prompt,
+                notulen=False,
+                structured_output=StartregelsVanAgendapunten,
+                max_tokens=max_tokens,
+            )
+            results = run_batch(batch_client, [request], batch_folder / "startregels", reason="splitsing")
+            content, finish_reason = batch_result_content(results.get("startregels"))
+            if content is None or finish_reason == "length":
+                # zoals real-time (zie split_transcript): afgekapte structured output is geen geldige JSON
+                logger.warning(
+                    f"Batch request voor de startregels {'afgekapt' if finish_reason == 'length' else 'mislukt'}, "
+                    "dus real-time splitsen in groepjes."
+                )
+                gpt_dict = get_gpt_split_grouped(
+                    openai_client, folder_path, agendapuntnummers, for_vve, splits_path, max_tokens
+                )
+                return gpt_dict, DEPLOYMENT_NAME
+            split_by_llm = parse_batch_split(content, StartregelsVanAgendapunten)
+            (splits_path / "splitsing output LLM.txt").write_text(
+                "\n".join(f"{k}: {v}" for k, v in split_by_llm.items())
+            )
+            gpt_dict = {k: v for k, v in split_by_llm.items() if k in agendapuntnummers}
+            with open(splits_path / "interval_split_llm_output.json", "w") as json_file:
+                json.dump(gpt_dict, json_file, indent=4)
+            if gpt_dict:
+                return gpt_dict, batch_deployment
+            logger.warning("Geen startregels gevonden, dus toch splitsen in groepjes.")
+
+    agendapuntnummers_groups = plan_agenda_groups(
+        agendapuntnummers, SPLIT_OUTPUT_TOKENS_PER_AGENDAPUNT["grouped"], max_tokens
+    )
+    prompts = [get_splitsing_prompt(folder_path, group, for_vve)[0] for group in agendapuntnummers_groups]
+    batch_requests = [
+        build_batch_request(
+            f"groepje-{i}",
+            prompt,
+            notulen=False,
+            structured_output=AgendapuntenMetGevondenRegels,
+            max_tokens=max_tokens,
+        )
+        for i, prompt in enumerate(prompts)
+    ]
+    logger.info(f"Splitsen in {len(batch_requests)} groepjes, als 1 batch.")
+    results = run_batch(batch_client, batch_requests, batch_folder / "groepjes", reason="splitsing")
+    if not results:
+        logger.warning("De batch leverde niets op, dus alle groepjes real-time splitsen.")
+        gpt_dict = get_gpt_split_grouped(
+            openai_client, folder_path, agendapuntnummers, for_vve, splits_path, max_tokens
         )
+        return gpt_dict, DEPLOYMENT_NAME
 
-        update = {k: v for k, v in split_by_llm.items() if k in agendapuntnummers_group and k not in gpt_dict}
-        gpt_dict.update(update)
+    gpt_dict = {}
+    subsplits = []
+    realtime_groups = 0
+    # in agendavolgorde, zodat bij overlappende groepjes het eerste groepje wint (zoals in get_gpt_split_grouped)
+    for request, prompt, group in zip(batch_requests, prompts, agendapuntnummers_groups):
+        content, finish_reason = batch_result_content(results.get(request["custom_id"]))
+        if finish_reason == "length":
+            realtime_groups += 1
+            split_by_llm = get_gpt_split_in_halves(openai_client, folder_path, group, for_vve, max_tokens)
+        elif content is None:
+            realtime_groups += 1
+            logger.warning(f"Batch request voor {group} mislukt, dus real-time splitsen.")
+            split_by_llm = make_rate_limited_llm_call(
+                openai_client,
+                prompt,
+                reason="splitsen " + str(group),
+                notulen=False,
+                max_tokens=max_tokens,
+            )
+        else:
+            split_by_llm = parse_batch_split(content, AgendapuntenMetGevondenRegels)
+        subsplits.append(split_by_llm)
+        gpt_dict.update({k: v for k, v in split_by_llm.items() if k in group and k not in gpt_dict})
+
+    (splits_path / "splitsing output LLM.txt").write_text(
+        "\n\n".join("\n".join(f"{k}: {v}" for k, v in split_by_llm.items()) for split_by_llm in subsplits)
+    )
+    with open(splits_path / "interval_split_llm_output.json", "w") as json_file:
+        json.dump(gpt_dict, json_file, indent=4)
+    if realtime_groups == 0:
+        return gpt_dict, batch_deployment
+    return gpt_dict, DEPLOYMENT_NAME if realtime_groups == len(batch_requests) else None
+
+
+def parse_batch_split(
+    content: str | None, structured_output: type[AgendapuntenMetGevondenRegels | StartregelsVanAgendapunten]
+) -> dict:
+    """Zet de structured output van een batch request om in de dict van de splitsing (zoals make_llm_call)."""
+    if content is None:
+        return {}
+    extracted_data = structured_output.model_validate_json(content)
+    if len(extracted_data.result) == 0:
+        logger.error("Could parse output but got an empty list. So none of agendapunten detected.")
+        return {}
+    return extracted_data.to_splitsing()
+
+
+def presegment_transcript(
+    folder_path: Path, agenda_splitsing: dict, splits_path: Path
+) -> tuple[dict | None, list[tuple[int, int]] | None]:
+    """Schat lokaal (zonder LLM) de startregels van de agendapunten, zie utils/retrieval_utils.py en PRESEGMENT.
 
+    Geeft de dict van de splitsing als de LLM overgeslagen kan worden, en anders de regels waarin de LLM naar de
+    startregels moet zoeken (None: het hele transcript).
+    """
+    presegment_mode = os.environ.get("presegment", PRESEGMENT)
+    if presegment_mode not in PRESEGMENT_MODES:
+        raise ValueError(f"Unknown presegment '{presegment_mode}', choose from {PRESEGMENT_MODES}")
+    if presegment_mode == "off":
+        return None, None
+
+    transcript = get_transcript(folder_path)
+    agendapuntnummers = list(agenda_splitsing)
+    presegmentation = presegment(transcript.lines, agenda_splitsing)
+    (splits_path / "voorsegmentatie.json").write_text(json.dumps(presegmentation, indent=4))
+
+    confident = [
+        nr for nr in agendapuntnummers if presegmentation.get(nr, {}).get("confidence", 0) >= PRESEGMENT_CONFIDENCE
+    ]
+    logger.info(f"Voorsegmentatie: {len(confident)} van {len(agendapuntnummers)} agendapunten met voldoende zekerheid")
+    if presegment_mode == "skip_llm" and len(confident) == len(agendapuntnummers):
+        logger.info("Voorsegmentatie is zeker genoeg, dus splitsen zonder LLM.")
+        gpt_dict = {nr: [(presegmentation[nr]["start"], presegmentation[nr]["start"])] for nr in agendapuntnummers}
+        (splits_path / "splitsing output LLM.txt").write_text(
+            "Gesplitst zonder LLM (voorsegmentatie)\n\n" + "\n".join(f"{k}: {v}" for k, v in presegmentation.items())
+        )
         with open(splits_path / "interval_split_llm_output.json", "w") as json_file:
             json.dump(gpt_dict, json_file, indent=4)
+        return gpt_dict, None
 
-    return gpt_dict, splits_path
+    line_ranges = candidate_line_ranges(presegmentation, agendapuntnummers, len(transcript))
+    kept_lines = sum(end - start + 1 for start, end in line_ranges)
+    if kept_lines > (1 - PRESEGMENT_MIN_SAVING) * len(transcript):
+        return None, None
+    logger.info(f"Voorsegmentatie: {kept_lines} van {len(transcript)} regels naar de LLM")
+    return None, line_ranges
+
+
+def get_gpt_split_start_lines(
+    openai_client: OpenAI, prompt: str, agendapuntnummers: list, splits_path: Path, max_tokens: int
+) -> dict:
+    """Vraag in 1 keer de startregel van elk agendapunt.
+
+    Het transcript wordt dus maar 1 keer meegestuurd. Het resultaat heeft het formaat dat apply_gpt_split verwacht,
+    met per agendapunt het interval (startregel, startregel). apply_gpt_split laat het agendapunt doorlopen tot het
+    volgende agendapunt.
+    """
+    split_by_llm = make_rate_limited_llm_call(
+        openai_client,
+        prompt,
+        reason="startregels " + str(agendapuntnummers),
+        notulen=False,
+        structured_output=StartregelsVanAgendapunten,
+        max_tokens=max_tokens,
+    )
+    (splits_path / "splitsing output LLM.txt").write_text("\n".join(f"{k}: {v}" for k, v in split_by_llm.items()))
+    gpt_dict = {k: v for k, v in split_by_llm.items() if k in agendapuntnummers}
+    with open(splits_path / "interval_split_llm_output.json", "w") as json_file:
+        json.dump(gpt_dict, json_file, indent=4)
+    return gpt_dict
+
+
+def get_gpt_split_grouped(
+    openai_client: OpenAI,
+    folder_path: Path,
+    agendapuntnummers: list,
+    for_vve: bool,
+    splits_path: Path,
+    max_tokens: int,
+) -> dict:
+    """Vraag per groepje agendapunten alle relevante intervallen van regelnummers.
+
+    De groepjes zijn zo groot dat de verwachte output binnen max_tokens past (zie plan_agenda_groups).
+    """
+    agendapuntnummers_groups = plan_agenda_groups(
+        agendapuntnummers, SPLIT_OUTPUT_TOKENS_PER_AGENDAPUNT["grouped"], max_tokens
+    )
+    prompts = [get_splitsing_prompt(folder_path, group, for_vve)[0] for group in agendapuntnummers_groups]
+    concurrency = int(os.environ.get("split_concurrency", SPLIT_CONCURRENCY))
+    logger.info(f"Splitsen in {len(prompts)} groepjes, {concurrency} tegelijk.")
+
+    gpt_dict = {}  # dit wordt de dict van de splitsing
+    subsplits = []
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = [
+            executor.submit(
+                make_rate_limited_llm_call,
+                openai_client,
+                prompt,
+                reason="splitsen " + str(group),
+                notulen=False,
+                max_tokens=max_tokens,
+            )
+            for prompt, group in zip(prompts, agendapuntnummers_groups)
+        ]
+        # de resultaten in agendavolgorde verwerken, zodat bij overlappende groepjes het eerste groepje wint
+        for agendapuntnummers_group, future in zip(agendapuntnummers_groups, futures):
+            try:
+                split_by_llm = future.result()
+            except LengthFinishReasonError:
+                split_by_llm = get_gpt_split_in_halves(
+                    openai_client, folder_path, agendapuntnummers_group, for_vve, max_tokens
+                )
+            subsplits.append(split_by_llm)
+            (splits_path / "splitsing output LLM.txt").write_text(
+                "\n\n".join("\n".join(f"{k}: {v}" for k, v in split_by_llm.items()) for split_by_llm in subsplits)
+            )
+
+            update = {k: v for k, v in split_by_llm.items() if k in agendapuntnummers_group and k not in gpt_dict}
+            gpt_dict.update(update)
+
+            with open(splits_path / "interval_split_llm_output.json", "w") as json_file:
+                json.dump(gpt_dict, json_file, indent=4)
+
+    return gpt_dict
+
+
+def get_gpt_split_windowed(
+    openai_client: OpenAI,
+    folder_path: Path,
+    agendapuntnummers: list,
+    for_vve: bool,
+    splits_path: Path,
+    input_budget: int,
+    max_tokens: int,
+) -> dict:
+    """Vraag de intervallen per agendapunt per venster van regels van het transcript, en voeg die samen.
+
+    Voor vergaderingen die niet in 1 prompt passen. De vensters overlappen en worden tegelijk verwerkt, dus met kleinere
+    vensters (split_window_tokens) is dit ook sneller dan 1 grote prompt.
+    """
+    # tokens van de prompt zonder het transcript: de agenda en de instructies
+    prompt_overhead = count_tokens(
+        get_splitsing_prompt(folder_path, agendapuntnummers, for_vve, line_ranges=[(1, 1)])[0]
+    )
+    window_tokens = min(int(os.environ.get("split_window_tokens", SPLIT_WINDOW_TOKENS)), input_budget - prompt_overhead)
+    windows = plan_transcript_windows(
+        get_transcript(folder_path).line_tokens, window_tokens, SPLIT_WINDOW_OVERLAP_LINES
+    )
+    agendapuntnummers_groups = plan_agenda_groups(
+        agendapuntnummers, SPLIT_OUTPUT_TOKENS_PER_AGENDAPUNT["grouped"], max_tokens
+    )
+    calls = [(window, group) for window in windows for group in agendapuntnummers_groups]
+    prompts = [get_splitsing_prompt(folder_path, group, for_vve, line_ranges=[window])[0] for window, group in calls]
+    concurrency = int(os.environ.get("split_concurrency", SPLIT_CONCURRENCY))
+    logger.info(
+        f"Splitsen in {len(windows)} vensters x {len(agendapuntnummers_groups)} groepjes, {concurrency} tegelijk."
+    )
+
+    window_splits = []
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = [
+            executor.submit(
+                make_rate_limited_llm_call,
+                openai_client,
+                prompt,
+                reason=f"splitsen venster {window} {group}",
+                notulen=False,
+                max_tokens=max_tokens,
+            )
+            for prompt, (window, group) in zip(prompts, calls)
+        ]
+        for (window, group), future in zip(calls, futures):
+            try:
+                split_by_llm = future.result()
+            except LengthFinishReasonError:
+                split_by_llm = get_gpt_split_in_halves(openai_client, folder_path, group, for_vve, max_tokens, window)
+            window_splits.append((window, {k: v for k, v in split_by_llm.items() if k in group}))
+            (splits_path / "splitsing output LLM.txt").write_text(
+                "\n\n".join(
+                    f"Regels {w[0]}-{w[1]}\n" + "\n".join(f"{k}: {v}" for k, v in split.items())
+                    for w, split in window_splits
+                )
+            )
+
+    gpt_dict = merge_window_splits(window_splits, agendapuntnummers)
+    with open(splits_path / "interval_split_llm_output.json", "w") as json_file:
+        json.dump(gpt_dict, json_file, indent=4)
+    return gpt_dict
+
+
+def get_gpt_split_in_halves(
+    openai_client: OpenAI,
+    folder_path: Path,
+    agendapuntnummers_group: list,
+    for_vve: bool,
+    max_tokens: int,
+    window: tuple[int, int] | None = None,
+) -> dict:
+    """Splits een groepje waarvan de output niet in max_tokens paste opnieuw, in 2 helften (en zo nodig verder)."""
+    if len(agendapuntnummers_group) == 1:
+        raise ValueError(f"Output van de splitsing van agendapunt {agendapuntnummers_group} past niet in {max_tokens}")
+    logger.warning(f"Output afgekapt voor {agendapuntnummers_group}, opnieuw in 2 helften.")
+    split_by_llm = {}
+    half = len(agendapuntnummers_group) // 2
+    for group in [agendapuntnummers_group[:half], agendapuntnummers_group[half:]]:
+        prompt, _ = get_splitsing_prompt(folder_path, group, for_vve, line_ranges=[window] if window else None)
+        try:
+            split = make_rate_limited_llm_call(
+                openai_client, prompt, reason="splitsen " + str(group), notulen=False, max_tokens=max_tokens
+            )
+        except LengthFinishReasonError:
+            split = get_gpt_split_in_halves(openai_client, folder_path, group, for_vve, max_tokens, window)
+        split_by_llm.update({k: v for k, v in split.items() if k in group})
+    return split_by_llm
 
 
 def genereer_notulen(
@@ -249,7 +816,7 @@ def genereer_notulen(
 ) -> Path:
     """Generate the meeting notes # TODO: als transcript en agendasplitsing niet dezelfe keys hebben, dan raise
     error."""
-    trial = new_trial_nr(folder_path / "output_notulen") if NOTUL_TRIAL is None else str(NOTUL_TRIAL)
+    trial = new_trial_nr(folder_path / "output_notulen")
     logger.info(f"Trial {trial} voor notulen genereren.")
     output_path = folder_path / "output_notulen" / trial
     output_path.mkdir(exist_ok=True, parents=True)
@@ -271,40 +838,164 @@ def genereer_notulen(
     (output_path / "prompt template notulen.txt").write_text(prompt_template)
 
     if for_vve:
-        output_md = f"# VvE {os.environ.get('vve_number','')}\n\n"
+        header_md = f"# VvE {os.environ.get('vve_number','')}\n\n"
     else:
-        output_md = "# Notulen\n\n"
-    for agendapunt_nr, content in agenda_splitsing.items():
-        prev_generated = output_path / f"{trial} nr {agendapunt_nr}.md"  # previously/already generated
-        if prev_generated.exists():
-            output = prev_generated.read_text()
-            logger.info(f"Read already generated: {agendapunt_nr}")
-        elif agendapunt_nr in transcript_gesplitst_dict:
-            stukje_transcript = transcript_gesplitst_dict[agendapunt_nr]
-            output = genereer_notulen_stukje(
-                folder_path, content, agendapunt_nr, stukje_transcript, prompt_template, trial
+        header_md = "# Notulen\n\n"
+    (output_path / "notulen.md").write_text(header_md)
+    progress = NotulenProgress(folder_path, output_path, list(agenda_splitsing))
+    if get_llm_execution_mode() == "batch":
+        outputs = genereer_notulen_batch(
+            folder_path, agenda_splitsing, transcript_gesplitst_dict, prompt_template, trial, progress
+        )
+        append_to_notulen(output_path, trial, agenda_splitsing, outputs.get)
+    else:
+        openai_client = init_openai_client()
+        concurrency = int(os.environ.get("notulen_concurrency", NOTULEN_CONCURRENCY))
+        streaming = os.environ.get("notulen_streaming", str(NOTULEN_STREAMING)) == "True"
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            futures = {}
+            for agendapunt_nr, content in agenda_splitsing.items():
+                if agendapunt_nr not in transcript_gesplitst_dict:
+                    progress.item_done(agendapunt_nr)
+                    continue
+                futures[agendapunt_nr] = executor.submit(
+                    genereer_notulen_stukje,
+                    folder_path,
+                    content,
+                    agendapunt_nr,
+                    transcript_gesplitst_dict[agendapunt_nr],
+                    prompt_template,
+                    trial,
+                    openai_client,
+                    partial(progress.on_token, agendapunt_nr) if streaming else None,
+                    partial(progress.restart, agendapunt_nr),
+                )
+                futures[agendapunt_nr].add_done_callback(
+                    lambda future, nr=agendapunt_nr: progress.item_done(nr) if future.exception() is None else None
+                )
+            # alle agendapunten worden tegelijk gegenereerd, maar notulen.md wordt in agendavolgorde opgebouwd
+            append_to_notulen(
+                output_path, trial, agenda_splitsing, lambda nr: futures[nr].result() if nr in futures else None
             )
+    progress.finished()
+    convert_to_docx(output_path / "notulen.md")
+    return output_path
+
+
+def append_to_notulen(
+    output_path: Path, trial: str, agenda_splitsing: dict, get_output: Callable[[str], str | None]
+) -> None:
+    """Voeg de agendapunten in agendavolgorde toe aan notulen.md, zodra get_output de output van het agendapunt geeft.
+
+    Elk agendapunt wordt achteraan toegevoegd (een goedkoop tussenresultaat), de .docx wordt pas aan het eind gemaakt.
+    get_output geeft None voor een agendapunt dat niet in het transcript is gevonden.
+    """
+    for agendapunt_nr, content in agenda_splitsing.items():
+        output = get_output(agendapunt_nr)
+        if output is not None:
             (output_path / f"{trial} nr {agendapunt_nr}.md").write_text(output)
             logger.info(f"Generated: agendapunt {agendapunt_nr}")
         else:
             output = f"Agendapunt {agendapunt_nr} niet als agendapunt gedetecteerd in transcript."
             logger.warning(output)
-        output_md += f"## {content['titel']}\n\n{output}\n\n"
-        (output_path / "notulen.md").write_text(output_md)
-        convert_to_docx(output_path / "notulen.md")
-    return output_path
+        with open(output_path / "notulen.md", "a") as f:
+            f.write(f"## {content['titel']}\n\n{output}\n\n")
 
 
-def genereer_notulen_stukje(
+def genereer_notulen_batch(
+    folder_path: Path,
+    agenda_splitsing: dict,
+    transcript_gesplitst_dict: dict,
+    prompt_template: str,
+    trial: str,
+    progress: NotulenProgress,
+) -> dict:
+    """Genereer de notulen van alle agendapunten met 1 batch van de Batch API (llm_execution_mode "batch").
+
+    Agendapunten uit de result cache gaan niet mee in de batch. De agendapunten waarvoor het batch request is mislukt
+    (alle agendapunten als de batch niet is voltooid, zie run_batch) worden alsnog real-time gegenereerd, tegelijk zoals
+    in genereer_notulen. Geeft de output per agendapuntnummer.
+    """
+    outputs, cache_keys, batch_requests = {}, {}, []
+    for agendapunt_nr, content in agenda_splitsing.items():
+        if agendapunt_nr not in transcript_gesplitst_dict:
+            progress.item_done(agendapunt_nr)
+            continue
+        prompt, cache_key = prepare_notulen_stukje(
+            folder_path,
+            content,
+            agendapunt_nr,
+            transcript_gesplitst_dict[agendapunt_nr],
+            prompt_template,
+            trial,
+            get_llm_deployment_name(),
+        )
+        cached = fetch_cached_result(folder_path, "notulen", cache_key)
+        if cached is not None:
+            outputs[agendapunt_nr] = cached["output"]
+            progress.item_done(agendapunt_nr)
+            continue
+        cache_keys[agendapunt_nr] = cache_key
+        batch_requests.append(build_batch_request(f"notulen-{agendapunt_nr}", prompt, notulen=True))
+    if not batch_requests:
+        return outputs
+
+    logger.info(f"Notulen van {len(batch_requests)} agendapunten als 1 batch.")
+    results = run_batch(
+        get_batch_client(folder_path), batch_requests, folder_path / "batch" / "notulen", reason="notulen"
+    )
+    failed = []
+    for agendapunt_nr, cache_key in cache_keys.items():
+        content, finish_reason = batch_result_content(results.get(f"notulen-{agendapunt_nr}"))
+        if finish_reason == "content_filter":
+            logger.error("Azure OpenAI content filter triggered")
+            outputs[agendapunt_nr] = process_llm_output(CONTENT_FILTER_MESSAGE)
+        elif content is None:
+            failed.append(agendapunt_nr)
+            continue
+        else:
+            outputs[agendapunt_nr] = process_llm_output(content)
+            store_result_in_cache(folder_path, "notulen", cache_key, {"output": outputs[agendapunt_nr]})
+        progress.item_done(agendapunt_nr)
+    if not failed:
+        return outputs
+
+    logger.warning(f"Batch requests voor agendapunten {failed} mislukt, dus real-time genereren.")
+    openai_client = init_openai_client()
+    concurrency = int(os.environ.get("notulen_concurrency", NOTULEN_CONCURRENCY))
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = {
+            agendapunt_nr: executor.submit(
+                genereer_notulen_stukje,
+                folder_path,
+                agenda_splitsing[agendapunt_nr],
+                agendapunt_nr,
+                transcript_gesplitst_dict[agendapunt_nr],
+                prompt_template,
+                trial,
+                openai_client,
+            )
+            for agendapunt_nr in failed
+        }
+        for agendapunt_nr, future in futures.items():
+            outputs[agendapunt_nr] = future.result()
+            progress.item_done(agendapunt_nr)
+    return outputs
+
+
+def prepare_notulen_stukje(
     folder_path: Path,
     agenda_content: dict,
     agendapunt_nr: str,
     stukje_transcript: str,
     prompt_template: str,
     trial: str,
-) -> str:
-    """Generates a part of the notes."""
-    openai_client = init_openai_client()
+    deployment: str,
+) -> tuple[str, str]:
+    """Maak de prompt voor een stukje van de notulen (en schrijf die weg), en geef de prompt en de key in de cache.
+
+    deployment is de deployment die het stukje maakt: de Batch API of real-time (ook als terugval in een batch job).
+    """
     agenda_str = f"**{agenda_content['titel']}**\n\n{agenda_content['body']}"
     prompt = prompt_template.format(
         agendapunt=agenda_str,
@@ -312,8 +1003,44 @@ def genereer_notulen_stukje(
     )
     (folder_path / "output_notulen" / trial).mkdir(exist_ok=True)
     (folder_path / "output_notulen" / trial / f"{trial} prompt {agendapunt_nr}.txt").write_text(prompt)
-    output = make_llm_call(openai_client, prompt, reason=f"stukje notulen, nr {agendapunt_nr}", notulen=True)
+    cache_key = compute_result_cache_key("notulen", prompt, deployment, LLM_SAMPLING_PARAMETERS["notulen"])
+    return prompt, cache_key
+
+
+def genereer_notulen_stukje(
+    folder_path: Path,
+    agenda_content: dict,
+    agendapunt_nr: str,
+    stukje_transcript: str,
+    prompt_template: str,
+    trial: str,
+    openai_client: OpenAI | None = None,
+    on_token: Callable[[str], None] | None = None,
+    on_retry: Callable[[], None] | None = None,
+) -> str:
+    """Generates a part of the notes, or takes it from the result cache if the same prompt was done before.
+
+    With on_token, the output is streamed and on_token gets every piece of text as soon as it arrives. on_retry is
+    called when the call is retried (after an error halfway the stream, for example).
+    """
+    prompt, cache_key = prepare_notulen_stukje(
+        folder_path, agenda_content, agendapunt_nr, stukje_transcript, prompt_template, trial, DEPLOYMENT_NAME
+    )
+    cached = fetch_cached_result(folder_path, "notulen", cache_key)
+    if cached is not None:
+        return cached["output"]
+    openai_client = openai_client or init_openai_client()
+    output = make_rate_limited_llm_call(
+        openai_client,
+        prompt,
+        reason=f"stukje notulen, nr {agendapunt_nr}",
+        notulen=True,
+        on_token=on_token,
+        on_retry=on_retry,
+    )
     output_processed = process_llm_output(output)
+    if output != CONTENT_FILTER_MESSAGE:
+        store_result_in_cache(folder_path, "notulen", cache_key, {"output": output_processed})
     return output_processed
 
 
@@ -3,5 +3,255 @@ import os
 OTAP = os.environ.get("OTAP", "local")
 
 SUPPORTED_MEDIA_FILES = ["mp3", "wav", "mpeg", "m4a", "mp4", "webm", "mpga"]
+# for these recordings the audio is first extracted on a CPU node, so the GPU node does not read the whole video
+VIDEO_MEDIA_FILES = ["mp4", "webm"]
 DATALAKE_BASE_FOLDER = "alliantie_notulen"
+# transcripts of earlier recordings, stored by hash of the audio + transcription settings (same 7-day retention)
+TRANSCRIPT_CACHE_FOLDER = f"{DATALAKE_BASE_FOLDER}_cache/transcripts"
+# results of the splitting and the notulen per agendapunt, stored by hash of their inputs (see utils/result_cache.py)
+RESULT_CACHE_FOLDER = f"{DATALAKE_BASE_FOLDER}_cache/results"
 DEPLOYMENT_NAME = "gpt-4o-notulen"
+# sampling parameters of the LLM calls (also part of the key of the result cache)
+LLM_SAMPLING_PARAMETERS = {"notulen": {"temperature": 0.01}, "splitsing": {}}
+# How the transcript is split per agendapunt (environment variable split_strategy):
+# "start_lines" asks once for the start line of every agendapunt, with the whole transcript and agenda in 1 prompt.
+# "grouped" asks for all relevant line intervals per group of agendapunten, so the transcript is sent once per group.
+# "windowed" asks for the line intervals per window of transcript lines (the windows overlap and run concurrently).
+# "start_lines" falls back to "grouped" when the agenda does not fit in the output budget below or the call fails.
+# When the transcript does not fit in the input budget, "windowed" is always used.
+SPLIT_STRATEGIES = ["start_lines", "grouped", "windowed"]
+SPLIT_STRATEGY = "start_lines"
+# Budgets per split call, counted locally with the tokenizer of the model of the deployment (gpt-4o: o200k_base).
+# The context window of gpt-4o is 128k tokens; the input budget leaves room for the output and a margin. The number of
+# agendapunten per call is chosen so that the expected output fits in the output budget (which is also the max_tokens
+# of the call), so the structured output is not truncated. Environment variables: split_input_token_budget and
+# split_output_token_budget.
+LLM_TOKEN_ENCODING = "o200k_base"
+SPLIT_INPUT_TOKEN_BUDGET = 110_000
+SPLIT_OUTPUT_TOKEN_BUDGET = 4_000
+# maximum tokens of transcript per window (environment variable split_window_tokens), and the overlap of the windows
+SPLIT_WINDOW_TOKENS = 40_000
+SPLIT_WINDOW_OVERLAP_LINES = 30
+# expected output tokens per agendapunt in the structured output of each strategy
+SPLIT_OUTPUT_TOKENS_PER_AGENDAPUNT = {"start_lines": 30, "grouped": 400}
+# Local pre-segmentation (utils/retrieval_utils.py, environment variable presegment): before the start_lines split, BM25
+# scores windows of PRESEGMENT_WINDOW_LINES lines against the agendapunten to guess their start lines.
+# "narrow" sends only the lines around the guessed start lines to the LLM (for guesses with a confidence below
+# PRESEGMENT_CONFIDENCE: everything between the neighbouring confident guesses). "skip_llm" uses the guesses without
+# LLM when all agendapunten are confident. "off" sends the whole transcript. Off by default: a wrong guess silently
+# leaves relevant lines out, so only turn it on after PRESEGMENT_CONFIDENCE is checked against labelled splits.
+PRESEGMENT_MODES = ["off", "narrow", "skip_llm"]
+PRESEGMENT = "off"
+PRESEGMENT_WINDOW_LINES = 20
+PRESEGMENT_STRIDE_LINES = 5
+PRESEGMENT_MARGIN_LINES = 40
+PRESEGMENT_CONFIDENCE = 1.0
+# only narrow when the candidate ranges leave out at least this fraction of the transcript
+PRESEGMENT_MIN_SAVING = 0.2
+# the split calls (groups, windows) are independent, this many are sent at the same time
+# (environment variable split_concurrency, 1 is sequential)
+SPLIT_CONCURRENCY = 4
+# the notulen of the agendapunten are generated concurrently too (environment variable notulen_concurrency)
+NOTULEN_CONCURRENCY = 8
+# stream the notulen per agendapunt (environment variable notulen_streaming), so that the partial output and the
+# progress (PROGRESS_FILENAME in the job folder, at most one update per PROGRESS_EVENT_SECONDS) are visible meanwhile
+NOTULEN_STREAMING = True
+PROGRESS_FILENAME = "progress.jsonl"
+PROGRESS_EVENT_SECONDS = 2.0
+# Limits of the deployment in Azure OpenAI (environment variables llm_tokens_per_minute and llm_requests_per_minute).
+# All calls share a token bucket for each, and back off when the API still returns a 429.
+LLM_TOKENS_PER_MINUTE = 150_000
+LLM_REQUESTS_PER_MINUTE = 900
+LLM_MAX_RETRIES = 6
+# Resilience of the LLM calls: 429s, 5xx errors, timeouts and broken connections are retried (at most LLM_MAX_RETRIES
+# times) after the Retry-After of the API or else a jittered exponential backoff, between LLM_BACKOFF_BASE_SECONDS and
+# LLM_BACKOFF_MAX_SECONDS. Every attempt has a time limit per stage (for a streamed answer the whole stream, otherwise
+# the wait for the answer), and the call with all its retries a deadline.
+LLM_BACKOFF_BASE_SECONDS = 1.0
+LLM_BACKOFF_MAX_SECONDS = 60.0
+LLM_CALL_TIMEOUT_SECONDS = {"splitsing": 300.0, "notulen": 180.0}
+LLM_CALL_DEADLINE_SECONDS = 900.0
+# A split call that has no answer after this many seconds gets a hedged duplicate, the first answer wins (environment
+# variable llm_hedge_split_after, 0 is off). This cuts the tail latency of rare stalls, at the cost of a duplicate call.
+LLM_HEDGE_SPLIT_AFTER_SECONDS = 0
+# expected number of output tokens of a notulen call (a split call is estimated at half of this)
+LLM_OUTPUT_TOKEN_ESTIMATE = 1500
+# Every LLM call is recorded in the call ledger (utils/llm_ledger.py): a line in LLM_LEDGER_FILENAME in the job folder,
+# a summary in LLM_LEDGER_SUMMARY_FILENAME and metrics in Application Insights. Prices in USD per million tokens of the
+# model of each deployment, for the cost per call.
+LLM_LEDGER_FILENAME = "llm_calls.jsonl"
+LLM_LEDGER_SUMMARY_FILENAME = "llm_calls_summary.json"
+LLM_PRICES_PER_MILLION_TOKENS = {
+    "gpt-4o-notulen": {"prompt": 2.50, "completion": 10.00},
+    "gpt-4o-notulen-batch": {"prompt": 1.25, "completion": 5.00},
+}
+# The splitting and the notulen are done with real-time chat completions, or (environment variable llm_execution_mode
+# "batch") with the Batch API on the global batch deployment BATCH_DEPLOYMENT_NAME: half the price and outside the
+# real-time quota, but the results come within BATCH_COMPLETION_WINDOW instead of minutes. For jobs that are not urgent.
+# With llm_batch_service "local" the batches go to a local stand-in (see utils/batch_utils.py), to test without network.
+LLM_EXECUTION_MODES = ["realtime", "batch"]
+LLM_EXECUTION_MODE = "realtime"
+BATCH_DEPLOYMENT_NAME = "gpt-4o-notulen-batch"
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_POLL_SECONDS = 60
+# A batch that is not done after this many seconds (environment variable llm_batch_max_wait_seconds) is cancelled and
+# all its requests are done real-time, so a stuck batch does not hold the job and its node for the whole window.
+BATCH_MAX_WAIT_SECONDS = 4 * 60 * 60
+
+# Transcription engines: "gpu" decodes segment by segment with float16 on CUDA, "cpu_batched" uses the batched
+# inference pipeline of faster-whisper with int8 on CPU, so that cheap CPU nodes (and laptops) can transcribe too.
+TRANSCRIBE_ENGINES = ["gpu", "cpu_batched"]
+# Quality/speed profiles for the decoding, chosen per job. "accurate" is the original setup (large-v2, beam search and
+# the default VAD parameters of faster-whisper).
+# Values not in a profile (e.g. batch_size) come from the environment variables or their defaults.
+TRANSCRIBE_PROFILES = {
+    "fast": {
+        "model_size": "medium",
+        "compute_type": {"gpu": "int8_float16", "cpu_batched": "int8"},
+        "beam_size": 1,
+        "batch_size": 16,
+        "vad_threshold": 0.5,
+        "vad_min_silence_ms": 500,
+    },
+    "balanced": {
+        "model_size": "large-v2",
+        "compute_type": {"gpu": "float16", "cpu_batched": "int8"},
+        "beam_size": 1,
+        "batch_size": 8,
+        "vad_threshold": 0.5,
+        "vad_min_silence_ms": 1000,
+    },
+    "accurate": {
+        "model_size": "large-v2",
+        "compute_type": {"gpu": "float16", "cpu_batched": "int8"},
+        "beam_size": 5,
+        "batch_size": 8,
+        "vad_threshold": 0.5,
+        "vad_min_silence_ms": 2000,
+    },
+}
+DEFAULT_TRANSCRIBE_PROFILE = "accurate"
+# published snapshots of the Whisper models: WHISPER_MODEL_FOLDER/model_size/version (see whisper_model_utils.py)
+WHISPER_MODEL_FOLDER = f"{DATALAKE_BASE_FOLDER}_models/whisper"
+WHISPER_MODEL_VERSION = "v1"
+CPU_TRANSCRIBE_INSTANCE_TYPE = "Standard_DS4_v2"
+# Long recordings are split at silences into chunks of at most this length. Only one chunk at a time per worker is
+# converted to float32, so peak memory does not grow with the length of the recording. With more than 1 worker the
+# chunks are transcribed in parallel by multiple model workers.
+TRANSCRIBE_WORKERS = 1
+TRANSCRIBE_CHUNK_MINUTES = 10
+# With 1 worker the chunks of a recording are transcribed one after the other, and the last characters of the text of
+# the previous chunk are the initial prompt of the next one, so Whisper keeps the context over the chunk boundaries.
+# Parallel chunks (more than 1 worker) start without this context.
+TRANSCRIBE_PROMPT_CHARACTERS = 800
+# Before transcribing, silences longer than MIN_SILENCE_SECONDS can be cut out of the audio (keeping some padding around
+# the speech), because Whisper time scales with the duration of the audio. Off by default until the mapping of the
+# timestamps back to the original recording (to_original_seconds) is validated on real recordings.
+COMPACT_SILENCES = False
+MIN_SILENCE_SECONDS = 2.0
+SILENCE_PADDING_SECONDS = 0.5
+# the settings that influence the transcript, and thus are part of the key of the transcript cache
+TRANSCRIPT_CACHE_SETTINGS_KEYS = [
+    "engine",
+    "model_size",
+    "compute_type",
+    "batch_size",
+    "chunk_minutes",
+    "prompt_characters",
+    "language",
+    "beam_size",
+    "vad_filter",
+    "vad_threshold",
+    "vad_min_silence_ms",
+    "compact_silences",
+    "min_silence_seconds",
+    "silence_padding_seconds",
+]
+
+
+def get_transcribe_settings(engine: str | None = None, profile: str | None = None) -> dict:
+    """Read the transcription settings from the environment variables of the transcribe component.
+
+    The profile (environment variable transcribe_profile, see TRANSCRIBE_PROFILES) sets the model and the decoding
+    parameters. Environment variables that override the profile or set the rest: whisper_model_size,
+    whisper_batch_size, whisper_cpu_threads, transcribe_workers, transcribe_chunk_minutes, compact_silences and
+    min_silence_seconds. The engine (transcribe_engine) and profile can also be given directly, e.g. by run_pipeline.
+    """
+    engine = engine or os.environ.get("transcribe_engine", "gpu")
+    if engine not in TRANSCRIBE_ENGINES:
+        raise ValueError(f"Unknown transcribe_engine '{engine}', choose from {TRANSCRIBE_ENGINES}")
+    profile = profile or os.environ.get("transcribe_profile", DEFAULT_TRANSCRIBE_PROFILE)
+    if profile not in TRANSCRIBE_PROFILES:
+        raise ValueError(f"Unknown transcribe_profile '{profile}', choose from {list(TRANSCRIBE_PROFILES)}")
+    profile_settings = TRANSCRIBE_PROFILES[profile]
+    chunk_minutes = float(os.environ.get("transcribe_chunk_minutes", TRANSCRIBE_CHUNK_MINUTES))
+    if chunk_minutes <= 0:
+        raise ValueError(f"transcribe_chunk_minutes must be positive, got {chunk_minutes}")
+    return {
+        "engine": engine,
+        "profile": profile,
+        "model_size": os.environ.get("whisper_model_size", profile_settings["model_size"]),
+        "device": "cuda" if engine == "gpu" else "cpu",
+        "compute_type": profile_settings["compute_type"][engine],
+        "batch_size": int(os.environ.get("whisper_batch_size", profile_settings["batch_size"])),
+        "cpu_threads": int(os.environ.get("whisper_cpu_threads", os.cpu_count() or 4)),
+        "workers": int(os.environ.get("transcribe_workers", TRANSCRIBE_WORKERS)),
+        "chunk_minutes": chunk_minutes,
+        "prompt_characters": TRANSCRIBE_PROMPT_CHARACTERS,
+        "compact_silences": os.environ.get("compact_silences", str(COMPACT_SILENCES)) == "True",
+        "min_silence_seconds": float(os.environ.get("min_silence_seconds", MIN_SILENCE_SECONDS)),
+        "silence_padding_seconds": SILENCE_PADDING_SECONDS,
+        "language": "nl",
+        "beam_size": profile_settings["beam_size"],
+        "vad_filter": True,
+        "vad_threshold": profile_settings["vad_threshold"],
+        "vad_min_silence_ms": profile_settings["vad_min_silence_ms"],
+    }
+
+
+def get_llm_rate_limits() -> tuple[int, int]:
+    """The tokens-per-minute and requests-per-minute limits of the deployment."""
+    return (
+        int(os.environ.get("llm_tokens_per_minute", LLM_TOKENS_PER_MINUTE)),
+        int(os.environ.get("llm_requests_per_minute", LLM_REQUESTS_PER_MINUTE)),
+    )
+
+
+def get_split_token_budgets() -> tuple[int, int]:
+    """The input and output token budgets of a split call."""
+    return (
+        int(os.environ.get("split_input_token_budget", SPLIT_INPUT_TOKEN_BUDGET)),
+        int(os.environ.get("split_output_token_budget", SPLIT_OUTPUT_TOKEN_BUDGET)),
+    )
+
+
+def get_split_settings() -> dict:
+    """All settings that influence the splitting of the transcript (part of the key of the result cache)."""
+    return {
+        "split_strategy": os.environ.get("split_strategy", SPLIT_STRATEGY),
+        "presegment": os.environ.get("presegment", PRESEGMENT),
+        "split_token_budgets": get_split_token_budgets(),
+        "split_window_tokens": int(os.environ.get("split_window_tokens", SPLIT_WINDOW_TOKENS)),
+        "split_window_overlap_lines": SPLIT_WINDOW_OVERLAP_LINES,
+        "split_output_tokens_per_agendapunt": SPLIT_OUTPUT_TOKENS_PER_AGENDAPUNT,
+        "presegment_parameters": [
+            PRESEGMENT_WINDOW_LINES,
+            PRESEGMENT_STRIDE_LINES,
+            PRESEGMENT_MARGIN_LINES,
+            PRESEGMENT_CONFIDENCE,
+            PRESEGMENT_MIN_SAVING,
+        ],
+    }
+
+
+def get_llm_hedge_split_after() -> float:
+    """Seconds after which a split call gets a hedged duplicate (0 is no hedging)."""
+    return float(os.environ.get("llm_hedge_split_after", LLM_HEDGE_SPLIT_AFTER_SECONDS))
+
+
+def get_llm_execution_mode() -> str:
+    """The execution mode of the LLM calls ("realtime" or "batch"), see LLM_EXECUTION_MODE."""
+    execution_mode = os.environ.get("llm_execution_mode", LLM_EXECUTION_MODE)
+    if execution_mode not in LLM_EXECUTION_MODES:
+        raise ValueError(f"Unknown llm_execution_mode '{execution_mode}', choose from {LLM_EXECUTION_MODES}")
+    return execution_mode
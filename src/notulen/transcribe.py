@@ -1,15 +1,38 @@
+import json
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Callable
 
 from azure.ai.ml import Input, Output
-from faster_whisper import WhisperModel
+from faster_whisper import BatchedInferencePipeline, WhisperModel
 
+from notulen.settings import TRANSCRIPT_CACHE_SETTINGS_KEYS, get_transcribe_settings
+from notulen.utils.audio_utils import (
+    SAMPLING_RATE,
+    compact_silences,
+    decode_to_pcm,
+    open_pcm,
+    pcm_to_float,
+    split_at_silences,
+    to_original_seconds,
+)
+from notulen.utils.whisper_model_utils import verify_model_artifact, warm_model
 from shared.my_logging import logger
 
 
-def transcribe(folder_path: Input(type="uri_folder"), output_folder: Output(type="uri_folder")) -> None:  # noqa F821
-    """Also able to transcribe multiple audio/video files into a single .txt file."""
+def transcribe(
+    folder_path: Input(type="uri_folder"),  # noqa F821
+    output_folder: Output(type="uri_folder"),  # noqa F821
+    model_folder: Input(type="uri_folder", optional=True) = None,  # noqa F821
+) -> None:
+    """Also able to transcribe multiple audio/video files into a single .txt file.
+
+    When model_folder is given (a published model snapshot, see whisper_model_utils.py), the model is loaded from there
+    instead of downloaded from the hub.
+    """
 
     input_path = Path(output_folder) / "input/opname"
     output_path = Path(output_folder) / "transcript.txt"
@@ -19,19 +42,51 @@ def transcribe(folder_path: Input(type="uri_folder"), output_folder: Output(type
         logger.info(f"{input_path.parent.parent.stem} already transcribed.")
         return
 
-    if not any(input_path.iterdir()):
-        raise Exception("No audio/video files found")
-    model = WhisperModel(
-        # model_size_or_path="/localwhispermodel_large_v2",
-        model_size_or_path="large-v2",
-        device="cuda",
-        compute_type="float16",
-        num_workers=1,
-        local_files_only=False,
+    settings = get_transcribe_settings()
+    logger.info(f"Transcription settings: {settings}")
+    model = load_whisper_model(settings, model_folder)
+    transcribe_folder(Path(output_folder), settings, model)
+
+
+def transcribe_folder(output_folder: Path, settings: dict, model: WhisperModel | BatchedInferencePipeline) -> None:
+    """Transcribe the recordings in output_folder/input/opname with a loaded model into output_folder/transcript.txt."""
+    start_time = time.time()
+    recordings = prepare_audio(output_folder, settings)
+    checkpoint = TranscriptCheckpoint(output_folder / "transcript_checkpoint", settings)
+    segments = transcribe_chunked(model, recordings, settings, checkpoint)
+    end_time = time.time()
+    logger.info(f"Transcription took {round((end_time-start_time)/60, 1)} minutes, {len(recordings)} file(s).")
+    with open(output_folder / "transcript.txt", "w") as f:
+        f.write("\n".join(segment["text"] for segment in segments))
+    # line i of the transcript (line i+1 in the numbered transcript) was said at these times in the original recording
+    (output_folder / "transcript_timestamps.json").write_text(
+        json.dumps([{k: segment[k] for k in ["file", "start", "end"]} for segment in segments], indent=1)
     )
-    model.logger = logger
-    result = []
+
+
+def extract_audio(folder_path: Input(type="uri_folder"), output_folder: Output(type="uri_folder")) -> None:  # noqa F821
+    """Extract the audio of the recordings on a (cheap) CPU node, before the transcribe node.
+
+    This writes the (compacted) 16 kHz PCM files that transcribe() reuses, so the GPU node reads only the audio and not
+    the complete (video) files.
+    """
+    if (Path(output_folder) / "transcript.txt").exists():
+        logger.info(f"{Path(output_folder).stem} already transcribed.")
+        return
     start_time = time.time()
+    prepare_audio(Path(output_folder), get_transcribe_settings())
+    logger.info(f"Audio extraction took {round((time.time()-start_time)/60, 1)} minutes.")
+
+
+def prepare_audio(output_folder: Path, settings: dict) -> list[tuple[Path, list]]:
+    """Decode every recording once into a 16 kHz PCM file in output_folder/pcm, and compact the silences.
+
+    The PCM files are reused when they already exist, e.g. when the job is retried or when extract_audio() already ran.
+    Returns a list of (PCM path, offset map to the original recording), in the order of the recordings.
+    """
+    input_path = output_folder / "input/opname"
+    if not any(input_path.iterdir()):
+        raise Exception("No audio/video files found")
 
     # Sort the input files by their name without extension,
     # casting to int to make sure filenames like 10, 20 etc. also are properly sorted
@@ -44,18 +99,213 @@ def transcribe(folder_path: Input(type="uri_folder"), output_folder: Output(type
     else:
         input_files_sorted = input_files
 
+    pcm_folder = output_folder / "pcm"
+    recordings = []  # (pcm path, offset map to the original recording)
     for path in input_files_sorted:
-        logger.info(f"Transcribing {path}...")
-        segments, _ = model.transcribe(
-            audio=(input_path / path).as_posix(), language="nl", beam_size=5, vad_filter=True
-        )
-        result.extend([s.text.strip() for s in segments])
-    end_time = time.time()
-    logger.info(
-        f"Transcription took {round((end_time-start_time)/60, 1)} minutes, {len(list(input_path.iterdir()))} file(s)."
+        logger.info(f"Decoding {path}...")
+        pcm_path = decode_to_pcm(input_path / path, pcm_folder / f"{Path(path).stem}.pcm")
+        offset_map = []
+        if settings["compact_silences"]:
+            pcm_path, offset_map = compact_silences(
+                pcm_path,
+                pcm_folder / f"{Path(path).stem}.compact.pcm",
+                min_silence_seconds=settings["min_silence_seconds"],
+                padding_seconds=settings["silence_padding_seconds"],
+            )
+            kept_minutes = sum(entry[2] for entry in offset_map) / SAMPLING_RATE / 60
+            logger.info(f"Silence compaction {path}: {round(kept_minutes, 1)} minutes of audio left")
+        recordings.append((pcm_path, offset_map))
+
+    return recordings
+
+
+def load_whisper_model(settings: dict, model_folder: str | None = None) -> WhisperModel | BatchedInferencePipeline:
+    """Load the Whisper model for the configured engine.
+
+    For the "cpu_batched" engine the model is wrapped in the batched inference pipeline of faster-whisper, which
+    transcribes several VAD segments of the audio in one forward pass.
+    """
+    start = time.time()
+    manifest = None
+    if model_folder is not None:
+        manifest = verify_model_artifact(Path(model_folder))
+        if manifest["model_size"] != settings["model_size"]:
+            raise ValueError(f"Model folder contains {manifest['model_size']}, expected {settings['model_size']}")
+    else:
+        logger.warning("No model folder given, downloading the model from the hub")
+
+    # every model worker can run a transcription concurrently, on CPU they share the available threads
+    model = WhisperModel(
+        model_size_or_path=model_folder if model_folder is not None else settings["model_size"],
+        device=settings["device"],
+        compute_type=settings["compute_type"],
+        cpu_threads=max(1, settings["cpu_threads"] // settings["workers"]) if settings["device"] == "cpu" else 0,
+        num_workers=settings["workers"],
+        local_files_only=model_folder is not None,
     )
-    with open(output_path, "w") as f:
-        f.write("\n".join(result))
+    model.logger = logger
+    warm_seconds = warm_model(model)
+    load_seconds = round(time.time() - start, 1)
+    if manifest is not None:
+        logger.info(
+            f"Loaded model {manifest['model_size']} {manifest['version']} in {load_seconds} s "
+            f"(of which {round(warm_seconds, 1)} s warming up), saved about {manifest['download_seconds']} s download"
+        )
+    else:
+        logger.info(f"Downloaded and loaded model {settings['model_size']} in {load_seconds} s")
+    if settings["engine"] == "cpu_batched":
+        return BatchedInferencePipeline(model=model)
+    return model
+
+
+def transcribe_audio(
+    model: WhisperModel | BatchedInferencePipeline, audio, settings: dict, initial_prompt: str | None = None
+) -> list:
+    """Transcribe audio (a path or a float32 array) and return the segments (with start, end and text).
+
+    initial_prompt is the text said just before the audio, e.g. the end of the previous chunk.
+    """
+    kwargs = {
+        "initial_prompt": initial_prompt,
+        "language": settings["language"],
+        "beam_size": settings["beam_size"],
+        "vad_filter": settings["vad_filter"],
+        "vad_parameters": {
+            "threshold": settings["vad_threshold"],
+            "min_silence_duration_ms": settings["vad_min_silence_ms"],
+        },
+    }
+    if isinstance(model, BatchedInferencePipeline):
+        kwargs["batch_size"] = settings["batch_size"]
+    segments, _ = model.transcribe(audio=audio, **kwargs)
+    return list(segments)
+
+
+def transcribe_chunked(
+    model: WhisperModel | BatchedInferencePipeline,
+    recordings: list[tuple[Path, list]],
+    settings: dict,
+    checkpoint: "TranscriptCheckpoint",
+) -> list[dict]:
+    """Split the recordings at silences into chunks and transcribe the chunks on a pool of model workers.
+
+    The PCM files are memory-mapped and a chunk is only converted to float32 when a worker picks it up, so peak memory
+    depends on the chunk length and the number of workers, not on the length of the recording. The results are stitched
+    back together in the original order (file by file, chunk by chunk), with the start and end of each segment in
+    seconds in the original recording.
+
+    With 1 worker the chunks are transcribed in order, and every chunk gets the end of the text of the previous chunk of
+    the same recording as initial prompt, so that Whisper keeps the context of the previous text over the boundaries.
+
+    Every finished chunk is flushed to the checkpoint, and chunks that are already in the checkpoint (from a previous,
+    failed or preempted, run) are not transcribed again.
+    """
+    chunks = []
+    for pcm_path, offset_map in recordings:
+        pcm = open_pcm(pcm_path)
+        boundaries = checkpoint.boundaries(
+            pcm_path.name, lambda: split_at_silences(pcm, max_chunk_seconds=settings["chunk_minutes"] * 60)
+        )
+        logger.info(f"Split {pcm_path.name} into {len(boundaries)} chunk(s)")
+        chunks.extend((pcm_path, pcm, offset_map, start, end) for start, end in boundaries)
+    logger.info(f"{checkpoint.number_done()} of {len(chunks)} chunk(s) already transcribed")
+
+    def _transcribe_chunk(chunk: tuple, initial_prompt: str | None = None) -> list[dict]:
+        pcm_path, pcm, offset_map, start, end = chunk
+        chunk_id = f"{pcm_path.stem}_{start}_{end}"
+        if checkpoint.is_done(chunk_id):
+            return checkpoint.load(chunk_id)
+        chunk_offset = start / SAMPLING_RATE
+        segments = [
+            {
+                "file": pcm_path.name.split(".")[0],
+                "start": round(to_original_seconds(chunk_offset + segment.start, offset_map), 2),
+                "end": round(to_original_seconds(chunk_offset + segment.end, offset_map), 2),
+                "text": segment.text.strip(),
+            }
+            for segment in transcribe_audio(model, pcm_to_float(pcm[start:end]), settings, initial_prompt)
+        ]
+        checkpoint.save(chunk_id, segments)
+        return segments
+
+    if settings["workers"] == 1:
+        results = []
+        for i, chunk in enumerate(chunks):
+            same_recording = i > 0 and chunks[i - 1][0] == chunk[0]
+            prompt = previous_text(results[-1], settings["prompt_characters"]) if same_recording else None
+            results.append(_transcribe_chunk(chunk, prompt))
+        return [segment for chunk_result in results for segment in chunk_result]
+
+    with ThreadPoolExecutor(max_workers=settings["workers"]) as executor:
+        results = executor.map(_transcribe_chunk, chunks)
+        return [segment for chunk_result in results for segment in chunk_result]
+
+
+def previous_text(segments: list[dict], max_characters: int) -> str | None:
+    """The last max_characters of the text of the segments, cut at a word boundary (None when there is no text)."""
+    text = " ".join(segment["text"] for segment in segments)
+    if len(text) > max_characters:
+        text = text[-max_characters:].split(" ", 1)[-1]
+    return text or None
+
+
+class TranscriptCheckpoint:
+    """Checkpoint of a transcription in progress, so that a rerun of the transcribe job resumes where it stopped.
+
+    The segments of every finished chunk are written to their own file in the checkpoint folder (the partial
+    transcript), and the manifest records the chunk boundaries per recording and which chunks are done. A checkpoint
+    made with other transcription settings is discarded.
+    """
+
+    def __init__(self, folder: Path, settings: dict):
+        """Load the manifest from the folder, or start a new one."""
+        self.folder = folder
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = folder / "manifest.json"
+        self.lock = threading.Lock()
+
+        relevant_settings = {k: settings[k] for k in TRANSCRIPT_CACHE_SETTINGS_KEYS}
+        manifest = json.loads(self.manifest_path.read_text()) if self.manifest_path.exists() else None
+        if manifest is not None and manifest["settings"] != relevant_settings:
+            logger.warning("Transcription settings changed since the last checkpoint, starting over")
+            manifest = None
+        self.manifest = manifest or {"settings": relevant_settings, "boundaries": {}, "done": []}
+
+    def boundaries(self, name: str, split: Callable[[], list[tuple[int, int]]]) -> list[tuple[int, int]]:
+        """Return the chunk boundaries of the recording from the checkpoint, or compute them with split()."""
+        if name not in self.manifest["boundaries"]:
+            self.manifest["boundaries"][name] = [list(b) for b in split()]
+            self._write_manifest()
+        return [tuple(b) for b in self.manifest["boundaries"][name]]
+
+    def number_done(self) -> int:
+        """Number of chunks that are done."""
+        return len(self.manifest["done"])
+
+    def is_done(self, chunk_id: str) -> bool:
+        """Whether the chunk is already transcribed."""
+        return chunk_id in self.manifest["done"]
+
+    def load(self, chunk_id: str) -> list[dict]:
+        """Load the segments of a finished chunk."""
+        return json.loads((self.folder / f"{chunk_id}.json").read_text())
+
+    def save(self, chunk_id: str, segments: list[dict]) -> None:
+        """Flush the segments of a finished chunk and mark it as done."""
+        _write_atomic(self.folder / f"{chunk_id}.json", json.dumps(segments))
+        with self.lock:
+            self.manifest["done"].append(chunk_id)
+            self._write_manifest()
+
+    def _write_manifest(self) -> None:
+        _write_atomic(self.manifest_path, json.dumps(self.manifest, indent=1))
+
+
+def _write_atomic(path: Path, text: str) -> None:
+    """Write to a temporary file first, so that a job that is killed halfway never leaves a half written file."""
+    partial = path.with_suffix(".partial")
+    partial.write_text(text)
+    partial.replace(path)
 
 
 if __name__ == "__main__":
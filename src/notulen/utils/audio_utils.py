@@ -0,0 +1,145 @@
+"""Helpers for preparing audio before it is transcribed by Whisper.
+
+Dit bestand wordt gebruikt in de transcribe node, dus hier geen imports van openai, pypandoc etc.
+"""
+import json
+from bisect import bisect_right
+from pathlib import Path
+
+import av
+import numpy as np
+from faster_whisper.vad import VadOptions, get_speech_timestamps
+
+from shared.my_logging import logger
+
+SAMPLING_RATE = 16000
+# the VAD runs on blocks of this length, so that it never needs the whole recording in memory
+VAD_BLOCK_SECONDS = 600
+
+
+def decode_to_pcm(source: Path, target: Path) -> Path:
+    """Stream-decode an audio/video file into a raw 16 kHz mono PCM file (signed 16 bit, little endian).
+
+    The file is decoded frame by frame, so memory use does not grow with the length of the recording. The PCM file is
+    first written under a temporary name, so an existing target is always complete and is reused as is (for example
+    when a preempted job is retried).
+
+    Only the first audio track of the file is decoded. Recordings with more audio tracks (e.g. one per microphone) are
+    not mixed, a warning is logged for them.
+    """
+    if target.exists():
+        return target
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+    partial = target.with_suffix(".partial")
+    resampler = av.audio.resampler.AudioResampler(format="s16", layout="mono", rate=SAMPLING_RATE)
+    with av.open(source.as_posix(), mode="r", metadata_errors="ignore") as container, open(partial, "wb") as f:
+        if len(container.streams.audio) > 1:
+            logger.warning(f"{source.name} has {len(container.streams.audio)} audio tracks, only the first is used")
+        for frame in container.decode(audio=0):
+            frame.pts = None  # the resampler does not need the timestamps, and they are sometimes invalid
+            for resampled in resampler.resample(frame):
+                f.write(resampled.to_ndarray().tobytes())
+        for resampled in resampler.resample(None):  # flush
+            f.write(resampled.to_ndarray().tobytes())
+    partial.rename(target)
+    return target
+
+
+def open_pcm(path: Path) -> np.memmap:
+    """Memory-map a PCM file written by decode_to_pcm."""
+    return np.memmap(path, dtype=np.int16, mode="r")
+
+
+def pcm_to_float(pcm: np.ndarray) -> np.ndarray:
+    """Convert (a slice of) int16 PCM into the float32 array that Whisper expects."""
+    return pcm.astype(np.float32) / 32768.0
+
+
+def detect_speech(pcm: np.ndarray, min_silence_ms: int = 1000) -> list[dict]:
+    """Run the VAD block by block and return the speech regions as {"start": sample, "end": sample} dicts."""
+    block = VAD_BLOCK_SECONDS * SAMPLING_RATE
+    speech = []
+    for offset in range(0, len(pcm), block):
+        audio = pcm_to_float(pcm[offset : offset + block])  # noqa:E203
+        for region in get_speech_timestamps(audio, VadOptions(min_silence_duration_ms=min_silence_ms)):
+            speech.append({"start": region["start"] + offset, "end": region["end"] + offset})
+    return speech
+
+
+def split_at_silences(pcm: np.ndarray, max_chunk_seconds: float, min_silence_ms: int = 1000) -> list[tuple[int, int]]:
+    """Split the audio into chunks of at most max_chunk_seconds, cutting in the silences found by the VAD.
+
+    Returns a list of (start, end) sample indices that together cover the whole audio, so nothing is thrown away. Only
+    when a single stretch of speech is longer than max_chunk_seconds it is cut hard.
+    """
+    max_chunk = int(max_chunk_seconds * SAMPLING_RATE)
+    if len(pcm) <= max_chunk:
+        return [(0, len(pcm))]
+
+    speech = detect_speech(pcm, min_silence_ms)
+    # candidate cut points: the middle of each silence between two stretches of speech
+    cut_points = [(prev["end"] + curr["start"]) // 2 for prev, curr in zip(speech, speech[1:])]
+
+    chunks = []
+    start = 0
+    while len(pcm) - start > max_chunk:
+        limit = start + max_chunk
+        candidates = [c for c in cut_points if start < c <= limit]
+        end = candidates[-1] if candidates else limit
+        chunks.append((start, end))
+        start = end
+    chunks.append((start, len(pcm)))
+    return chunks
+
+
+def compact_silences(
+    pcm_path: Path, target: Path, min_silence_seconds: float, padding_seconds: float
+) -> tuple[Path, list[list[int]]]:
+    """Write a copy of the PCM file without the silences that are longer than min_silence_seconds.
+
+    Around every stretch of speech padding_seconds of the original audio is kept, so the words are not cut off and
+    there is still a short pause between the stretches. Returns the path of the compacted PCM file and the offset map:
+    a list of [compact_start, original_start, length] in samples, one entry per kept stretch of audio. The offset map is
+    also written next to the compacted file (as .json), so that a retried job reuses both.
+    """
+    offset_map_path = target.with_suffix(".json")
+    if target.exists() and offset_map_path.exists():
+        return target, json.loads(offset_map_path.read_text())["offset_map"]
+
+    pcm = open_pcm(pcm_path)
+    padding = int(padding_seconds * SAMPLING_RATE)
+    min_silence = int(min_silence_seconds * SAMPLING_RATE)
+    keep = []  # (start, end) in the original audio
+    for region in detect_speech(pcm):
+        start, end = max(0, region["start"] - padding), min(len(pcm), region["end"] + padding)
+        if keep and start - keep[-1][1] < min_silence:
+            keep[-1] = (keep[-1][0], max(keep[-1][1], end))
+        else:
+            keep.append((start, end))
+    if not keep:  # no speech detected at all, keep everything and let Whisper decide
+        keep = [(0, len(pcm))]
+
+    offset_map = []
+    partial = target.with_suffix(".partial")
+    with open(partial, "wb") as f:
+        compact_start = 0
+        block = VAD_BLOCK_SECONDS * SAMPLING_RATE
+        for start, end in keep:
+            for block_start in range(start, end, block):
+                f.write(pcm[block_start : min(end, block_start + block)].tobytes())  # noqa:E203
+            offset_map.append([compact_start, start, end - start])
+            compact_start += end - start
+    offset_map_path.write_text(json.dumps({"sampling_rate": SAMPLING_RATE, "offset_map": offset_map}))
+    partial.rename(target)
+    return target, offset_map
+
+
+def to_original_seconds(compact_seconds: float, offset_map: list[list[int]]) -> float:
+    """Map a time in the compacted audio back to the time in the original recording."""
+    if not offset_map:
+        return compact_seconds
+    sample = int(compact_seconds * SAMPLING_RATE)
+    index = max(0, bisect_right([entry[0] for entry in offset_map], sample) - 1)
+    compact_start, original_start, _ = offset_map[index]
+    return (original_start + sample - compact_start) / SAMPLING_RATE
@@ -0,0 +1,295 @@
+"""Batch API mode of the LLM calls (llm_execution_mode "batch"), for jobs that are not urgent.
+
+All prompts of a stage are written to one JSONL batch file, submitted through the Batch API of the batch deployment,
+and polled until the batch is done. The state of the batch is kept in the batch folder of the job, so a rerun of the job
+resumes polling the same batch instead of submitting it again.
+
+LocalBatchService is a stand-in for the Batch API that answers every request locally with a placeholder (start lines
+spread evenly over the transcript, and placeholder notulen), so that the batch mode can be tested without network:
+set llm_batch_service to "local".
+"""
+import hashlib
+import json
+import os
+import re
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable
+from uuid import uuid4
+
+from openai import OpenAI
+from pydantic import BaseModel
+
+from notulen.settings import (
+    BATCH_COMPLETION_WINDOW,
+    BATCH_DEPLOYMENT_NAME,
+    BATCH_MAX_WAIT_SECONDS,
+    BATCH_POLL_SECONDS,
+    DEPLOYMENT_NAME,
+    LLM_SAMPLING_PARAMETERS,
+    get_llm_execution_mode,
+)
+from notulen.utils.llm_ledger import get_llm_ledger
+from notulen.utils.utilities import clean_prompt
+from shared.my_logging import logger
+from shared.utils import init_openai_client
+
+BATCH_DONE_STATUSES = ("completed", "failed", "expired", "cancelled")
+LOCAL_BATCH_SERVICE_NAME = "local-batch-service"
+
+
+def get_llm_deployment_name() -> str:
+    """The deployment that answers the LLM calls in this execution mode, for the result cache keys and the ledger.
+
+    The placeholders of the local stand-in get their own name, so they never end up in the cache of real results.
+    """
+    if get_llm_execution_mode() == "realtime":
+        return DEPLOYMENT_NAME
+    if os.environ.get("llm_batch_service") == "local":
+        return LOCAL_BATCH_SERVICE_NAME
+    return BATCH_DEPLOYMENT_NAME
+
+
+def get_batch_client(folder_path: Path) -> OpenAI:
+    """The client for the Batch API, or the local stand-in when llm_batch_service is "local"."""
+    if os.environ.get("llm_batch_service") == "local":
+        return LocalBatchService(folder_path / "batch" / "local_service")
+    return init_openai_client()
+
+
+def build_batch_request(
+    custom_id: str,
+    prompt: str,
+    notulen: bool,
+    structured_output: type[BaseModel] | None = None,
+    max_tokens: int | None = None,
+) -> dict:
+    """A line of the batch file: the same request as make_llm_call makes, but for the batch deployment."""
+    body = {"model": BATCH_DEPLOYMENT_NAME, "messages": [{"role": "user", "content": clean_prompt(prompt)}]}
+    if notulen:
+        body.update(LLM_SAMPLING_PARAMETERS["notulen"])
+    else:
+        body["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {
+                "name": structured_output.__name__,
+                "schema": strict_json_schema(structured_output.model_json_schema()),
+                "strict": True,
+            },
+        }
+        body.update(LLM_SAMPLING_PARAMETERS["splitsing"])
+        if max_tokens:
+            body["max_tokens"] = max_tokens
+    return {"custom_id": custom_id, "method": "POST", "url": "/chat/completions", "body": body}
+
+
+def strict_json_schema(schema: dict | list) -> dict | list:
+    """The JSON schema of a pydantic model in the form of structured outputs with strict=True (as
+    client.beta.chat.completions.parse sends it): every object has all its properties required and no others."""
+    if isinstance(schema, list):
+        return [strict_json_schema(item) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    schema = {key: strict_json_schema(value) for key, value in schema.items()}
+    if schema.get("type") == "object" and "properties" in schema:
+        schema["additionalProperties"] = False
+        schema["required"] = list(schema["properties"])
+    return schema
+
+
+def run_batch(client: OpenAI, batch_requests: list[dict], batch_folder: Path, reason: str) -> dict:
+    """Submit the requests as one batch (or resume the batch of the same requests), wait until it is done, and return
+    the results by custom_id. Requests that failed are missing or have an error; the callers do them real-time.
+
+    A batch that is not done within llm_batch_max_wait_seconds (BATCH_MAX_WAIT_SECONDS) after it was submitted is
+    cancelled. When the batch does not end as "completed" (cancelled, failed or expired), no results are returned at
+    all, so every request is done real-time.
+    """
+    batch_folder.mkdir(parents=True, exist_ok=True)
+    batch_input = "\n".join(json.dumps(request, ensure_ascii=False) for request in batch_requests) + "\n"
+    input_sha256 = hashlib.sha256(batch_input.encode()).hexdigest()
+    state_path = batch_folder / "batch.json"
+    state = json.loads(state_path.read_text()) if state_path.exists() else {}
+    if state.get("input_sha256") == input_sha256:
+        logger.info(f"Batch ({reason}): resuming batch {state['batch_id']}")
+    else:
+        (batch_folder / "batch_input.jsonl").write_text(batch_input)
+        with open(batch_folder / "batch_input.jsonl", "rb") as f:
+            input_file = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=input_file.id, endpoint="/chat/completions", completion_window=BATCH_COMPLETION_WINDOW
+        )
+        state = {"batch_id": batch.id, "input_sha256": input_sha256, "submitted": time.time()}
+        state_path.write_text(json.dumps(state, indent=4))
+        logger.info(f"Batch ({reason}): submitted {len(batch_requests)} requests as batch {batch.id}")
+
+    poll_seconds = getattr(client, "poll_seconds", BATCH_POLL_SECONDS)
+    max_wait_seconds = float(os.environ.get("llm_batch_max_wait_seconds", BATCH_MAX_WAIT_SECONDS))
+    while True:
+        batch = client.batches.retrieve(state["batch_id"])
+        if batch.status in BATCH_DONE_STATUSES:
+            break
+        if time.time() - state["submitted"] > max_wait_seconds:
+            logger.error(f"Batch ({reason}) {batch.id} is not done after {max_wait_seconds} s, cancelling it")
+            client.batches.cancel(batch.id)
+            break
+        done = batch.request_counts.completed if batch.request_counts else 0
+        logger.info(f"Batch ({reason}): {batch.status}, {done} of {len(batch_requests)} requests done")
+        time.sleep(poll_seconds)
+    if batch.status != "completed":
+        logger.error(f"Batch ({reason}) {batch.id} did not complete ({batch.status}), all requests are done real-time")
+        # a rerun of the job submits a new batch instead of resuming this one
+        state_path.unlink()
+        _record_in_ledger(batch_requests, {}, reason, time.time() - state["submitted"])
+        return {}
+
+    results = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if file_id:
+            for line in client.files.content(file_id).text.splitlines():
+                if line.strip():
+                    result = json.loads(line)
+                    results[result["custom_id"]] = result
+    (batch_folder / "batch_output.jsonl").write_text("".join(json.dumps(r) + "\n" for r in results.values()))
+    _record_in_ledger(batch_requests, results, reason, time.time() - state["submitted"])
+    logger.info(f"Batch ({reason}): {len(results)} of {len(batch_requests)} results")
+    return results
+
+
+def batch_result_content(result: dict | None) -> tuple[str | None, str | None]:
+    """The content and finish_reason of a result of the batch, or (None, None) if the request failed."""
+    if result is None or result.get("error") or (result.get("response") or {}).get("status_code") != 200:
+        return None, None
+    choice = result["response"]["body"]["choices"][0]
+    if choice["message"].get("refusal"):
+        return None, None
+    return choice["message"].get("content"), choice.get("finish_reason")
+
+
+def _record_in_ledger(batch_requests: list[dict], results: dict, reason: str, seconds: float) -> None:
+    """Record every request of the batch in the LLM call ledger, with the duration of the whole batch as latency."""
+    for request in batch_requests:
+        result = results.get(request["custom_id"])
+        content, finish_reason = batch_result_content(result)
+        usage = (result or {}).get("response", {}).get("body", {}).get("usage") or {}
+        get_llm_ledger().record(
+            {
+                "reason": f"{reason} {request['custom_id']}",
+                "stage": reason,
+                "deployment": get_llm_deployment_name(),
+                "batch": True,
+                "status": "ok" if content is not None or finish_reason is not None else "BatchRequestFailed",
+                "retries": 0,
+                "queue_seconds": 0.0,
+                "latency_seconds": round(seconds, 2),
+                "prompt_tokens": usage.get("prompt_tokens"),
+                "completion_tokens": usage.get("completion_tokens"),
+                "finish_reason": finish_reason,
+            }
+        )
+
+
+class LocalBatchService:
+    """Local stand-in for the part of the OpenAI client that the batch mode uses (files and batches).
+
+    The files and batches are kept in a folder. A batch is in progress at the first poll and answered at the next one,
+    by responder (request body -> content of the answer).
+    """
+
+    poll_seconds = 0.1
+
+    def __init__(self, folder: Path, responder: Callable[[dict], str] | None = None):
+        """Keep the files and the batches in folder."""
+        self.folder = folder
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.responder = responder or placeholder_response
+        self.files = SimpleNamespace(create=self._create_file, content=self._file_content)
+        self.batches = SimpleNamespace(
+            create=self._create_batch, retrieve=self._retrieve_batch, cancel=self._cancel_batch
+        )
+
+    def _create_file(self, file, purpose: str) -> SimpleNamespace:
+        file_id = f"file-{uuid4().hex}"
+        (self.folder / file_id).write_bytes(file.read())
+        return SimpleNamespace(id=file_id, purpose=purpose)
+
+    def _file_content(self, file_id: str) -> SimpleNamespace:
+        return SimpleNamespace(text=(self.folder / file_id).read_text())
+
+    def _create_batch(self, input_file_id: str, endpoint: str, completion_window: str) -> SimpleNamespace:
+        batch = {"id": f"batch-{uuid4().hex}", "status": "validating", "input_file_id": input_file_id}
+        (self.folder / f"{batch['id']}.json").write_text(json.dumps(batch))
+        return self._as_batch(batch)
+
+    def _retrieve_batch(self, batch_id: str) -> SimpleNamespace:
+        batch = json.loads((self.folder / f"{batch_id}.json").read_text())
+        if batch["status"] == "validating":
+            batch["status"] = "in_progress"
+        elif batch["status"] == "in_progress":
+            requests = [json.loads(line) for line in self._file_content(batch["input_file_id"]).text.splitlines()]
+            output_file_id = f"file-{uuid4().hex}"
+            (self.folder / output_file_id).write_text("".join(json.dumps(self._answer(r)) + "\n" for r in requests))
+            batch.update(status="completed", output_file_id=output_file_id, total=len(requests))
+        (self.folder / f"{batch_id}.json").write_text(json.dumps(batch))
+        return self._as_batch(batch)
+
+    def _cancel_batch(self, batch_id: str) -> SimpleNamespace:
+        batch = json.loads((self.folder / f"{batch_id}.json").read_text())
+        batch["status"] = "cancelled"
+        (self.folder / f"{batch_id}.json").write_text(json.dumps(batch))
+        return self._as_batch(batch)
+
+    def _answer(self, request: dict) -> dict:
+        content = self.responder(request["body"])
+        prompt = request["body"]["messages"][0]["content"]
+        return {
+            "id": f"response-{uuid4().hex}",
+            "custom_id": request["custom_id"],
+            "response": {
+                "status_code": 200,
+                "body": {
+                    "model": request["body"]["model"],
+                    "choices": [
+                        {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+                    ],
+                    "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4},
+                },
+            },
+            "error": None,
+        }
+
+    @staticmethod
+    def _as_batch(batch: dict) -> SimpleNamespace:
+        total = batch.get("total", 0)
+        return SimpleNamespace(
+            id=batch["id"],
+            status=batch["status"],
+            output_file_id=batch.get("output_file_id"),
+            error_file_id=None,
+            request_counts=SimpleNamespace(total=total, completed=total, failed=0),
+        )
+
+
+def placeholder_response(body: dict) -> str:
+    """Placeholder answer of the local stand-in: for a split prompt the agendapunten spread evenly over the lines of the
+    transcript in the prompt, for a notulen prompt a short placeholder text."""
+    prompt = body["messages"][0]["content"]
+    response_format = body.get("response_format")
+    if response_format is None:
+        return f"_Notulen van de lokale batch service (prompt van {len(prompt)} tekens)._"
+
+    # the agendapuntnummers are on the last line of the split prompts, the transcript lines start with "12) "
+    agendapuntnummers = [nr.strip() for nr in prompt.strip().splitlines()[-1].split(",")]
+    line_numbers = [int(n) for n in re.findall(r"^(\d+)\) ", prompt, flags=re.MULTILINE)] or [1]
+    step = max(1, len(line_numbers) // len(agendapuntnummers))
+    starts = [line_numbers[min(i * step, len(line_numbers) - 1)] for i in range(len(agendapuntnummers))]
+    if response_format["json_schema"]["name"] == "StartregelsVanAgendapunten":
+        result = [{"agendapuntnummer": nr, "startregel": start} for nr, start in zip(agendapuntnummers, starts)]
+    else:
+        ends = [start - 1 for start in starts[1:]] + [line_numbers[-1]]
+        result = [
+            {"agendapuntnummer": nr, "set_of_intervals": [{"left_endpoint": start, "right_endpoint": max(start, end)}]}
+            for nr, start, end in zip(agendapuntnummers, starts, ends)
+        ]
+    return json.dumps({"result": result})
@@ -0,0 +1,138 @@
+"""Ledger of the LLM calls: per call the reason, stage, deployment, tokens, cost, latency, time to first token, time
+spent waiting for the rate limiter, retries, whether it was a hedged duplicate and finish_reason.
+
+Every call of make_rate_limited_llm_call is recorded:
+- as a line in LLM_LEDGER_FILENAME in the job folder (once start_job has been called),
+- as OpenTelemetry metrics (histograms of the times, counters of calls, tokens and cost), which go to Application
+  Insights through the Azure Monitor setup in shared.my_logging,
+- in a summary per stage with percentiles of the times, written to LLM_LEDGER_SUMMARY_FILENAME at the end of the job.
+"""
+import json
+import os
+import threading
+from datetime import datetime
+from functools import cache
+from pathlib import Path
+
+import numpy as np
+from opentelemetry import metrics
+
+from notulen.settings import (
+    LLM_LEDGER_FILENAME,
+    LLM_LEDGER_SUMMARY_FILENAME,
+    LLM_PRICES_PER_MILLION_TOKENS,
+)
+from shared.my_logging import logger
+
+
+class LLMCallLedger:
+    """Collects the records of the LLM calls of this process (from several threads)."""
+
+    def __init__(self):
+        """Create the metric instruments; the records are only written to a file after start_job."""
+        self.lock = threading.Lock()
+        self.path = None
+        self.records = []
+        meter = metrics.get_meter("notulen.llm")
+        self.latency = meter.create_histogram("llm_call_latency", unit="s", description="Duration of an LLM call")
+        self.time_to_first_token = meter.create_histogram(
+            "llm_call_time_to_first_token", unit="s", description="Time until the first streamed token"
+        )
+        self.queue_time = meter.create_histogram(
+            "llm_call_queue_time", unit="s", description="Time spent waiting for the rate limiter"
+        )
+        self.calls = meter.create_counter("llm_calls", description="Number of LLM calls")
+        self.tokens = meter.create_counter("llm_tokens", unit="token", description="Tokens used by LLM calls")
+        self.cost = meter.create_counter("llm_cost", unit="USD", description="Cost of LLM calls")
+
+    def start_job(self, folder_path: Path) -> None:
+        """Write the records of the calls from now on to the ledger file of this job folder."""
+        with self.lock:
+            self.path = folder_path / LLM_LEDGER_FILENAME
+            self.records = []
+
+    def record(self, call: dict) -> None:
+        """Record a finished (or failed) call."""
+        call = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "job": os.environ.get("timestamp", ""),
+            **call,
+            "cost_usd": compute_cost(call.get("deployment"), call.get("prompt_tokens"), call.get("completion_tokens")),
+        }
+        attributes = {
+            "stage": call["stage"],
+            "deployment": call["deployment"],
+            "status": call["status"],
+            "finish_reason": str(call.get("finish_reason")),
+            "OTAP": os.environ.get("OTAP", "local"),
+        }
+        self.calls.add(1, attributes)
+        if call.get("latency_seconds") is not None:
+            self.latency.record(call["latency_seconds"], attributes)
+        if call.get("time_to_first_token_seconds") is not None:
+            self.time_to_first_token.record(call["time_to_first_token_seconds"], attributes)
+        self.queue_time.record(call["queue_seconds"], attributes)
+        for token_type in ("prompt", "completion"):
+            if call.get(f"{token_type}_tokens"):
+                self.tokens.add(call[f"{token_type}_tokens"], {**attributes, "token_type": token_type})
+        if call["cost_usd"]:
+            self.cost.add(call["cost_usd"], attributes)
+
+        with self.lock:
+            self.records.append(call)
+            if self.path is not None:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(call, ensure_ascii=False) + "\n")
+
+    def summary(self) -> dict:
+        """Per stage: the number of calls, retries, tokens and cost, and the percentiles of the times."""
+        with self.lock:
+            records = list(self.records)
+        summary = {}
+        for stage in sorted({record["stage"] for record in records}):
+            stage_records = [record for record in records if record["stage"] == stage]
+            summary[stage] = {
+                "calls": len(stage_records),
+                "failed_calls": sum(record["status"] not in ("ok", "HedgeLost") for record in stage_records),
+                "retries": sum(record["retries"] for record in stage_records),
+                "hedged_calls": sum(bool(record.get("hedge")) for record in stage_records),
+                "lost_hedges": sum(record["status"] == "HedgeLost" for record in stage_records),
+                "prompt_tokens": sum(record.get("prompt_tokens") or 0 for record in stage_records),
+                "completion_tokens": sum(record.get("completion_tokens") or 0 for record in stage_records),
+                "cost_usd": round(sum(record["cost_usd"] or 0 for record in stage_records), 4),
+                **{
+                    name: _percentiles([record.get(f"{name}_seconds") for record in stage_records])
+                    for name in ("latency", "time_to_first_token", "queue")
+                },
+            }
+        return summary
+
+    def write_summary(self) -> dict:
+        """Log the summary, and write it next to the ledger file of the job."""
+        summary = self.summary()
+        logger.info(f"LLM calls: {json.dumps(summary)}")
+        if self.path is not None:
+            (self.path.parent / LLM_LEDGER_SUMMARY_FILENAME).write_text(json.dumps(summary, indent=4))
+        return summary
+
+
+@cache
+def get_llm_ledger() -> LLMCallLedger:
+    """The ledger of this process, shared by all LLM calls."""
+    return LLMCallLedger()
+
+
+def compute_cost(deployment: str | None, prompt_tokens: int | None, completion_tokens: int | None) -> float | None:
+    """Cost of a call in USD, or None when the prices of the deployment or the token counts are unknown."""
+    prices = LLM_PRICES_PER_MILLION_TOKENS.get(deployment)
+    if prices is None or prompt_tokens is None or completion_tokens is None:
+        return None
+    return round((prompt_tokens * prices["prompt"] + completion_tokens * prices["completion"]) / 1_000_000, 6)
+
+
+def _percentiles(values: list[float | None]) -> dict | None:
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {"p50": round(p50, 2), "p90": round(p90, 2), "p99": round(p99, 2), "max": round(max(values), 2)}
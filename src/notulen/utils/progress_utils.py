@@ -0,0 +1,90 @@
+"""Progress of the generation of the notulen, as events in PROGRESS_FILENAME in the job folder.
+
+Every line is a JSON event with the number of agendapunten that are done (out of the total) and the number of tokens
+generated so far. While an agendapunt is streamed, its partial output is written to output_notulen/<trial>/partial.
+The webapp (start_pipeline in the Notulen Generator page) shows the last event with read_last_progress_event.
+"""
+import json
+import threading
+from datetime import datetime
+from pathlib import Path
+from time import time
+
+from notulen.settings import PROGRESS_EVENT_SECONDS, PROGRESS_FILENAME
+
+
+class NotulenProgress:
+    """Collects the streamed tokens of all agendapunten (from several threads) and writes the progress events."""
+
+    def __init__(self, folder_path: Path, output_path: Path, agendapuntnummers: list[str]):
+        """Start with an event in which nothing is done yet."""
+        self.progress_path = folder_path / PROGRESS_FILENAME
+        self.partial_path = output_path / "partial"
+        self.partial_path.mkdir(parents=True, exist_ok=True)
+        self.items_total = len(agendapuntnummers)
+        self.items_done = set()
+        self.tokens = {nr: 0 for nr in agendapuntnummers}
+        self.partial_output = {nr: [] for nr in agendapuntnummers}
+        self.changed = set()  # agendapunten of which the partial output is not written yet
+        self.lock = threading.Lock()
+        self.last_event = 0.0
+        with self.lock:
+            self._write_event("started")
+
+    def on_token(self, agendapunt_nr: str, text: str) -> None:
+        """A streamed piece of output (about one token) of the agendapunt."""
+        with self.lock:
+            self.partial_output[agendapunt_nr].append(text)
+            self.tokens[agendapunt_nr] += 1
+            self.changed.add(agendapunt_nr)
+            if time() - self.last_event >= PROGRESS_EVENT_SECONDS:
+                self._write_partial_output()
+                self._write_event("tokens")
+
+    def restart(self, agendapunt_nr: str) -> None:
+        """The call of the agendapunt is retried, so its partial output and its token count start over."""
+        with self.lock:
+            self.partial_output[agendapunt_nr] = []
+            self.tokens[agendapunt_nr] = 0
+            self.changed.add(agendapunt_nr)
+
+    def item_done(self, agendapunt_nr: str) -> None:
+        """The agendapunt is done (generated, from the result cache, or not found in the transcript)."""
+        with self.lock:
+            self.items_done.add(agendapunt_nr)
+            self.changed.discard(agendapunt_nr)
+            (self.partial_path / f"{agendapunt_nr}.md").unlink(missing_ok=True)
+            self._write_event("item_done", agendapunt=agendapunt_nr)
+
+    def finished(self) -> None:
+        """All agendapunten are done."""
+        with self.lock:
+            self._write_event("done")
+
+    def _write_partial_output(self) -> None:
+        for agendapunt_nr in self.changed:
+            (self.partial_path / f"{agendapunt_nr}.md").write_text("".join(self.partial_output[agendapunt_nr]))
+        self.changed.clear()
+
+    def _write_event(self, event: str, **details) -> None:
+        self.last_event = time()
+        progress_event = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "event": event,
+            "items_done": len(self.items_done),
+            "items_total": self.items_total,
+            "tokens_generated": sum(self.tokens.values()),
+            **details,
+        }
+        with open(self.progress_path, "a") as f:
+            f.write(json.dumps(progress_event) + "\n")
+
+
+def read_last_progress_event(progress_text: str) -> dict | None:
+    """The last complete event in the text of a progress file, or None if there is none."""
+    for line in reversed(progress_text.splitlines()):
+        try:
+            return json.loads(line)
+        except json.JSONDecodeError:
+            continue  # a line that is still being written
+    return None
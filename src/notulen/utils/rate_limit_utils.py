@@ -0,0 +1,305 @@
+"""Rate limiting and resilience of the calls to the Azure OpenAI deployment.
+
+Concurrent calls stay within the tokens-per-minute and requests-per-minute limits of the deployment instead of running
+into 429 errors. A call that still fails with a 429, a 5xx error, a timeout or a broken connection is retried with
+backoff, every attempt has a time limit (also a stream that keeps sending tokens slowly) and the call as a whole a
+deadline, and a split call that stalls can get a hedged duplicate. So a single bad response does not fail the whole
+post-transcribe job.
+
+The calls are I/O bound (the node waits for the API), so they run in threads: this also works on a single-core node.
+"""
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import cache
+from typing import Callable
+
+import httpx
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    InternalServerError,
+    OpenAI,
+    RateLimitError,
+)
+
+from notulen.settings import (
+    DEPLOYMENT_NAME,
+    LLM_BACKOFF_BASE_SECONDS,
+    LLM_BACKOFF_MAX_SECONDS,
+    LLM_CALL_DEADLINE_SECONDS,
+    LLM_CALL_TIMEOUT_SECONDS,
+    LLM_MAX_RETRIES,
+    LLM_OUTPUT_TOKEN_ESTIMATE,
+    get_llm_hedge_split_after,
+    get_llm_rate_limits,
+)
+from notulen.utils.llm_ledger import get_llm_ledger
+from notulen.utils.utilities import make_llm_call
+from shared.my_logging import logger
+
+
+class TokenBucket:
+    """Token bucket that is refilled continuously with per_minute / 60 tokens per second, up to per_minute tokens."""
+
+    def __init__(self, per_minute: int):
+        """Initialize with a full bucket."""
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self) -> None:
+        """Add the tokens of the time since the last refill."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def seconds_until(self, amount: float) -> float:
+        """How long to wait until the bucket holds amount tokens (0 if it does already)."""
+        self.refill()
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+
+class LLMRateLimiter:
+    """Blocks a call until both the token bucket (TPM) and the request bucket (RPM) allow it.
+
+    After a 429 the limiter pauses all calls, not only the one that got the 429.
+    """
+
+    def __init__(self, tokens_per_minute: int, requests_per_minute: int):
+        """Initialize."""
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, estimated_tokens: int) -> None:
+        """Wait until a call of estimated_tokens (prompt + expected output) is allowed and take its tokens."""
+        # a single prompt larger than the bucket would wait forever, so it may use at most a full bucket
+        estimated_tokens = min(estimated_tokens, self.token_bucket.capacity)
+        while True:
+            with self.lock:
+                wait = max(
+                    self.paused_until - time.monotonic(),
+                    self.token_bucket.seconds_until(estimated_tokens),
+                    self.request_bucket.seconds_until(1),
+                )
+                if wait <= 0:
+                    self.token_bucket.tokens -= estimated_tokens
+                    self.request_bucket.tokens -= 1
+                    return
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Hold back all calls for the given number of seconds (after a 429)."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+@cache
+def get_llm_rate_limiter() -> LLMRateLimiter:
+    """The rate limiter of this process, shared by all calls to the deployment (splitting and notulen)."""
+    tokens_per_minute, requests_per_minute = get_llm_rate_limits()
+    logger.info(f"LLM rate limits: {tokens_per_minute} tokens and {requests_per_minute} requests per minute")
+    return LLMRateLimiter(tokens_per_minute, requests_per_minute)
+
+
+def estimate_tokens(prompt: str, notulen: bool) -> int:
+    """Rough estimate of the tokens of a call: about 4 characters per token for the prompt, plus the output."""
+    return len(prompt) // 4 + (LLM_OUTPUT_TOKEN_ESTIMATE if notulen else LLM_OUTPUT_TOKEN_ESTIMATE // 2)
+
+
+def make_rate_limited_llm_call(
+    client: OpenAI,
+    prompt: str,
+    notulen: bool,
+    reason: str = "",
+    on_retry: Callable[[], None] | None = None,
+    **kwargs,
+) -> dict | str | None:
+    """make_llm_call, but within the rate limits of the deployment, with retries, timeouts and (for the splitting)
+    hedging.
+
+    The retries of the OpenAI client itself are switched off, so that a 429 also pauses the other threads. on_retry is
+    called before every retry (for example to throw away the partial output of a streamed call). Other keyword
+    arguments (structured_output, max_tokens, on_token) are passed on to make_llm_call. Every call is recorded in the
+    LLM call ledger, also when it fails.
+    """
+    hedge_after = get_llm_hedge_split_after()
+    if notulen or hedge_after <= 0:
+        return call_with_retries(client, prompt, notulen, reason, on_retry, **kwargs)
+
+    executor = ThreadPoolExecutor(max_workers=2)
+    race = HedgeRace(reason)
+    try:
+        primary = executor.submit(call_with_retries, client, prompt, notulen, reason, on_retry, race=race, **kwargs)
+        if wait([primary], timeout=hedge_after).done:
+            return primary.result()
+        logger.warning(f"LLM call ({reason}) has no answer after {hedge_after} s, sending a hedged duplicate")
+        hedge = executor.submit(
+            call_with_retries, client, prompt, notulen, reason, on_retry, hedge=True, race=race, **kwargs
+        )
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    logger.info(f"LLM call ({reason}): the {'hedged' if future is hedge else 'first'} call won")
+                    race.finish(winner_is_hedge=future is hedge)
+                    return future.result()
+        return primary.result()  # both failed, so raise the error of the first call
+    finally:
+        # the slower call keeps running in the background until its answer arrives, but it is not retried anymore and
+        # it is not recorded in the ledger again (see HedgeRace)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class HedgeRace:
+    """The first call and the hedged duplicate of a split call.
+
+    When one of them wins, the other one is lost: it is recorded right away as a lost hedge (status "HedgeLost"), so
+    that the ledger is complete when its summary is written, and it is not retried or recorded when it ends later.
+    """
+
+    def __init__(self, reason: str):
+        """Nothing is recorded or lost yet."""
+        self.reason = reason
+        self.lock = threading.Lock()
+        self.recorded = set()  # the hedge flags of the calls that are in the ledger
+        self.lost = set()
+
+    def is_lost(self, hedge: bool) -> bool:
+        """Whether the other call already won."""
+        with self.lock:
+            return hedge in self.lost
+
+    def record(self, call: dict) -> None:
+        """Record the call in the ledger, unless it is already recorded as lost."""
+        with self.lock:
+            if call["hedge"] in self.lost:
+                return
+            self.recorded.add(call["hedge"])
+            get_llm_ledger().record(call)
+
+    def finish(self, winner_is_hedge: bool) -> None:
+        """The call with hedge flag winner_is_hedge won; the other call is lost if it is still running."""
+        loser = not winner_is_hedge
+        with self.lock:
+            if loser in self.recorded:
+                return  # it already ended (with an error)
+            self.lost.add(loser)
+            get_llm_ledger().record(
+                {
+                    "reason": self.reason,
+                    "stage": "splitsing",
+                    "deployment": DEPLOYMENT_NAME,
+                    "hedge": loser,
+                    "status": "HedgeLost",
+                    "retries": 0,
+                    "queue_seconds": 0.0,
+                }
+            )
+
+
+def call_with_retries(
+    client: OpenAI,
+    prompt: str,
+    notulen: bool,
+    reason: str,
+    on_retry: Callable[[], None] | None = None,
+    hedge: bool = False,
+    race: HedgeRace | None = None,
+    **kwargs,
+) -> dict | str | None:
+    """One call of make_llm_call, retried on 429s, 5xx errors, timeouts and broken connections.
+
+    Every attempt waits for the rate limiter and may take at most LLM_CALL_TIMEOUT_SECONDS of the stage; no retry starts
+    that would end after LLM_CALL_DEADLINE_SECONDS. A hedged call (with race) stops retrying when the other call won.
+    The timeout of the client only limits the wait for each read, so a streamed attempt (with on_token) is also stopped
+    when it is not complete within that time, see with_time_limit.
+    """
+    stage = "notulen" if notulen else "splitsing"
+    limiter = get_llm_rate_limiter()
+    start = time.monotonic()
+    call = {
+        "reason": reason,
+        "stage": stage,
+        "deployment": DEPLOYMENT_NAME,
+        "hedge": hedge,
+        "status": "ok",
+        "retries": 0,
+        "queue_seconds": 0.0,
+    }
+    try:
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            if race is not None and race.is_lost(hedge):
+                return None
+            queued = time.monotonic()
+            limiter.acquire(estimate_tokens(prompt, notulen))
+            call["queue_seconds"] = round(call["queue_seconds"] + time.monotonic() - queued, 2)
+            remaining = LLM_CALL_DEADLINE_SECONDS - (time.monotonic() - start)
+            attempt_timeout = max(1.0, min(LLM_CALL_TIMEOUT_SECONDS[stage], remaining))
+            attempt_client = client.with_options(max_retries=0, timeout=attempt_timeout)
+            attempt_kwargs = kwargs
+            if kwargs.get("on_token") is not None:
+                attempt_kwargs = {**kwargs, "on_token": with_time_limit(kwargs["on_token"], attempt_timeout)}
+            try:
+                return make_llm_call(
+                    attempt_client, prompt, notulen=notulen, reason=reason, call_record=call, **attempt_kwargs
+                )
+            # httpx.TransportError: the connection breaks or stalls halfway a stream
+            except (RateLimitError, InternalServerError, APIConnectionError, httpx.TransportError) as e:
+                backoff = compute_backoff(e, attempt)
+                elapsed = time.monotonic() - start
+                if attempt == LLM_MAX_RETRIES or elapsed + backoff >= LLM_CALL_DEADLINE_SECONDS:
+                    logger.error(f"LLM call ({reason}) failed after {attempt + 1} attempts and {round(elapsed)} s: {e}")
+                    raise
+                call["retries"] += 1
+                logger.warning(
+                    f"{type(e).__name__} from the LLM ({reason}), attempt {attempt + 1}, "
+                    f"retrying in {round(backoff, 1)} s"
+                )
+                if isinstance(e, RateLimitError):
+                    limiter.pause(backoff)  # the deployment is full, so hold back the other calls as well
+                else:
+                    time.sleep(backoff)
+                if on_retry is not None:
+                    on_retry()
+    except Exception as e:
+        call["status"] = type(e).__name__
+        raise
+    finally:
+        if race is not None:
+            race.record(call)
+        else:
+            get_llm_ledger().record(call)
+
+
+def with_time_limit(on_token: Callable[[str], None], timeout: float) -> Callable[[str], None]:
+    """on_token that stops the stream with a httpx.ReadTimeout (so the attempt is retried) after timeout seconds."""
+    deadline = time.monotonic() + timeout
+
+    def _on_token(token: str) -> None:
+        if time.monotonic() > deadline:
+            raise httpx.ReadTimeout(f"Streamed answer not complete after {round(timeout)} s")
+        on_token(token)
+
+    return _on_token
+
+
+def compute_backoff(error: Exception, attempt: int) -> float:
+    """Seconds to wait before the next attempt: the Retry-After of the API if it gives one, otherwise exponential
+    backoff with full jitter (so that the waiting threads do not all retry at once)."""
+    if isinstance(error, APIStatusError):
+        retry_after_ms = error.response.headers.get("retry-after-ms")
+        retry_after = error.response.headers.get("retry-after")
+        try:
+            if retry_after_ms:
+                return float(retry_after_ms) / 1000 + random.uniform(0, 1)
+            if retry_after:
+                return float(retry_after) + random.uniform(0, 1)
+        except ValueError:
+            pass  # Retry-After can also be a date, then use the backoff below
+    return random.uniform(0, min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * 2 ** (attempt + 1)))
@@ -0,0 +1,65 @@
+"""Content-addressed cache of the results of the LLM stages (the splitting and the notulen per agendapunt).
+
+The key is a hash of everything that determines the result: the transcript, the agenda, the prompt templates, the
+deployment and the sampling parameters. A retry of a failed post-transcribe job, or a rerun of the same recording
+with another type_notulen, reuses every result whose inputs did not change.
+
+The results are stored in the job folder (folder/result_cache), and when the environment variable
+result_cache_datalake is "True" also in RESULT_CACHE_FOLDER on the datalake, so that other jobs can use them too. The
+cached results on the datalake are deleted after 7 days, like the transcripts.
+"""
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from notulen.settings import RESULT_CACHE_FOLDER
+from shared.my_logging import logger
+from shared.utils import AzureHelper
+
+
+def compute_result_cache_key(*parts) -> str:
+    """Hash of the parts (strings, numbers, dicts and lists)."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+def fetch_cached_result(folder_path: Path, kind: str, key: str) -> dict | None:
+    """The cached result of this kind ("splitsing", "notulen") and key, or None."""
+    local_path = folder_path / "result_cache" / kind / f"{key}.json"
+    if local_path.exists():
+        logger.info(f"Result cache hit ({kind}, job folder): {key}")
+        return json.loads(local_path.read_text())
+    if os.environ.get("result_cache_datalake") == "True":
+        blob = AzureHelper().container_client.get_blob_client(f"{RESULT_CACHE_FOLDER}/{kind}/{key}.json")
+        if blob.exists():
+            logger.info(f"Result cache hit ({kind}, datalake): {key}")
+            result = blob.download_blob().readall()
+            local_path.parent.mkdir(parents=True, exist_ok=True)
+            local_path.write_bytes(result)
+            return json.loads(result)
+    logger.info(f"Result cache miss ({kind}): {key}")
+    return None
+
+
+def store_result_in_cache(folder_path: Path, kind: str, key: str, result: dict) -> None:
+    """Store the result in the job folder, and on the datalake when result_cache_datalake is "True"."""
+    result_json = json.dumps(result, ensure_ascii=False)
+    local_path = folder_path / "result_cache" / kind / f"{key}.json"
+    local_path.parent.mkdir(parents=True, exist_ok=True)
+    local_path.write_text(result_json)
+    if os.environ.get("result_cache_datalake") == "True":
+        AzureHelper().container_client.upload_blob(
+            f"{RESULT_CACHE_FOLDER}/{kind}/{key}.json", result_json.encode(), overwrite=True
+        )
+
+
+def delete_expired_results(az: AzureHelper, days: int = 7) -> None:
+    """Delete the cached results that are older than the given number of days (same retention as the notulen)."""
+    deleted = 0
+    expiry = datetime.now(timezone.utc) - timedelta(days=days)
+    for blob in az.container_client.list_blobs(name_starts_with=f"{RESULT_CACHE_FOLDER}/"):
+        if blob.name.endswith(".json") and blob.last_modified < expiry:
+            az.container_client.delete_blob(blob.name)
+            deleted += 1
+    logger.info(f"Deleted {deleted} cached results from the datalake.")
@@ -0,0 +1,157 @@
+"""Local pre-segmentation of the transcript, before the LLM splits it.
+
+Overlapping windows of transcript lines are scored against every agendapunt (title + body) with BM25, and the windows
+are assigned to the agendapunten in agenda order. This gives a guess of the start line of every agendapunt, and how
+confident that guess is. It runs on NumPy only, without network.
+"""
+import re
+
+import numpy as np
+from unidecode import unidecode
+
+from notulen.settings import (
+    PRESEGMENT_CONFIDENCE,
+    PRESEGMENT_MARGIN_LINES,
+    PRESEGMENT_STRIDE_LINES,
+    PRESEGMENT_WINDOW_LINES,
+)
+
+# veelvoorkomende woorden die niets zeggen over het onderwerp van een agendapunt
+STOPWORDS = set(
+    """aan als bij dan dat deze die dit doen door een eens en er ge geen had heb hebben heeft hem het hier hij hoe
+    hun iets ik in is ja je kan kon kunnen maar me meer men met mij mijn moet na naar niet niets nog nu of om omdat
+    ons ook op over reeds te tegen toch toen tot u uit uw van veel voor want waren was wat we wel werd wezen wie wij
+    wil worden wordt zal ze zei zelf zich zij zijn zo zonder zou even gewoon eigenlijk denk weet goed heel zeg
+    zeggen gaan gaat komt komen graag daar waar dus alle allemaal""".split()
+)
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercase words (without accents) and numbers, leaving out the stopwords."""
+    words = re.findall(r"[a-z]+|\d+", unidecode(text).lower())
+    return [w for w in words if w not in STOPWORDS and (len(w) > 2 or w.isdigit())]
+
+
+def score_windows(transcript_lines: list[str], queries: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """BM25 score of every window of PRESEGMENT_WINDOW_LINES lines (with steps of PRESEGMENT_STRIDE_LINES) for every
+    query.
+
+    Returns the scores (windows x queries) and the first line (from 1) of every window.
+    """
+    query_tokens = [tokenize(q) for q in queries]
+    vocabulary = {w: i for i, w in enumerate(sorted({w for tokens in query_tokens for w in tokens}))}
+
+    # term frequencies per line (only of the words in the queries) and the length of every line
+    line_tf = np.zeros((len(transcript_lines) + 1, len(vocabulary)), dtype=np.float32)
+    line_length = np.zeros(len(transcript_lines) + 1, dtype=np.float32)
+    for i, line in enumerate(transcript_lines, start=1):
+        tokens = tokenize(line)
+        line_length[i] = len(tokens)
+        np.add.at(line_tf[i], [vocabulary[w] for w in tokens if w in vocabulary], 1)
+    # with cumulative sums, the sum over a window is a difference of two rows
+    cumulative_tf, cumulative_length = np.cumsum(line_tf, axis=0), np.cumsum(line_length)
+
+    starts = list(range(0, max(len(transcript_lines) - PRESEGMENT_WINDOW_LINES, 0) + 1, PRESEGMENT_STRIDE_LINES))
+    if starts[-1] + PRESEGMENT_WINDOW_LINES < len(transcript_lines):
+        starts.append(len(transcript_lines) - PRESEGMENT_WINDOW_LINES)  # the last window ends at the last line
+    starts = np.array(starts)
+    ends = np.minimum(starts + PRESEGMENT_WINDOW_LINES, len(transcript_lines))
+    tf = cumulative_tf[ends] - cumulative_tf[starts]
+    length = cumulative_length[ends] - cumulative_length[starts]
+
+    document_frequency = (tf > 0).sum(axis=0)
+    idf = np.log((len(starts) - document_frequency + 0.5) / (document_frequency + 0.5) + 1)
+    normalisation = BM25_K1 * (1 - BM25_B + BM25_B * length / max(length.mean(), 1))
+    weights = idf * tf * (BM25_K1 + 1) / (tf + normalisation[:, None])
+
+    query_tf = np.zeros((len(vocabulary), len(queries)), dtype=np.float32)
+    for j, tokens in enumerate(query_tokens):
+        np.add.at(query_tf[:, j], [vocabulary[w] for w in tokens], 1)
+    return weights @ query_tf, starts + 1
+
+
+def align_in_agenda_order(scores: np.ndarray) -> np.ndarray:
+    """Assign every window to an agendapunt such that the agendapunten follow the agenda order, and the sum of the
+    (per agendapunt standardised) scores is maximal. Agendapunten can be skipped (not discussed).
+
+    Returns the index of the agendapunt of every window.
+    """
+    z = (scores - scores.mean(axis=0)) / np.where(scores.std(axis=0) > 0, scores.std(axis=0), 1)
+    number_of_windows, number_of_items = z.shape
+    total = np.zeros_like(z)
+    previous = np.zeros(z.shape, dtype=np.int64)  # the agendapunt of the previous window on the best path
+    total[0] = z[0]
+    for w in range(1, number_of_windows):
+        # best path so far that ends in agendapunt j or an earlier one, and in which agendapunt that path ends
+        best_until = np.maximum.accumulate(total[w - 1])
+        previous[w] = np.maximum.accumulate(np.where(total[w - 1] >= best_until, np.arange(number_of_items), 0))
+        total[w] = z[w] + best_until
+
+    assignment = np.zeros(number_of_windows, dtype=np.int64)
+    assignment[-1] = np.argmax(total[-1])
+    for w in range(number_of_windows - 1, 0, -1):
+        assignment[w - 1] = previous[w][assignment[w]]
+    return assignment
+
+
+def presegment(transcript_lines: list[str], agenda_splitsing: dict) -> dict:
+    """Guess the start line of every agendapunt from the lexical overlap between the transcript and the agenda.
+
+    Returns {agendapuntnummer: {"start": line, "confidence": float}}, only for the agendapunten that got at least one
+    window. The confidence is how much higher the (standardised) score of the agendapunt is within its own part of the
+    transcript than outside of it.
+    """
+    agendapuntnummers = list(agenda_splitsing)
+    queries = [f"{agenda_splitsing[nr]['titel']}\n{agenda_splitsing[nr].get('body', '')}" for nr in agendapuntnummers]
+    scores, window_starts = score_windows(transcript_lines, queries)
+    assignment = align_in_agenda_order(scores)
+    z = (scores - scores.mean(axis=0)) / np.where(scores.std(axis=0) > 0, scores.std(axis=0), 1)
+
+    result = {}
+    for index, agendapuntnummer in enumerate(agendapuntnummers):
+        own = assignment == index
+        if not own.any():
+            continue
+        outside = z[~own, index].mean() if (~own).any() else 0.0
+        result[agendapuntnummer] = {
+            "start": int(window_starts[np.argmax(own)]),
+            "confidence": round(float(z[own, index].mean() - outside), 2),
+        }
+    return result
+
+
+def candidate_line_ranges(
+    presegmentation: dict, agendapuntnummers: list, number_of_lines: int
+) -> list[tuple[int, int]]:
+    """The line ranges in which the LLM has to look for the start lines of the agendapunten.
+
+    Around a confident start line PRESEGMENT_MARGIN_LINES lines on both sides. For an agendapunt without a confident
+    start line, everything between the confident start lines of the agendapunten before and after it. The ranges are
+    merged and sorted.
+    """
+    anchors = [
+        presegmentation[nr]["start"]
+        if presegmentation.get(nr, {}).get("confidence", 0) >= PRESEGMENT_CONFIDENCE
+        else None
+        for nr in agendapuntnummers
+    ]
+    ranges = []
+    for index, anchor in enumerate(anchors):
+        if anchor is not None:
+            ranges.append(
+                (max(1, anchor - PRESEGMENT_MARGIN_LINES), min(number_of_lines, anchor + PRESEGMENT_MARGIN_LINES))
+            )
+        else:
+            before = [a for a in anchors[:index] if a is not None]
+            after = [a for a in anchors[index + 1 :] if a is not None]  # noqa:E203
+            ranges.append((before[-1] if before else 1, after[0] if after else number_of_lines))
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
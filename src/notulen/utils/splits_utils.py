@@ -1,6 +1,11 @@
+import math
 import re
 from pathlib import Path
 
+import numpy as np
+
+from notulen.utils.transcript import Transcript
+
 
 def extract_agendapunten(folder_path: Path) -> dict:
     """Dit splitst het PDF bestand van de agenda in losse agendapunten. Hierbij is eerst het PDF bestand geconverteerd
@@ -102,143 +107,97 @@ def _replace_numbers_with_letters(text: str) -> str:
     return text
 
 
-class AgendapuntMetTranscript:
-    """Deze klasse representeert een agendapunt (nummer) en een bijbehorende lijst van intervallen van regelnummers uit
-    het transcript."""
-
-    def __init__(self, agendapuntnummer: str, list_of_intervals: list[tuple[int, int]], laatste_regel_transcript: int):
-        """Initialize."""
-        self.agendapuntnummer = agendapuntnummer
-        self.list_of_intervals = list_of_intervals
-        self.laatste_regel_transcript = laatste_regel_transcript
-
-        if len(list_of_intervals) == 0:
-            # LLM did not detect relevant lines, so we give it the entire transcript
-            self.left_boundary_gebied = 1
-            self.right_boundary_gebied = laatste_regel_transcript
-            self.right_boundary_gebied_old = self.right_boundary_gebied
-            self.list_of_intervals = [(self.left_boundary_gebied, self.right_boundary_gebied)]
-        else:
-            self.left_boundary_gebied = min([interval[0] for interval in list_of_intervals])
-            self.right_boundary_gebied = max([interval[1] for interval in list_of_intervals])
-            self.right_boundary_gebied_old = self.right_boundary_gebied
-            self.verwijder_overlap()
-
-    def verwijder_overlap(self):
-        """Maak de intervallen disjunct door overlappende en ingesloten delen samen te voegen.
-
-        Ook worden de intervallen op een logische volgorde gesorteerd.
-        """
-        if len(self.list_of_intervals) == 1:
-            return
-
-        # Sorteer de intervallen op startregel
-        sorted_intervals = sorted(self.list_of_intervals, key=lambda x: x[0])
-        merged = [sorted_intervals[0]]
-
-        for current in sorted_intervals[1:]:
-            prev_start, prev_end = merged[-1]
-            curr_start, curr_end = current
-
-            if curr_start <= prev_end:
-                # Overlap (of direct aansluitend) en dus samenvoegen
-                merged[-1] = (prev_start, max(prev_end, curr_end))
-            else:
-                # Geen overlap, nieuw interval
-                merged.append(current)
-
-        self.list_of_intervals = merged
-
-        # Update boundaries
-        self.left_boundary_gebied = merged[0][0]
-        self.right_boundary_gebied = merged[-1][1]
+def compute_split_intervals(gpt_dict: dict, laatste_regel_transcript: int) -> tuple[list[str], np.ndarray, np.ndarray]:
+    """Verwerk de splitsing dictionary van de LLM tot disjuncte intervallen van regelnummers per agendapunt.
 
-    def add_interval(self, new_interval: tuple[int, int]):
-        """Voeg een zelfgemaakt interval toe als het logisch is."""
-        self.list_of_intervals.append(new_interval)
-
-
-def apply_gpt_split(transcript_lines: list[str], gpt_dict: dict, splits_path: Path) -> dict:
-    """Gegeven de dictionary van de splitsing van de LLM, splits de string van het transcript.
-
-    Maar eerst verwerken we de splitsing dictionary van de LLM met zelfgeschreven logica, omdat de output soms onlogisch
-    is.
+    De output van de LLM is soms onlogisch, dus die wordt verwerkt met zelfgeschreven logica. Alle intervallen staan
+    in 1 array, zodat dit voor alle agendapunten tegelijk gebeurt. Geeft de agendapuntnummers (in agendavolgorde), het
+    agendapunt (index in die lijst) van elk interval, en de intervallen als array van (begin, eind) regelnummers.
     """
-    transcript_split = {}
-    laatste_regel_transcript = len(transcript_lines)
-
-    # prepare keys/agendapuntnummers
+    # prepare keys/agendapuntnummers, and enforce that the agendapuntnummers are in the correct order
     gpt_dict = {k.replace(".", "").lower(): v for k, v in gpt_dict.items()}
-    items_list = list(gpt_dict.items())
-    # enforce that the agendapuntnummers are in the correct order inside the items list
-    items_list = sorted(items_list, key=_helper_sorting)
+    agendapuntnummers = [k for k, _ in sorted(gpt_dict.items(), key=_helper_sorting)]
+    n = len(agendapuntnummers)
+    if n == 0:
+        return [], np.zeros(0, dtype=np.int64), np.zeros((0, 2), dtype=np.int64)
+
+    # LLM did not detect relevant lines, so we give it the entire transcript
+    intervals = [list(gpt_dict[nr]) or [(1, laatste_regel_transcript)] for nr in agendapuntnummers]
+    items = np.repeat(np.arange(n), [len(i) for i in intervals])
+    bounds = np.array([interval for i in intervals for interval in i], dtype=np.int64).reshape(-1, 2)
+    bounds = np.clip(bounds, 1, max(laatste_regel_transcript, 1))
+    starts, ends = bounds[:, 0], bounds[:, 1]
+    # het gebied van een agendapunt begint bij de kleinste startregel van zijn intervallen
+    left_boundary_gebied = np.full(n, laatste_regel_transcript, dtype=np.int64)
+    np.minimum.at(left_boundary_gebied, items, starts)
 
-    agendapunten_met_transcript = [
-        AgendapuntMetTranscript(agendapuntnummer, list_of_intervals, laatste_regel_transcript)
-        for agendapuntnummer, list_of_intervals in items_list
-    ]
-    # Verwerk onlogische output van LLM met zelfgeschreven logica.
     # Het taalmodel is beter in het herkennen van waar een agendapunt begint dan waar die eindigt
-    for agendapunt_index, agendapunt_met_transcript in enumerate(agendapunten_met_transcript):
-        if len(agendapunten_met_transcript) == 1:
-            # Als er maar 1 agendapunt is, krijgt die gewoon het hele transcript. De elif en else statements worden geskipt # noqa: E501
-            agendapunt_met_transcript.list_of_intervals = [(1, laatste_regel_transcript)]
-        elif agendapunt_index == 0:
-            # het eerste agendapunt moet lopen van het begin van het transcript tot het volgende agendapunt
-            agendapunt_met_transcript.list_of_intervals = [
-                (1, agendapunten_met_transcript[agendapunt_index + 1].left_boundary_gebied)
-            ]
-        elif agendapunt_index == len(agendapunten_met_transcript) - 1:
-            # het laatste agendapunt moet gewoon het laatste gedeelte van het transcript vangen
-            agendapunt_met_transcript.list_of_intervals = [
-                (
-                    agendapunt_met_transcript.left_boundary_gebied,
-                    laatste_regel_transcript,
-                )  # wijzig eindpunt maar niet startpunt
-            ]
-        else:
-            for interval_index, interval in enumerate(agendapunt_met_transcript.list_of_intervals):
-                left_boundary = interval[0]  # van het interval, niet van het hele gebied
-                right_boundary = interval[1]
-
-                # De volgende aanpassing kan nuttig zijn als het blijkt dat het beginpunt niet goed wordt herkend # noqa: E501
-                # en dat er daardoor te weinig context wordt meegegeven. Voor nu uitgecomment. # noqa: E501
-                # als het eerste interval later begint dan het vorige agendapunt eindigt, veranderen we dit (door de linkergrens te wijzigen) # noqa: E501
-                # if interval_index == 0 and left_boundary > agendapunten_met_transcript[agendapunt_index - 1].right_boundary_gebied_old + 1: # noqa: E501
-                #     left_boundary = agendapunten_met_transcript[agendapunt_index - 1].right_boundary_gebied_old + 1 # noqa: E501
-
-                # de volgende if statement vergroot het gebied van het agendapunt d.m.v. 2 aanpassingen: # noqa: E501
-                # (1) verwijdert "onnodige" gaten tussen intervallen van 1 agendapunt en (2) verwijdert het gat naar het volgende agendapunt # noqa: E501
-                if (
-                    # elk interval dat eindigt voor het beginpunt van het volgende agendapunt is een onzinnig interval,
-                    # dat interval moest lopen tot het beginpunt van het volgende agendapunt
-                    right_boundary
-                    < agendapunten_met_transcript[agendapunt_index + 1].left_boundary_gebied
-                ):
-                    right_boundary = agendapunten_met_transcript[
-                        agendapunt_index + 1
-                    ].left_boundary_gebied  # maak interval groter naar start volgende agendapunt
-
-                if (left_boundary, right_boundary) != interval:  # if interval changed
-                    agendapunt_met_transcript.add_interval(new_interval=(left_boundary, right_boundary))
-            agendapunt_met_transcript.verwijder_overlap()  # opnieuw overlap verwijderen, gecreeerd binnen de else statement # noqa: E501
-
-        # Klaar met verwerken voor dit agendapunt. Extraheer het relevante deel van het transcript.
-        transcript_split[agendapunt_met_transcript.agendapuntnummer] = ""
-        for interval in agendapunt_met_transcript.list_of_intervals:
-            start = interval[0] - 1
-            end = interval[1]
-            transcript_split[agendapunt_met_transcript.agendapuntnummer] += "".join(transcript_lines[start:end])
+    if n == 1:
+        # Als er maar 1 agendapunt is, krijgt die gewoon het hele transcript
+        items, starts, ends = np.array([0]), np.array([1]), np.array([laatste_regel_transcript])
+    else:
+        # elk interval dat eindigt voor het beginpunt van het volgende agendapunt is een onzinnig interval, dat interval
+        # moest lopen tot het beginpunt van het volgende agendapunt. Dit verwijdert "onnodige" gaten tussen intervallen
+        # van 1 agendapunt en het gat naar het volgende agendapunt.
+        ends = np.maximum(ends, np.append(left_boundary_gebied[1:], 0)[items])
+        # het eerste agendapunt loopt van het begin van het transcript tot het volgende agendapunt, en het laatste
+        # agendapunt vangt het laatste gedeelte van het transcript (eindpunt gewijzigd maar niet het startpunt)
+        middle = (items > 0) & (items < n - 1)
+        items = np.concatenate([[0], items[middle], [n - 1]])
+        starts = np.concatenate([[1], starts[middle], [left_boundary_gebied[-1]]])
+        ends = np.concatenate([[left_boundary_gebied[1]], ends[middle], [laatste_regel_transcript]])
+
+    items, bounds = merge_intervals(items, starts, ends, laatste_regel_transcript)
+    return agendapuntnummers, items, bounds
+
+
+def merge_intervals(
+    items: np.ndarray, starts: np.ndarray, ends: np.ndarray, laatste_regel_transcript: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Maak de intervallen per agendapunt disjunct door overlappende en ingesloten delen samen te voegen.
+
+    De intervallen worden gesorteerd op agendapunt en startregel. Door de regelnummers per agendapunt te verschuiven,
+    kan het lopende maximum van de eindregels in 1 keer over alle agendapunten berekend worden.
+    """
+    order = np.lexsort((starts, items))
+    items, starts, ends = items[order], starts[order], ends[order]
+    shift = items * (laatste_regel_transcript + 2)
+    running_end = np.maximum.accumulate(ends + shift)
+    # een nieuw interval begint als de startregel na het einde van alle vorige intervallen (van dit agendapunt) ligt
+    new_interval = np.ones(len(items), dtype=bool)
+    new_interval[1:] = starts[1:] + shift[1:] > running_end[:-1]
+    first = np.flatnonzero(new_interval)
+    bounds = np.stack([starts[first], np.maximum.reduceat(ends, first)], axis=1) if len(first) else np.zeros((0, 2))
+    return items[first], bounds.astype(np.int64)
+
+
+def apply_gpt_split(transcript: Transcript, gpt_dict: dict, splits_path: Path) -> tuple[dict, dict]:
+    """Gegeven de dictionary van de splitsing van de LLM, splits het transcript.
+
+    Geeft het stuk transcript per agendapunt, zonder en met regelnummers. Beide worden in 1 keer gemaakt uit dezelfde
+    intervallen, als slices van de tekst van het hele transcript (zie de line-offset index van Transcript).
+    """
+    agendapuntnummers, items, bounds = compute_split_intervals(gpt_dict, len(transcript))
 
-    # save processed split
-    output_path = splits_path / "splitsing output LLM processed.txt"
-    if output_path.exists():
-        output_path.unlink()
-    for agendapunt_met_transcript in agendapunten_met_transcript:
-        with output_path.open("a") as f:
-            f.write(f"{agendapunt_met_transcript.agendapuntnummer}: {agendapunt_met_transcript.list_of_intervals}\n")
+    transcript_split = {nr: [] for nr in agendapuntnummers}
+    transcript_split_numbered = {nr: [] for nr in agendapuntnummers}
+    for item, (first_line, last_line) in zip(items, bounds):
+        transcript_split[agendapuntnummers[item]].append(transcript.slice(first_line, last_line))
+        transcript_split_numbered[agendapuntnummers[item]].append(
+            transcript.slice(first_line, last_line, numbered=True)
+        )
 
-    return transcript_split
+    # save processed split
+    (splits_path / "splitsing output LLM processed.txt").write_text(
+        "".join(
+            f"{nr}: {[(int(b[0]), int(b[1])) for b in bounds[items == index]]}\n"
+            for index, nr in enumerate(agendapuntnummers)
+        )
+    )
+    return (
+        {nr: "".join(parts) for nr, parts in transcript_split.items()},
+        {nr: "".join(parts) for nr, parts in transcript_split_numbered.items()},
+    )
 
 
 def _helper_sorting(dict_item: dict) -> float | int:
@@ -268,5 +227,65 @@ def create_agenda_groups(agendapuntnummers: list, groupsize: int) -> list[list]:
     return agendapuntnummers_groups
 
 
+def plan_agenda_groups(
+    agendapuntnummers: list, output_tokens_per_agendapunt: int, output_token_budget: int
+) -> list[list]:
+    """Verdeel de agendapuntnummers in zo weinig mogelijk groepjes waarvan de verwachte output binnen het budget past.
+
+    De groepjes zijn ongeveer even groot (zie create_agenda_groups). Past alles in 1 call, dan is er 1 groepje.
+    """
+    max_groupsize = max(1, output_token_budget // output_tokens_per_agendapunt)
+    number_of_groups = math.ceil(len(agendapuntnummers) / max_groupsize)
+    if number_of_groups <= 1:
+        return [agendapuntnummers]
+    return create_agenda_groups(agendapuntnummers, groupsize=math.ceil(len(agendapuntnummers) / number_of_groups))
+
+
+def plan_transcript_windows(line_tokens: np.ndarray, window_tokens: int, overlap_lines: int) -> list[tuple[int, int]]:
+    """Verdeel de regels van het transcript in vensters van maximaal window_tokens tokens.
+
+    Geeft gesloten intervallen van regelnummers (vanaf 1). Opeenvolgende vensters overlappen overlap_lines regels,
+    zodat een agendapunt dat vlak bij de grens van een venster begint ook in het volgende venster te zien is.
+    """
+    windows = []
+    start = 0
+    while True:
+        end, tokens = start, 0
+        while end < len(line_tokens) and (end == start or tokens + line_tokens[end] <= window_tokens):
+            tokens += line_tokens[end]
+            end += 1
+        windows.append((start + 1, end))
+        if end >= len(line_tokens):
+            return windows
+        start = max(start + 1, end - overlap_lines)
+
+
+def merge_window_splits(window_splits: list[tuple[tuple[int, int], dict]], agendapuntnummers: list) -> dict:
+    """Voeg de splitsingen per venster samen tot de dict van de splitsing van het hele transcript.
+
+    De intervallen worden afgekapt tot het venster waarin ze gevonden zijn, en intervallen die overlappen (bijvoorbeeld
+    doordat de vensters overlappen) worden samengevoegd. Een agendapunt dat in geen enkel venster gevonden is krijgt
+    een lege lijst, net als bij de andere manieren van splitsen.
+    """
+    gpt_dict = {}
+    for agendapuntnummer in agendapuntnummers:
+        if not any(agendapuntnummer in split for _, split in window_splits):
+            continue
+        intervals = sorted(
+            (max(left, window_start), min(right, window_end))
+            for (window_start, window_end), split in window_splits
+            for left, right in split.get(agendapuntnummer, [])
+            if max(left, window_start) <= min(right, window_end)
+        )
+        merged = []
+        for left, right in intervals:
+            if merged and left <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], right))
+            else:
+                merged.append((left, right))
+        gpt_dict[agendapuntnummer] = merged
+    return gpt_dict
+
+
 if __name__ == "__main__":
     pass
@@ -0,0 +1,121 @@
+"""A small executor for the stages of the pipeline after the transcription (see genereer_notulen.full_pipeline).
+
+Every stage declares the stages it depends on, its parameters and its output files. When a stage is done, its result
+and a hash of every output file are written to a checkpoint manifest (folder/checkpoints/<stage>.json). On a rerun of
+the job, a stage is skipped when its inputs (the results of the stages it depends on and its parameters) did not change
+and its output files are still the ones it wrote. Input files that no stage writes (the transcript, the agenda) are part
+of the parameters, with their file_hash. Stages of which all dependencies are done run concurrently.
+"""
+import hashlib
+import json
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from time import time
+from typing import Callable
+
+from notulen.utils.result_cache import compute_result_cache_key
+from shared.my_logging import logger
+
+
+class Stage:
+    """A step of the pipeline.
+
+    run is called with the results of the stages in depends_on as keyword arguments (by stage name), and returns its
+    result as a dict that can be stored as JSON. Paths in the result are relative to the job folder, so that a rerun
+    with the folder mounted somewhere else still works. outputs gives the output files (relative to the job folder)
+    for a result.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        run: Callable[..., dict],
+        depends_on: tuple[str, ...] = (),
+        parameters: dict | None = None,
+        outputs: Callable[[dict], list[str]] | None = None,
+    ):
+        """Define the stage; it is run by run_stages."""
+        self.name = name
+        self.run = run
+        self.depends_on = depends_on
+        self.parameters = parameters or {}
+        self.outputs = outputs or (lambda result: [])
+
+
+def run_stages(folder: Path, stages: list[Stage]) -> dict:
+    """Run the stages in order of their dependencies, as concurrent as possible, and return their results by name.
+
+    When a stage fails, the stages that do not depend on it still run (and are checkpointed), so that a rerun only
+    has to redo the failed stage and what comes after it. The first error is raised at the end.
+    """
+    pending = {stage.name: stage for stage in stages}
+    results, errors = {}, {}
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        running = {}
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if any(dependency in errors for dependency in stage.depends_on):
+                    logger.warning(f"Stage {name} not run, because a stage it depends on failed")
+                    errors[name] = None
+                    del pending[name]
+                elif all(dependency in results for dependency in stage.depends_on):
+                    inputs = {dependency: results[dependency] for dependency in stage.depends_on}
+                    running[executor.submit(run_stage, folder, stage, inputs)] = name
+                    del pending[name]
+            if not running:
+                raise ValueError(f"Stages {list(pending)} depend on unknown stages or on each other")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    logger.exception(f"Stage {name} failed: {e}")
+                    errors[name] = e
+
+    failures = [e for e in errors.values() if e is not None]
+    if failures:
+        raise failures[0]
+    return results
+
+
+def run_stage(folder: Path, stage: Stage, inputs: dict) -> dict:
+    """Run the stage, or return the result from its checkpoint manifest when that is still valid."""
+    manifest_path = folder / "checkpoints" / f"{stage.name}.json"
+    inputs_key = compute_result_cache_key(inputs, stage.parameters)
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+        outputs_valid = all(file_hash(folder / path) == expected for path, expected in manifest["outputs"].items())
+        if manifest["inputs"] == inputs_key and outputs_valid:
+            logger.info(f"Stage {stage.name}: skipped, the checkpoint is still valid")
+            return manifest["result"]
+        logger.info(f"Stage {stage.name}: inputs or outputs changed since the checkpoint, running again")
+
+    start = time()
+    logger.info(f"Stage {stage.name}: started")
+    result = stage.run(**inputs)
+    outputs = {}
+    for path in stage.outputs(result):
+        if not (folder / path).is_file():
+            raise FileNotFoundError(f"Stage {stage.name} did not write its output {path}")
+        outputs[path] = file_hash(folder / path)
+    manifest = {
+        "stage": stage.name,
+        "inputs": inputs_key,
+        "result": result,
+        "outputs": outputs,
+        "seconds": round(time() - start, 1),
+    }
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    # eerst naar een tijdelijk bestand, zodat een afgebroken job nooit een half manifest achterlaat
+    partial = manifest_path.with_suffix(".partial")
+    partial.write_text(json.dumps(manifest, indent=1, ensure_ascii=False))
+    partial.replace(manifest_path)
+    logger.info(f"Stage {stage.name}: done in {manifest['seconds']} s")
+    return result
+
+
+def file_hash(path: Path) -> str | None:
+    """sha256 of the file, or None when it does not exist. Also for the input files in the parameters of a stage."""
+    return hashlib.sha256(path.read_bytes()).hexdigest() if path.is_file() else None
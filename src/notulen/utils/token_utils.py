@@ -0,0 +1,17 @@
+"""Count tokens locally with the tokenizer of the model of the deployment, to keep the LLM calls within budget."""
+from functools import cache
+
+import tiktoken
+
+from notulen.settings import LLM_TOKEN_ENCODING
+
+
+@cache
+def get_encoding() -> tiktoken.Encoding:
+    """The tokenizer, loaded once per process."""
+    return tiktoken.get_encoding(LLM_TOKEN_ENCODING)
+
+
+def count_tokens(text: str) -> int:
+    """Number of tokens of the text for the model of the deployment."""
+    return len(get_encoding().encode(text, disallowed_special=()))
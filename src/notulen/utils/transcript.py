@@ -0,0 +1,77 @@
+"""The transcript of a meeting, loaded once per job and shared by everything after the transcription."""
+from functools import cached_property
+from pathlib import Path
+
+import numpy as np
+
+from notulen.utils.token_utils import count_tokens
+
+_transcripts = {}
+
+
+class Transcript:
+    """The lines of transcript.txt, with and without line numbers ("12) ...").
+
+    The file is read once. A line-offset index gives the position of every line in the text, so a range of lines is a
+    single slice of the text. The numbered view and the token counts are only made when they are first needed.
+    """
+
+    def __init__(self, path: Path):
+        """Read the transcript and index the start of every line."""
+        self.path = path
+        with open(path, "r", encoding="utf-8") as f:
+            self.text = f.read()
+        # split on "\n" only, like readlines()
+        lines = self.text.split("\n")
+        self.lines = [line + "\n" for line in lines[:-1]] + ([lines[-1]] if lines[-1] else [])
+        # offsets[i] is the position in the text where line i+1 starts, offsets[-1] is the end of the text
+        self.offsets = np.concatenate([[0], np.cumsum([len(line) for line in self.lines], dtype=np.int64)])
+
+    def __len__(self) -> int:
+        """Number of lines."""
+        return len(self.lines)
+
+    @cached_property
+    def numbered_lines(self) -> list[str]:
+        """The lines with their line number (from 1) in front of them."""
+        return [f"{i+1}) " + line for i, line in enumerate(self.lines)]
+
+    @cached_property
+    def numbered_text(self) -> str:
+        """The whole transcript with line numbers."""
+        return "".join(self.numbered_lines)
+
+    @cached_property
+    def numbered_offsets(self) -> np.ndarray:
+        """The line-offset index of numbered_text."""
+        return np.concatenate([[0], np.cumsum([len(line) for line in self.numbered_lines], dtype=np.int64)])
+
+    def slice(self, first_line: int, last_line: int, numbered: bool = False) -> str:
+        """The lines first_line up to and including last_line (from 1) as one string."""
+        first_line = min(max(first_line, 1), len(self) + 1)
+        last_line = min(max(last_line, first_line - 1), len(self))
+        text, offsets = (self.numbered_text, self.numbered_offsets) if numbered else (self.text, self.offsets)
+        return text[offsets[first_line - 1] : offsets[last_line]]  # noqa:E203
+
+    @cached_property
+    def line_tokens(self) -> np.ndarray:
+        """Number of tokens of every numbered line."""
+        return np.array([count_tokens(line) for line in self.numbered_lines], dtype=np.int64)
+
+    def count_tokens(self, numbered: bool = True) -> int:
+        """Number of tokens of the whole transcript."""
+        return int(self.line_tokens.sum()) if numbered else count_tokens(self.text)
+
+
+def get_transcript(folder_path: Path) -> Transcript:
+    """The Transcript of folder_path/transcript.txt, shared by all callers as long as the file does not change.
+
+    The first time, the numbered transcript is also written to transcript_numbered.txt (for debugging).
+    """
+    path = folder_path / "transcript.txt"
+    stat = path.stat()
+    key = (path.resolve(), stat.st_mtime_ns, stat.st_size)
+    if key not in _transcripts:
+        _transcripts[key] = Transcript(path)
+        (folder_path / "transcript_numbered.txt").write_text(_transcripts[key].numbered_text)
+    return _transcripts[key]
@@ -0,0 +1,91 @@
+"""Cache of transcripts, so that a recording that is submitted again (for example to get "Meer uitgebreid" notes after
+"Kort en bondig") does not need a new Whisper run.
+
+The key is a hash of the Content-MD5 and size of the recording files and of the transcription settings. The cached
+transcripts are stored flat in TRANSCRIPT_CACHE_FOLDER on the datalake, so the retention can be based on the last
+modified time of each blob.
+"""
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from notulen.settings import TRANSCRIPT_CACHE_FOLDER, TRANSCRIPT_CACHE_SETTINGS_KEYS
+from shared.my_logging import logger
+from shared.utils import AzureHelper
+
+
+def compute_transcript_cache_key(az: AzureHelper, folder: str, settings: dict) -> str:
+    """Hash the recording files in base_folder/folder/input/opname together with the transcription settings.
+
+    The recordings are not downloaded: the hash uses the Content-MD5 and the size that the blob storage keeps for every
+    blob. The webapp uploads every file with a single Put Blob, for which the blob storage computes the Content-MD5
+    itself. When there are no recordings, a name is not a number or a file has no Content-MD5 (e.g. uploaded in blocks),
+    the key is empty and the cache is not used.
+    """
+    opname_prefix = f"{az.base_folder}/{folder}/input/opname/"
+    blobs = [
+        blob
+        for blob in az.container_client.list_blobs(name_starts_with=opname_prefix)
+        if "." in blob.name.split("/")[-1]
+    ]
+    if not blobs:
+        # without recordings the key would only depend on the settings, and be shared by all such jobs
+        logger.info(f"No recordings found in {opname_prefix}, the transcript cache is not used")
+        return ""
+    if len(blobs) > 1:
+        # same order as in transcribe(): by the number in the filename
+        try:
+            blobs = sorted(blobs, key=lambda blob: int(os.path.splitext(blob.name.split("/")[-1])[0]))
+        except ValueError:
+            logger.info("Names of the recordings are not numbers, the transcript cache is not used")
+            return ""
+
+    sha = hashlib.sha256()
+    for blob in blobs:
+        content_md5 = blob.content_settings.content_md5
+        if not content_md5:
+            logger.info(f"No Content-MD5 for {blob.name}, the transcript cache is not used")
+            return ""
+        sha.update(blob.name.split("/")[-1].encode())
+        sha.update(bytes(content_md5))
+        sha.update(str(blob.size).encode())
+    relevant_settings = {k: settings[k] for k in TRANSCRIPT_CACHE_SETTINGS_KEYS}
+    sha.update(json.dumps(relevant_settings, sort_keys=True).encode())
+    return sha.hexdigest()
+
+
+def fetch_cached_transcript(az: AzureHelper, key: str, folder: str) -> bool:
+    """Copy the cached transcript to base_folder/folder/transcript.txt, if it exists.
+
+    Returns whether there was a cache hit.
+    """
+    cache_blob = az.container_client.get_blob_client(f"{TRANSCRIPT_CACHE_FOLDER}/{key}.txt")
+    if not cache_blob.exists():
+        logger.info(f"Transcript cache miss: {key}")
+        return False
+    transcript = cache_blob.download_blob().readall()
+    az.container_client.upload_blob(f"{az.base_folder}/{folder}/transcript.txt", transcript, overwrite=True)
+    logger.info(f"Transcript cache hit: {key}")
+    return True
+
+
+def store_transcript_in_cache(az: AzureHelper, key: str, transcript_path: Path) -> None:
+    """Upload the transcript to the cache, so that the same recording with the same settings is not transcribed
+    again."""
+    az.container_client.upload_blob(
+        f"{TRANSCRIPT_CACHE_FOLDER}/{key}.txt", transcript_path.read_bytes(), overwrite=True
+    )
+    logger.info(f"Stored transcript in cache: {key}")
+
+
+def delete_expired_transcripts(az: AzureHelper, days: int = 7) -> None:
+    """Delete the cached transcripts that are older than the given number of days (same retention as the notulen)."""
+    deleted = 0
+    expiry = datetime.now(timezone.utc) - timedelta(days=days)
+    for blob in az.container_client.list_blobs(name_starts_with=f"{TRANSCRIPT_CACHE_FOLDER}/"):
+        if blob.name.endswith(".txt") and blob.last_modified < expiry:
+            az.container_client.delete_blob(blob.name)
+            deleted += 1
+    logger.info(f"Deleted {deleted} cached transcripts from the datalake.")
@@ -1,17 +1,23 @@
 import re
 import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Any, Callable
 
 import pypandoc
-from openai import AzureOpenAI
+from openai import NOT_GIVEN, AzureOpenAI, Stream
+from openai.types.chat import ChatCompletionChunk
 from pdf4llm import to_markdown
 from pydantic import BaseModel, Field
 from unidecode import unidecode
 
-from notulen.settings import DEPLOYMENT_NAME
+from notulen.settings import DEPLOYMENT_NAME, LLM_SAMPLING_PARAMETERS
+from notulen.utils.transcript import Transcript, get_transcript
 from shared.my_logging import logger
 
+CONTENT_FILTER_MESSAGE = "Notulen konden niet worden gegenereerd vanwege content filter van het taalmodel."
+
 
 # De volgende 3 classes definieren de "structured output".
 # Ik verwacht dat de docstring van een class en de discription in
@@ -39,68 +45,159 @@ class AgendapuntenMetGevondenRegels(BaseModel):
         description="Lijst van agendapunten en de bijbehorende verzamelingen van regelnummers."
     )
 
+    def to_splitsing(self) -> dict:
+        """Zet om naar de dict van de splitsing: {agendapuntnummer: [(begin, eind), ...]}."""
+        # intervallen allowed to be empty, syntax wise, but can also actually be empty in weird cases.
+        return {
+            agendapunt.agendapuntnummer: [(i.left_endpoint, i.right_endpoint) for i in agendapunt.set_of_intervals]
+            for agendapunt in self.result
+        }
 
-def get_splitsing_prompt(folder_path: Path, agendapuntnummers, for_vve: bool) -> tuple[str, str]:
-    """Returns the prompt."""
-    try:
-        agenda_str = (folder_path / "processed_input_docs/agenda.md").read_text()
-    except FileNotFoundError:
-        try:
-            agenda_str = (folder_path / "input/agenda.txt").read_text()
-        except FileNotFoundError:
-            raise Exception("No agenda in .md or .txt found")
 
-    transcript_lines_numbered = load_transcript(folder_path, numbered=True)
-    transcript = "".join(transcript_lines_numbered)
+# Structured output voor de splitsing in 1 keer: alleen de startregel per agendapunt.
+class StartregelVoorAgendapunt(BaseModel):
+    """Geeft het regelnummer van het transcript waarop de bespreking van het agendapunt begint."""
 
-    if for_vve:
-        prompt_template = (Path(__file__).parent.parent / "prompts" / "prompt_splitsen_vve.md").read_text()
+    agendapuntnummer: str = Field(description="een nummer zoals '1' of '1a'")
+    startregel: int = Field(description="Het regelnummer van het transcript waarop het agendapunt begint.")
+
+
+class StartregelsVanAgendapunten(BaseModel):
+    """."""
+
+    result: list[StartregelVoorAgendapunt] = Field(description="Lijst van agendapunten en hun startregels.")
+
+    def to_splitsing(self) -> dict:
+        """Zet om naar de dict van de splitsing, met een interval van 1 regel per agendapunt.
+
+        apply_gpt_split laat elk agendapunt toch doorlopen tot de startregel van het volgende agendapunt.
+        """
+        return {
+            agendapunt.agendapuntnummer: [(agendapunt.startregel, agendapunt.startregel)] for agendapunt in self.result
+        }
+
+
+def get_splitsing_prompt(
+    folder_path: Path,
+    agendapuntnummers,
+    for_vve: bool,
+    start_lines: bool = False,
+    line_ranges: list[tuple[int, int]] | None = None,
+) -> tuple[str, str]:
+    """Returns the prompt.
+
+    With start_lines=True the prompt asks only for the start line of each agendapunt (see StartregelsVanAgendapunten).
+    With line_ranges (list of (first line, last line)) the prompt only contains those lines of the transcript: with
+    start_lines the left out lines are marked, otherwise the ranges are a window (prompt_splitsen_venster.md).
+    """
+    agenda_str = read_agenda(folder_path)
+    if line_ranges is None:
+        transcript = get_transcript(folder_path).numbered_text
+    else:
+        transcript = _select_line_ranges(get_transcript(folder_path), line_ranges)
+    if start_lines:
+        template_name = "prompt_splitsen_start"
+    elif line_ranges is not None:
+        template_name = "prompt_splitsen_venster"
     else:
-        prompt_template = (Path(__file__).parent.parent / "prompts" / "prompt_splitsen.md").read_text()
+        template_name = "prompt_splitsen"
+    if for_vve:
+        template_name += "_vve"
+    prompt_template = (Path(__file__).parent.parent / "prompts" / f"{template_name}.md").read_text()
 
     agendapuntnummers_str = ", ".join(agendapuntnummers)
-    prompt = prompt_template.format(transcript=transcript, agenda=agenda_str, agendapuntnummers=agendapuntnummers_str)
+    prompt = prompt_template.format(
+        transcript=transcript,
+        agenda=agenda_str,
+        agendapuntnummers=agendapuntnummers_str,
+        venster_begin=line_ranges[0][0] if line_ranges else "",
+        venster_eind=line_ranges[-1][1] if line_ranges else "",
+    )
     return prompt, prompt_template
 
 
-def load_transcript(folder_path: Path, numbered: bool) -> list[str]:
-    """Loads the transscript."""
-    with open(folder_path / "transcript.txt", "r", encoding="utf-8") as f:
-        transcript_lines = f.readlines()
-    transcript_lines_numbered = [f"{i+1}) " + line for i, line in enumerate(transcript_lines)]
-    if numbered:
-        (folder_path / "transcript_numbered.txt").write_text("".join(transcript_lines_numbered))
-        return transcript_lines_numbered
-    else:
-        return transcript_lines
+def read_agenda(folder_path: Path) -> str:
+    """The agenda as Markdown (converted from the PDF) or as the custom agenda text."""
+    try:
+        return (folder_path / "processed_input_docs/agenda.md").read_text()
+    except FileNotFoundError:
+        try:
+            return (folder_path / "input/agenda.txt").read_text()
+        except FileNotFoundError:
+            raise Exception("No agenda in .md or .txt found")
 
 
-def make_llm_call(client: AzureOpenAI, prompt: str, notulen: bool, reason: str = "") -> dict | str | None:
-    """Stuur de prompt naar Azure OpenAI GPT-4o."""
+def _select_line_ranges(transcript: Transcript, line_ranges: list[tuple[int, int]]) -> str:
+    """The numbered lines in the (sorted, disjoint) line ranges, with a marker where lines are left out."""
+    parts = []
+    previous_end = 0
+    for start, end in line_ranges:
+        if start > previous_end + 1:
+            parts.append(f"[... regels {previous_end + 1} t/m {start - 1} weggelaten ...]\n")
+        parts.append(transcript.slice(start, end, numbered=True))
+        previous_end = end
+    if len(transcript) > previous_end:
+        parts.append(f"[... regels {previous_end + 1} t/m {len(transcript)} weggelaten ...]\n")
+    return "".join(parts)
+
+
+def make_llm_call(
+    client: AzureOpenAI,
+    prompt: str,
+    notulen: bool,
+    reason: str = "",
+    structured_output: type[BaseModel] = AgendapuntenMetGevondenRegels,
+    max_tokens: int | None = None,
+    on_token: Callable[[str], None] | None = None,
+    call_record: dict | None = None,
+) -> dict | str | None:
+    """Stuur de prompt naar Azure OpenAI GPT-4o.
+
+    Voor de splitsing (notulen=False) bepaalt structured_output het formaat van het antwoord. Het wordt omgezet in de
+    dict van de splitsing met to_splitsing(). Als de structured output niet binnen max_tokens past, geeft de API een
+    LengthFinishReasonError.
+
+    Voor de notulen wordt het antwoord gestreamd als on_token is gegeven: on_token krijgt elk stukje tekst zodra het
+    binnen is.
+
+    In call_record komen de tokens, de finish_reason en de tijden van de call (voor de ledger, zie utils/llm_ledger.py).
+    """
 
     logger.info(f"Prompting the LLM: {reason}")
     starttime = time.time()
-    prompt = unidecode(prompt)
-    prompt = prompt.replace("\ufeff", "")  # you get this when using MS Word
+    prompt = clean_prompt(prompt)
     if notulen:
         response = client.chat.completions.create(
             model=DEPLOYMENT_NAME,
             response_format={"type": "text"},
             messages=[{"role": "user", "content": prompt}],
-            stream=False,
-            temperature=0.01,
-            # top_p = 0.001
+            stream=on_token is not None,
+            stream_options={"include_usage": True} if on_token is not None else NOT_GIVEN,
+            **LLM_SAMPLING_PARAMETERS["notulen"],
         )
-        if response.choices[0].finish_reason == "content_filter":
+        if on_token is not None:
+            content, finish_reason, usage, first_token_time = read_stream(response, on_token)
+        else:
+            content, finish_reason, usage, first_token_time = (
+                response.choices[0].message.content,
+                response.choices[0].finish_reason,
+                response.usage,
+                None,
+            )
+        _fill_call_record(call_record, starttime, usage, finish_reason, first_token_time)
+        if finish_reason == "content_filter":
             logger.error("Azure OpenAI content filter triggered")
-            return "Notulen konden niet worden gegenereerd vanwege content filter van het taalmodel."
-        content = response.choices[0].message.content
+            return CONTENT_FILTER_MESSAGE
     else:  # splitsing transcript
         response = client.beta.chat.completions.parse(
             model=DEPLOYMENT_NAME,
             messages=[{"role": "user", "content": prompt}],
-            response_format=AgendapuntenMetGevondenRegels,
+            response_format=structured_output,
+            max_tokens=max_tokens or NOT_GIVEN,
+            **LLM_SAMPLING_PARAMETERS["splitsing"],
         )
+        usage = response.usage
+        _fill_call_record(call_record, starttime, usage, response.choices[0].finish_reason, None)
         if response.choices[0].message.refusal:
             logger.error("API (structured outputs) refused the call.")
             return {}
@@ -109,24 +206,56 @@ def make_llm_call(client: AzureOpenAI, prompt: str, notulen: bool, reason: str =
         if len(extracted_data.result) == 0:
             logger.error("Could parse output but got an empty list. So none of agendapunten detected.")
             return {}
-        splitsing_parsed = {}
-        for agendapunt_met_data in extracted_data.result:
-            intervallen = agendapunt_met_data.set_of_intervals
-            # intervallen allowed to be empty, syntax wise, but can also actually be empty in weird cases.
-            intervallen_parsed = []
-            for i in intervallen:
-                intervallen_parsed.append((i.left_endpoint, i.right_endpoint))
-            splitsing_parsed[agendapunt_met_data.agendapuntnummer] = intervallen_parsed
+        splitsing_parsed = extracted_data.to_splitsing()
 
         content = splitsing_parsed
     logger.info(f"LLM call: {round((time.time() - starttime)/60, 1)} minutes")
-    logger.info(
-        f"Input tokens: {response.usage.prompt_tokens}, output tokens: {response.usage.completion_tokens} (API)"
-    )
+    if usage is not None:
+        logger.info(f"Input tokens: {usage.prompt_tokens}, output tokens: {usage.completion_tokens} (API)")
 
     return content
 
 
+def clean_prompt(prompt: str) -> str:
+    """Maak de prompt schoon voor de API (ook voor de Batch API, zie utils/batch_utils.py)."""
+    prompt = unidecode(prompt)
+    return prompt.replace("\ufeff", "")  # you get this when using MS Word
+
+
+def read_stream(
+    stream: Stream[ChatCompletionChunk], on_token: Callable[[str], None]
+) -> tuple[str, str | None, Any, float | None]:
+    """Lees een gestreamd antwoord: geef elk stukje tekst aan on_token, en geef de hele tekst, de finish_reason, het
+    gebruik (tokens, in de laatste chunk) en het tijdstip van het eerste stukje tekst terug."""
+    parts, finish_reason, usage, first_token_time = [], None, None, None
+    for chunk in stream:
+        if chunk.usage is not None:
+            usage = chunk.usage
+        for choice in chunk.choices:  # de eerste chunk van Azure heeft geen choices (alleen de content filter)
+            if choice.delta is not None and choice.delta.content:
+                if first_token_time is None:
+                    first_token_time = time.time()
+                parts.append(choice.delta.content)
+                on_token(choice.delta.content)
+            if choice.finish_reason is not None:
+                finish_reason = choice.finish_reason
+    return "".join(parts), finish_reason, usage, first_token_time
+
+
+def _fill_call_record(
+    call_record: dict | None, starttime: float, usage: Any, finish_reason: str | None, first_token_time: float | None
+) -> None:
+    if call_record is None:
+        return
+    call_record["latency_seconds"] = round(time.time() - starttime, 2)
+    call_record["time_to_first_token_seconds"] = (
+        round(first_token_time - starttime, 2) if first_token_time is not None else None
+    )
+    call_record["prompt_tokens"] = usage.prompt_tokens if usage is not None else None
+    call_record["completion_tokens"] = usage.completion_tokens if usage is not None else None
+    call_record["finish_reason"] = finish_reason
+
+
 def process_llm_output(output: str) -> str:
     """Processes the output from the LLM."""
     output2 = output.replace("`", "").strip()
@@ -194,7 +323,21 @@ def convert_to_docx(path_to_md: str):
     ]
     output = "".join(lines2)
     (parent_folder / "output_processed.md").write_text(output)
-    pypandoc.convert_text(source=output, to="docx", format="markdown", outputfile=parent_folder / f"{name}.docx")
+    render_docx(output, parent_folder / f"{name}.docx")
+
+
+def render_docx(markdown: str, outputfile: Path) -> None:
+    """Render Markdown to a .docx file with pandoc."""
+    pypandoc.convert_text(source=markdown, to="docx", format="markdown", outputfile=outputfile)
+
+
+def render_docx_batch(documents: dict[Path, str]) -> None:
+    """Render several Markdown documents ({outputfile: markdown}) at once.
+
+    Every document gets its own pandoc process, so threads are enough to render them in parallel.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, len(documents))) as executor:
+        list(executor.map(render_docx, documents.values(), documents.keys()))
 
 
 def new_trial_nr(path: Path) -> str:
@@ -225,18 +368,13 @@ def convert_stuff_to_docx_for_stakeholders(folder_path: Path, splits_path: Path,
     """
     out_path = folder_path / "result"
     out_path.mkdir(exist_ok=True, parents=True)
-    pypandoc.convert_file(
-        source_file=splits_path / "splitsing output LLM.txt",
-        format="md",
-        to="docx",
-        outputfile=out_path / "splitsing output LLM.docx",
-    )
-    pypandoc.convert_file(
-        source_file=splits_path / "resultaat splitsing.md",
-        format="md",
-        to="docx",
-        outputfile=out_path / "resultaat splitsing.docx",
+    render_docx_batch(
+        {
+            out_path / "splitsing output LLM.docx": (splits_path / "splitsing output LLM.txt").read_text(),
+            out_path / "resultaat splitsing.docx": (splits_path / "resultaat splitsing.md").read_text(),
+        }
     )
+    # notulen.docx is al gemaakt aan het eind van genereer_notulen
     shutil.copy(src=notulen_output_path / "notulen.docx", dst=out_path / "notulen.docx")
 
 
@@ -0,0 +1,100 @@
+"""Versioned snapshots of the (CTranslate2) Whisper model, so that the transcribe job does not download the model from
+the Hugging Face hub every time it starts.
+
+Publish a snapshot once (locally), for example:
+    python src/notulen/utils/whisper_model_utils.py --model-size large-v2 --version v1 --output data/whisper_models
+and upload the folder data/whisper_models/large-v2/v1 to WHISPER_MODEL_FOLDER/large-v2/v1 on the datalake. The
+pipeline mounts that folder as the model_folder input of the transcribe job.
+"""
+import argparse
+import hashlib
+import json
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+from faster_whisper import WhisperModel
+from faster_whisper.utils import download_model
+
+from shared.my_logging import logger
+
+MANIFEST_NAME = "manifest.json"
+
+
+def publish_model_artifact(model_size: str, version: str, output_root: Path) -> Path:
+    """Download the model from the hub into output_root/model_size/version and write a manifest.
+
+    The manifest records the size and sha256 of every file, and how long the download took (which is the cold-start
+    time that a job saves by loading the snapshot instead).
+    """
+    model_dir = output_root / model_size / version
+    if (model_dir / MANIFEST_NAME).exists():
+        raise FileExistsError(f"Model artifact {model_dir} already exists, publish a new version instead.")
+    model_dir.mkdir(parents=True, exist_ok=True)
+
+    start = time.time()
+    download_model(model_size, output_dir=model_dir.as_posix())
+    download_seconds = round(time.time() - start, 1)
+
+    files = {}
+    for path in sorted(p for p in model_dir.iterdir() if p.is_file() and p.name != MANIFEST_NAME):
+        files[path.name] = {"size": path.stat().st_size, "sha256": _sha256(path)}
+    manifest = {
+        "model_size": model_size,
+        "version": version,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "download_seconds": download_seconds,
+        "files": files,
+    }
+    (model_dir / MANIFEST_NAME).write_text(json.dumps(manifest, indent=4))
+    logger.info(f"Published {model_size} {version} to {model_dir} (download took {download_seconds} s)")
+    return model_dir
+
+
+def verify_model_artifact(model_dir: Path, full: bool = False) -> dict:
+    """Check that every file of the manifest is present with the right size (and with full=True: the right hash).
+
+    Returns the manifest.
+    """
+    manifest_path = model_dir / MANIFEST_NAME
+    if not manifest_path.exists():
+        raise FileNotFoundError(f"No {MANIFEST_NAME} in model folder {model_dir}")
+    manifest = json.loads(manifest_path.read_text())
+    for name, expected in manifest["files"].items():
+        path = model_dir / name
+        if not path.exists() or path.stat().st_size != expected["size"]:
+            raise ValueError(f"Model artifact {model_dir} is incomplete: {name} missing or wrong size")
+        if full and _sha256(path) != expected["sha256"]:
+            raise ValueError(f"Model artifact {model_dir} is corrupt: wrong hash for {name}")
+    logger.info(f"Verified model artifact {manifest['model_size']} {manifest['version']}")
+    return manifest
+
+
+def warm_model(model: WhisperModel) -> float:
+    """Run the model once on a second of silence, so that the first real chunk does not pay for initialisation.
+
+    Returns the time this took in seconds.
+    """
+    start = time.time()
+    segments, _ = model.transcribe(np.zeros(16000, dtype=np.float32), language="nl", beam_size=1)
+    list(segments)  # segments is a generator, so this runs the model
+    return time.time() - start
+
+
+def _sha256(path: Path) -> str:
+    """Hash a (large) file in blocks."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**24), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Publish a versioned snapshot of a Whisper model.")
+    parser.add_argument("--model-size", default="large-v2")
+    parser.add_argument("--version", required=True)
+    parser.add_argument("--output", default="data/whisper_models")
+    args = parser.parse_args()
+    publish_model_artifact(args.model_size, args.version, Path(args.output))
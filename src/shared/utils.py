@@ -72,6 +72,14 @@ class AzureHelper:
 
         return blob_folder
 
+    def download_text(self, folder_path: str, filename: str) -> str | None:
+        """Downloads base_folder/folder_path/filename as text, or None if it does not exist (yet)."""
+        full_filepath = os.path.join(self.base_folder, folder_path, filename)
+        blob_client = self.blob_service_client.get_blob_client(container=self.container_name, blob=full_filepath)
+        if not blob_client.exists():
+            return None
+        return blob_client.download_blob().readall().decode("utf-8")
+
     def delete_blob_folder(self, input_folder: str):
         """Delete the given folder on the datalake.
 
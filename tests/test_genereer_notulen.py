@@ -0,0 +1,74 @@
+"""Tests of the splitting of the transcript in genereer_notulen."""
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+from notulen import genereer_notulen
+from notulen.utils.utilities import (
+    AgendapuntenMetGevondenRegels,
+    ClosedIntervalOfLineNumbers,
+    RegelnummersVoorAgendapunt,
+    StartregelsVanAgendapunten,
+)
+
+AGENDA_SPLITSING = {"1": "Opening", "2": "Rondvraag"}
+
+
+class FakeClient:
+    """Fake OpenAI client: the start-line call raises error, the grouped calls answer with a split."""
+
+    def __init__(self, error: Exception):
+        """Initialize with the error of the start-line call."""
+        self.error = error
+        self.grouped_calls = 0
+        self.beta = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(parse=self.parse)))
+
+    def with_options(self, **kwargs) -> "FakeClient":
+        """The timeout and retries of an attempt do not matter here."""
+        return self
+
+    def parse(self, response_format: type, **kwargs) -> SimpleNamespace:
+        """Fake beta.chat.completions.parse."""
+        if response_format is StartregelsVanAgendapunten:
+            raise self.error
+        self.grouped_calls += 1
+        parsed = AgendapuntenMetGevondenRegels(
+            result=[
+                RegelnummersVoorAgendapunt(
+                    agendapuntnummer="1",
+                    set_of_intervals=[ClosedIntervalOfLineNumbers(left_endpoint=1, right_endpoint=5)],
+                ),
+                RegelnummersVoorAgendapunt(
+                    agendapuntnummer="2",
+                    set_of_intervals=[ClosedIntervalOfLineNumbers(left_endpoint=6, right_endpoint=9)],
+                ),
+            ]
+        )
+        message = SimpleNamespace(parsed=parsed, refusal=None)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason="stop")], usage=None)
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        openai.LengthFinishReasonError(completion=SimpleNamespace(usage=None)),
+        openai.APIError("boom", httpx.Request("POST", "https://example.com"), body=None),
+    ],
+)
+def test_start_lines_failure_falls_back_to_grouped(tmp_path, monkeypatch, error):
+    """A failed start-line call does not fail the splitsing, it is split in groups instead."""
+    client = FakeClient(error)
+    monkeypatch.setenv("split_strategy", "start_lines")
+    monkeypatch.setenv("llm_execution_mode", "realtime")
+    monkeypatch.setenv("llm_hedge_split_after", "0")
+    monkeypatch.setattr(genereer_notulen, "init_openai_client", lambda: client)
+    monkeypatch.setattr(genereer_notulen, "get_splitsing_prompt", lambda *args, **kwargs: ("prompt", ""))
+    monkeypatch.setattr(genereer_notulen, "count_tokens", lambda prompt: 100)
+    monkeypatch.setattr(genereer_notulen, "presegment_transcript", lambda *args: (None, None))
+
+    gpt_dict, _ = genereer_notulen.split_transcript(tmp_path, AGENDA_SPLITSING, False, tmp_path)
+
+    assert client.grouped_calls > 0
+    assert gpt_dict == {"1": [(1, 5)], "2": [(6, 9)]}
@@ -14,11 +14,21 @@ from streamlit.delta_generator import DeltaGenerator
 from upload_component import blob_storage_upload_component
 
 from notulen.azure_infra.notulen_pipeline import run_pipeline
+from notulen.settings import (
+    DEFAULT_TRANSCRIBE_PROFILE,
+    LLM_EXECUTION_MODE,
+    PROGRESS_FILENAME,
+    VIDEO_MEDIA_FILES,
+)
+from notulen.utils.progress_utils import read_last_progress_event
 from shared.my_logging import logger
 from shared.utils import AzureHelper
 
 set_styling()
 
+TRANSCRIBE_PROFILE_LABELS = {"fast": "Snel", "balanced": "Gebalanceerd", "accurate": "Nauwkeurig"}
+LLM_EXECUTION_MODE_LABELS = {"realtime": "Zo snel mogelijk", "batch": "Binnen een dag (goedkoper)"}
+
 # @st.cache_resource()
 def get_azure_helper() -> AzureHelper:
     """."""
@@ -80,8 +90,12 @@ def start_pipeline(timestamp: str):
                 email=email,
                 vve_number=st.session_state.vve_number,
                 for_vve=False,
+                transcribe_profile=st.session_state.transcribe_profile,
+                llm_execution_mode=st.session_state.llm_execution_mode,
+                extract_audio_first=any(f.split(".")[-1] in VIDEO_MEDIA_FILES for f in st.session_state.uploaded_files),
             )
             run_id = pipeline_job.name
+            az = get_azure_helper()
 
             # Poll the pipeline status
             full_pipeline = ml_client.jobs.get(run_id)
@@ -114,6 +128,12 @@ def start_pipeline(timestamp: str):
                     progress_text = "Notulen genereren... dit kan een paar minuten duren..."
                     progress_percentage = 75
                     suffix = " bij het genereren van notulen (transcriberen ging wel goed)."
+                    # de post transcribe job schrijft de voortgang per agendapunt in de job folder
+                    progress_event = read_last_progress_event(az.download_text(timestamp, PROGRESS_FILENAME) or "")
+                    if progress_event is not None and progress_event["items_total"] > 0:
+                        items_done, items_total = progress_event["items_done"], progress_event["items_total"]
+                        progress_text = f"Notulen genereren... {items_done} van {items_total} agendapunten klaar..."
+                        progress_percentage = 75 + 20 * items_done // items_total
 
                 progress_bar.progress(progress_percentage, text=progress_text)
                 pipeline_status = ml_client.jobs.get(run_id).status
@@ -232,6 +252,10 @@ if "agendapunten" not in st.session_state:
     st.session_state.agendapunten = []
 if "type_notulen" not in st.session_state:
     st.session_state.type_notulen = None
+if "transcribe_profile" not in st.session_state:
+    st.session_state.transcribe_profile = DEFAULT_TRANSCRIBE_PROFILE
+if "llm_execution_mode" not in st.session_state:
+    st.session_state.llm_execution_mode = LLM_EXECUTION_MODE
 if "agenda_checked" not in st.session_state:
     st.session_state.agenda_checked = False
 if "for_vve" not in st.session_state:
@@ -346,6 +370,22 @@ with notulen_type_placeholder.container():
             st.markdown("*We genereren korte, bondige notulen.*")
         elif st.session_state.type_notulen == "Meer uitgebreid":
             st.markdown("*We genereren notulen met meer details en context.*")
+        st.radio(
+            "Kies de nauwkeurigheid van het transcriberen:",
+            options=list(TRANSCRIBE_PROFILE_LABELS),
+            format_func=lambda profile: TRANSCRIBE_PROFILE_LABELS[profile],
+            key="transcribe_profile",
+            horizontal=True,
+            help="Snel is geschikt voor korte, interne overleggen. Kies nauwkeurig voor formele vergaderingen, zoals een ledenvergadering van een VvE.",
+        )
+        st.radio(
+            "Wanneer heb je de notulen nodig?",
+            options=list(LLM_EXECUTION_MODE_LABELS),
+            format_func=lambda mode: LLM_EXECUTION_MODE_LABELS[mode],
+            key="llm_execution_mode",
+            horizontal=True,
+            help="Heb je geen haast? Dan maken we de notulen goedkoper, maar het kan dan tot een dag duren. Je krijgt ze per e-mail.",
+        )
 
 with upload_component_placeholder.container():
     if st.session_state.agenda_checked and st.session_state.agenda_valid and st.session_state.type_notulen is not None: